@@ -1,12 +1,26 @@
 #!/usr/bin/python
 
+import copy
 import errno
+import hashlib
+import json
 import logging
 import math
 import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+import queue
+try:
+    import numpy
+except ImportError:
+    numpy = None
 from converter.codecs import codec_lists
 from converter.formats import format_list
-from converter.ffmpeg import FFMpeg
+from converter.ffmpeg import FFMpeg, ProgressEvent
+from converter.cache import file_identity
 
 logger = logging.getLogger(__name__)
 
@@ -15,6 +29,102 @@ class ConverterError(Exception):
     pass
 
 
+class ConversionProfile(object):
+    """
+    Conversion options validated once, for running many conversions with
+    the same options. Create profiles with Converter.compile_profile(),
+    and pass them to Converter.convert() in place of the options dict.
+
+    Only the parts of the ffmpeg option list that depend on the source
+    (its video geometry: size, aspect ratios and rotation) are derived
+    per conversion, and those are memoised by source geometry, so
+    converting many files of the same few shapes doesn't re-run the codec
+    and format option parsing.
+
+    Profiles are immutable and safe to share between threads.
+
+    >>> profile = Converter().compile_profile({
+    ...    'format': 'mkv',
+    ...    'audio': { 'codec': 'aac' },
+    ...    'video': { 'codec': 'h264', 'width': 1280 }
+    ... })
+    >>> for f in files:
+    ...    for timecode in c.convert(f, f + '.mkv', profile):
+    ...        pass
+    """
+
+    __slots__ = ('_converter', '_options', '_maxsize', '_bound', '_lock',
+                 'hits', 'misses')
+
+    def __init__(self, converter, options, maxsize=1024):
+        """
+        :param converter: Converter the profile is compiled for
+        :param options: Conversion options, see Converter.convert()
+        :param maxsize: Maximum number of memoised option lists
+        """
+        if not isinstance(options, dict):
+            raise ConverterError('Invalid options')
+        options = copy.deepcopy(options)
+        converter.parse_options(options)  # validate
+
+        set_attr = super(ConversionProfile, self).__setattr__
+        set_attr('_converter', converter)
+        set_attr('_options', options)
+        set_attr('_maxsize', maxsize)
+        set_attr('_bound', OrderedDict())
+        set_attr('_lock', threading.Lock())
+        set_attr('hits', 0)
+        set_attr('misses', 0)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('ConversionProfile is immutable')
+
+    @property
+    def options(self):
+        """
+        A copy of the options the profile was compiled from.
+        """
+        return copy.deepcopy(self._options)
+
+    @staticmethod
+    def source_key(info):
+        """
+        The source geometry the option list depends on.
+        """
+        v = info.video
+        if v is None:
+            return None
+        return (v.video_width, v.video_height, v.video_display_aspect_ratio,
+                v.video_sample_aspect_ratio, v.metadata.get('rotate'))
+
+    def bind(self, info, twopass=None):
+        """
+        Return the ffmpeg option list for converting a source described
+        by info (a MediaInfo object), for the given pass (see
+        Converter.parse_options()).
+        """
+        key = (self.source_key(info) if 'video' in self._options else None,
+               twopass)
+        with self._lock:
+            optlist = self._bound.get(key)
+            if optlist is not None:
+                self._bound.move_to_end(key)
+                super(ConversionProfile, self).__setattr__('hits', self.hits + 1)
+                return list(optlist)
+
+        options, _ = self._converter._source_options(self._options, info)
+        optlist = tuple(self._converter.parse_options(options, twopass))
+        with self._lock:
+            super(ConversionProfile, self).__setattr__('misses', self.misses + 1)
+            self._bound[key] = optlist
+            while len(self._bound) > self._maxsize:
+                self._bound.popitem(last=False)
+        return list(optlist)
+
+    def __repr__(self):
+        return 'ConversionProfile(%r)' % (self._options,)
+
+
 class Converter(object):
     """
     Converter class, encapsulates formats and codecs.
@@ -22,10 +132,19 @@ class Converter(object):
     >>> c = Converter()
     """
 
-    def __init__(self, ffmpeg_path=None, ffprobe_path=None):
-        """Initialize a new Converter object."""
+    def __init__(self, ffmpeg_path=None, ffprobe_path=None, probe_cache=None,
+                 capabilities_cache=None):
+        """
+        Initialize a new Converter object.
+
+        :param probe_cache: Optional converter.cache.ProbeCache, shared by
+            probe(), convert() and segment()
+        :param capabilities_cache: Optional JSON file name where the
+            capabilities of the ffmpeg binary are remembered between runs
+        """
         self.ffmpeg = FFMpeg(
-            ffmpeg_path=ffmpeg_path, ffprobe_path=ffprobe_path)
+            ffmpeg_path=ffmpeg_path, ffprobe_path=ffprobe_path,
+            probe_cache=probe_cache, capabilities_cache=capabilities_cache)
         self.video_codecs = {}
         self.audio_codecs = {}
         self.subtitle_codecs = {}
@@ -48,7 +167,13 @@ class Converter(object):
             self.formats[name] = cls
 
     def parse_options(self, opt, twopass=None):
-        """Parse format/codec options and prepare raw ffmpeg option list."""
+        """
+        Parse format/codec options and prepare raw ffmpeg option list.
+
+        Codecs and formats the ffmpeg binary doesn't support (see
+        FFMpeg.capabilities) are rejected with ConverterError. If the
+        capabilities can't be detected, this check is skipped.
+        """
         if not isinstance(opt, dict):
             raise ConverterError('Invalid output specification')
 
@@ -59,9 +184,18 @@ class Converter(object):
         if f not in self.formats:
             raise ConverterError('Requested unknown format: ' + str(f))
 
-        format_options = self.formats[f]().parse_options(opt)
+        fmt = self.formats[f]()
+        format_options = fmt.parse_options(opt)
         if format_options is None:
             raise ConverterError('Unknown container format error')
+        self._check_supported(fmt.ffmpeg_format_name, 'muxer')
+        min_version = fmt.required_ffmpeg_version(opt)
+        if min_version:
+            self._check_version(min_version, 'the %s format options' % f)
+
+        if twopass == 1:
+            # the first pass only collects statistics, its output is discarded
+            format_options = ['-f', 'null']
 
         if 'audio' not in opt and 'video' not in opt:
             raise ConverterError('Neither audio nor video streams requested')
@@ -77,6 +211,7 @@ class Converter(object):
         c = opt_audio['codec']
         if c not in self.audio_codecs:
             raise ConverterError('Requested unknown audio codec ' + str(c))
+        self._check_supported(self.audio_codecs[c].ffmpeg_codec_name, 'encoder')
 
         audio_options = self.audio_codecs[c]().parse_options(opt_audio)
         if audio_options is None:
@@ -93,6 +228,7 @@ class Converter(object):
         c = opt_video['codec']
         if c not in self.video_codecs:
             raise ConverterError('Requested unknown video codec ' + str(c))
+        self._check_supported(self.video_codecs[c].ffmpeg_codec_name, 'encoder')
 
         video_options = self.video_codecs[c]().parse_options(opt_video)
         if video_options is None:
@@ -108,6 +244,7 @@ class Converter(object):
         c = opt_subtitle['codec']
         if c not in self.subtitle_codecs:
             raise ConverterError('Requested unknown subtitle codec ' + str(c))
+        self._check_supported(self.subtitle_codecs[c].ffmpeg_codec_name, 'encoder')
 
         subtitle_options = self.subtitle_codecs[
             c]().parse_options(opt_subtitle)
@@ -121,6 +258,13 @@ class Converter(object):
             else:
                 format_options.extend(['-map', str(m)])
 
+        if 'threads' in opt:
+            t = opt['threads']
+            if not isinstance(t, int) or t < 0:
+                raise ConverterError('threads needs to be a non-negative int')
+            else:
+                format_options.extend(['-threads', str(t)])
+
         # aggregate all options
         optlist = audio_options + video_options + subtitle_options + \
             format_options
@@ -132,11 +276,50 @@ class Converter(object):
 
         return optlist
 
-    def convert(self, infile, outfile, options, twopass=False, timeout=10):
+    def _check_supported(self, name, kind):
+        """
+        Raise ConverterError if the ffmpeg binary is known not to support
+        the named encoder or muxer.
+        """
+        if not name:
+            return  # null and copy codecs
+        caps = self.ffmpeg.capabilities
+        if caps is None:
+            return
+        supported = caps.has_encoder(name) if kind == 'encoder' else caps.has_muxer(name)
+        if not supported:
+            raise ConverterError('ffmpeg %s does not support the %s %s' % (
+                caps.version or self.ffmpeg.ffmpeg_path, kind, name))
+
+    def _check_version(self, minimum, feature):
+        """
+        Raise ConverterError if the ffmpeg binary is known to be older
+        than the minimum version (a tuple, e.g. (3, 4)) feature needs.
+        """
+        caps = self.ffmpeg.capabilities
+        version = caps.version_info if caps is not None else None
+        if version is not None and version < minimum:
+            raise ConverterError('ffmpeg %s does not support %s (%s or newer '
+                                 'is needed)' % (caps.version, feature,
+                                                 '.'.join(map(str, minimum))))
+
+    def compile_profile(self, options):
+        """
+        Validate the conversion options and return them as a
+        ConversionProfile, which can be passed to convert() in place of
+        the options to skip most of the per-conversion option parsing.
+        Raises ConverterError if the options are invalid.
+        """
+        return ConversionProfile(self, options)
+
+    def convert(self, infile, outfile, options, twopass=False, timeout=10,
+                deadline=None, parallel_chunks=None, passlog_dir=None,
+                progress_events=False, smart_copy=False):
         """
         Convert media file (infile) according to specified options, and save it to outfile. For two-pass encoding, specify the pass (1 or 2) in the twopass parameter.
 
-        Options should be passed as a dictionary. The keys are:
+        Options should be passed as a dictionary, or a ConversionProfile
+        (see compile_profile()). The keys are:
             * format (mandatory, string) - container format; see
               formats.BaseFormat for list of supported formats
             * audio (optional, dict) - audio codec and options; see
@@ -144,6 +327,8 @@ class Converter(object):
             * video (optional, dict) - video codec and options; see
               codecs.video.VideoCodec for list of supported options
             * map (optional, int) - can be used to map all content of stream 0
+            * threads (optional, int) - number of threads the encoders may
+              use (0 lets ffmpeg decide)
 
         Multiple audio/video streams are not supported. The output has to
         have at least an audio or a video stream (or both).
@@ -151,17 +336,49 @@ class Converter(object):
         Convert returns a generator that needs to be iterated to drive the
         conversion process. The generator will periodically yield timecode
         of currently processed part of the file (ie. at which second in the
-        content is the conversion process currently).
-
-        The optional timeout argument specifies how long should the operation
-        be blocked in case ffmpeg gets stuck and doesn't report back. This
-        doesn't limit the total conversion time, just the amount of time
-        Converter will wait for each update from ffmpeg. As it's usually
-        less than a second, the default of 10 is a reasonable default. To
-        disable the timeout, set it to None. You may need to do this if
-        using Converter in a threading environment, since the way the
-        timeout is handled (using signals) has special restriction when
-        using threads.
+        content is the conversion process currently). If progress_events
+        is True, it yields ProgressEvent objects instead, carrying the
+        fraction of the job done along with the encoding speed, output size
+        and estimated time left.
+
+        The optional timeout argument specifies how long (in seconds of
+        wall time) should the operation be blocked in case ffmpeg gets stuck
+        and doesn't report back. This doesn't limit the total conversion
+        time, just the amount of time Converter will wait for each update
+        from ffmpeg. As it's usually less than a second, the default of 10
+        is a reasonable default. To disable the timeout, set it to None.
+        The optional deadline argument limits the total time of each ffmpeg
+        run. When a limit expires, ffmpeg is killed and
+        converter.ffmpeg.FFMpegTimeoutError is raised. Neither uses signals,
+        so Converter can be used from any thread, and many conversions can
+        run concurrently in one process.
+
+        With two-pass encoding, the first pass only collects statistics:
+        its output goes to ffmpeg's null muxer, and its log is kept in a
+        private temporary directory (removed afterwards), so concurrent
+        two-pass conversions don't interfere with each other. If
+        passlog_dir is given, first-pass statistics are stored there and
+        reused for later conversions of the same (unchanged) source with
+        the same options, disregarding the bitrates, so the first pass can
+        be skipped when producing the same video at several bitrates.
+        The first pass accounts for the first half of the progress, and
+        the second pass is expected to take as long as the first when
+        estimating the time left.
+
+        If smart_copy is True, the source video and audio streams are
+        copied instead of re-encoded when they already match the requested
+        codec and options (see codecs.BaseCodec.can_copy()), e.g. when an
+        h264/yuv420p source is converted to h264 of the same size and no
+        higher bitrate. Two-pass encoding is skipped if the video is
+        copied.
+
+        If parallel_chunks is set to N > 1, the video is split at keyframes
+        into N chunks that are encoded by concurrent ffmpeg processes and
+        then stitched together with the concat demuxer, while the audio is
+        encoded once, separately. This keeps all cores busy with encoders
+        that don't scale well with threads (e.g. VP8/VP9). Chunked encoding
+        can't be combined with two-pass encoding, and subtitles aren't
+        copied. Progress reflects the video chunks.
 
         >>> conv = Converter().convert('test1.ogg', '/tmp/output.mkv', {
         ...    'format': 'mkv',
@@ -172,6 +389,11 @@ class Converter(object):
         >>> for timecode in conv:
         ...   pass # can be used to inform the user about the progress
         """
+        profile = None
+        if isinstance(options, ConversionProfile):
+            profile = options
+            options = profile._options  # not modified below
+
         if not isinstance(options, dict):
             raise ConverterError('Invalid options')
 
@@ -185,6 +407,219 @@ class Converter(object):
         if not info.video and not info.audio:
             raise ConverterError('Source file has no audio or video streams')
 
+        options, preoptlist = self._source_options(options, info)
+        if smart_copy:
+            copied = self._smart_copy(options, info)
+            if copied != options:
+                options = copied
+                profile = None
+            if options.get('video', {}).get('codec') == 'copy':
+                twopass = False
+        if not info.format or not info.format.duration or not isinstance(info.format.duration, (float, int)) or info.format.duration < 0.01:
+            raise ConverterError('Zero-length media')
+
+        started = time.monotonic()
+        if parallel_chunks and parallel_chunks > 1:
+            if twopass:
+                raise ConverterError('Chunked encoding does not support two-pass encoding')
+            if info.video and options.get('video', {}).get('codec') not in (None, 'copy'):
+                chunked = self._convert_chunked(infile, outfile, options, info,
+                                                parallel_chunks, timeout,
+                                                deadline, preoptlist,
+                                                progress_events, started)
+                for progress in chunked:
+                    yield progress
+                return
+
+        if twopass:
+            if profile is not None:
+                optlists = profile.bind(info, 1), profile.bind(info, 2)
+            else:
+                optlists = self.parse_options(options, 1), self.parse_options(options, 2)
+            twopass_gen = self._convert_twopass(infile, outfile, optlists,
+                                                info.format.duration, timeout,
+                                                deadline, preoptlist, passlog_dir,
+                                                progress_events, started)
+            for progress in twopass_gen:
+                yield progress
+        else:
+            if profile is not None:
+                optlist = profile.bind(info)
+            else:
+                optlist = self.parse_options(options, twopass)
+            updates = self.ffmpeg.convert(infile, outfile, optlist,
+                                          timeout=timeout, deadline=deadline,
+                                          preopts=preoptlist,
+                                          detailed=progress_events)
+            for progress in self._progress(updates, info.format.duration,
+                                           progress_events, started):
+                yield progress
+
+    @staticmethod
+    def _progress(updates, duration, events=False, started=None, offset=0.0,
+                  weight=1.0, after=0.0):
+        """
+        Turn the updates of an ffmpeg run that covers the fraction
+        offset..offset+weight of a job into the job progress: fractions,
+        or ProgressEvent objects if events is True (in which case the
+        updates are detailed ConvertProgress objects). After is the
+        expected wall time of the rest of the job, as a multiple of the
+        time of this run, and started the monotonic time the job started.
+        """
+        run_started = time.monotonic()
+        for update in updates:
+            if not events:
+                yield offset + weight * float(update) / duration
+                continue
+
+            if update.timecode is None:
+                continue
+            done = min(1.0, update.timecode / duration)
+            now = time.monotonic()
+            eta = None
+            if done > 0:
+                eta = (now - run_started) / done * (1.0 - done + after)
+            yield ProgressEvent(offset + weight * done, update.timecode,
+                                update.fps, update.speed, update.bitrate,
+                                update.total_size, now - (started or run_started),
+                                eta, duration)
+
+    def _convert_twopass(self, infile, outfile, optlists, duration, timeout,
+                         deadline, preoptlist, passlog_dir=None, events=False,
+                         started=None):
+        optlist1, optlist2 = optlists
+
+        scratch = tempfile.mkdtemp(prefix='converter-2pass-')
+        try:
+            passlog = os.path.join(scratch, 'pass')
+            key = None
+            if passlog_dir:
+                key = self._passlog_key(infile, optlist1, preoptlist)
+
+            if key is not None and self._load_passlog(passlog_dir, key, passlog):
+                first = 0.0
+            else:
+                updates = self.ffmpeg.convert(infile, os.devnull,
+                                              optlist1 + ['-passlogfile', passlog],
+                                              timeout=timeout, deadline=deadline,
+                                              preopts=preoptlist, detailed=events)
+                for progress in self._progress(updates, duration, events, started,
+                                               weight=0.5, after=1.0):
+                    yield progress
+                if key is not None:
+                    self._save_passlog(passlog_dir, key, passlog)
+                first = 0.5
+
+            updates = self.ffmpeg.convert(infile, outfile,
+                                          optlist2 + ['-passlogfile', passlog],
+                                          timeout=timeout, deadline=deadline,
+                                          preopts=preoptlist, detailed=events)
+            for progress in self._progress(updates, duration, events, started,
+                                           offset=first, weight=1.0 - first):
+                yield progress
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    # options that don't affect the first-pass statistics
+    PASSLOG_IGNORED_OPTIONS = ('-vb', '-maxrate', '-bufsize', '-threads')
+
+    def _passlog_key(self, infile, optlist, preoptlist=None):
+        """
+        Key of the first-pass statistics for the current version of infile
+        read with preoptlist (input options, e.g. -ss and -t) and encoded
+        with optlist (pass 1 options), or None if infile can't be stat'ed.
+        """
+        try:
+            identity = file_identity(infile)
+        except OSError:
+            return None
+        opts = []
+        i = 0
+        while i < len(optlist):
+            if optlist[i] in self.PASSLOG_IGNORED_OPTIONS:
+                i += 2
+                continue
+            opts.append(optlist[i])
+            i += 1
+        data = json.dumps([list(identity), list(preoptlist or []), opts])
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _load_passlog(passlog_dir, key, passlog):
+        """
+        Copy the cached statistics for key to the passlog prefix. Returns
+        False if there are none.
+        """
+        try:
+            with open(os.path.join(passlog_dir, key + '.json')) as f:
+                suffixes = json.load(f)
+            for suffix in suffixes:
+                shutil.copyfile(os.path.join(passlog_dir, key + suffix),
+                                passlog + suffix)
+        except (IOError, OSError, ValueError):
+            return False
+        logger.debug('Reusing first-pass statistics ' + key)
+        return True
+
+    @staticmethod
+    def _save_passlog(passlog_dir, key, passlog):
+        """
+        Store the statistics written to the passlog prefix under key. The
+        files are replaced atomically, and the list of files is written
+        last, so concurrent readers never see incomplete statistics.
+        """
+        def store(src, name):
+            fd, tmp = tempfile.mkstemp(dir=passlog_dir, prefix='.tmp-')
+            os.close(fd)
+            try:
+                shutil.copyfile(src, tmp)
+                os.rename(tmp, os.path.join(passlog_dir, name))
+            except (IOError, OSError):
+                os.unlink(tmp)
+                raise
+
+        prefix = os.path.basename(passlog)
+        scratch = os.path.dirname(passlog)
+        try:
+            try:
+                os.makedirs(passlog_dir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            suffixes = [name[len(prefix):] for name in sorted(os.listdir(scratch))
+                        if name.startswith(prefix)]
+            for suffix in suffixes:
+                store(passlog + suffix, key + suffix)
+            manifest = passlog + '.json'
+            with open(manifest, 'w') as f:
+                json.dump(suffixes, f)
+            store(manifest, key + '.json')
+        except (IOError, OSError) as e:
+            logger.warning("Can't store first-pass statistics: %s" % e)
+
+    def _smart_copy(self, options, info):
+        """
+        Switch the video and audio codecs to copy where the source stream
+        already matches the requested options.
+        """
+        options = options.copy()
+        for kind, stream, codecs in (('video', info.video, self.video_codecs),
+                                     ('audio', info.audio, self.audio_codecs)):
+            opt = options.get(kind)
+            if not stream or not isinstance(opt, dict) or opt.get('codec') not in codecs:
+                continue
+            if codecs[opt['codec']]().can_copy(stream, opt):
+                logger.debug('Copying %s stream (%s) instead of re-encoding' % (
+                    kind, stream.codec))
+                options[kind] = {'codec': 'copy'}
+        return options
+
+    @staticmethod
+    def _source_options(options, info):
+        """
+        Add the source video geometry to the video options, and extract
+        the custom launch options. Returns (options, preoptlist).
+        """
         preoptlist = None
         if info.video and 'video' in options:
             options = options.copy()
@@ -197,26 +632,762 @@ class Converter(object):
             preoptlist = options['video'].get('ffmpeg_custom_launch_opts', '').split(' ')
             # Remove empty arguments (make crashes)
             preoptlist = [arg for arg in preoptlist if arg]
+        return options, preoptlist
+
+    @staticmethod
+    def _split_video_filters(optlist):
+        """
+        Take the video filters (-vf) and output size (-s) out of an option
+        list, so they can be applied in a filter graph. Stream mappings are
+        dropped as well. Returns (optlist, filter chain or None).
+        """
+        rest = []
+        filters = []
+        size = None
+        i = 0
+        while i < len(optlist):
+            opt = optlist[i]
+            if opt in ('-vf', '-s', '-map') and i + 1 < len(optlist):
+                if opt == '-vf':
+                    filters.append(optlist[i + 1])
+                elif opt == '-s':
+                    size = optlist[i + 1]
+                i += 2
+                continue
+            rest.append(opt)
+            i += 1
+        if size:
+            # ffmpeg applies -s after the -vf filters
+            filters.append('scale=%s' % size.replace('x', ':'))
+        return rest, ','.join(filters) or None
+
+    def convert_multi(self, infile, outputs, timeout=10, deadline=None,
+                      progress_events=False, smart_copy=False):
+        """
+        Convert media file (infile) into several outputs at once. Outputs
+        is a list of (outfile, options) tuples, with options in the same
+        format as for convert() (a dict or a ConversionProfile).
+
+        All outputs are produced by a single ffmpeg process, so the source
+        is probed, read and decoded only once: the decoded video is split
+        and scaled separately for each output, while audio is mapped into
+        every output that asks for it. This saves most of the decoding
+        work when producing several renditions of the same source (e.g.
+        an adaptive streaming ladder).
+
+        Two-pass and chunked encoding are not supported, and subtitles
+        aren't copied. Video options from ffmpeg_custom_launch_opts are
+        taken from the first output that has them.
+
+        Returns a generator yielding the fraction of the source processed
+        so far; timeout, deadline, progress_events and smart_copy are as
+        for convert().
+
+        >>> conv = Converter().convert_multi('test1.ogg', [
+        ...    ('/tmp/720p.mp4', {'format': 'mp4', 'audio': {'codec': 'aac'},
+        ...                       'video': {'codec': 'h264', 'height': 720}}),
+        ...    ('/tmp/360p.mp4', {'format': 'mp4', 'audio': {'codec': 'aac'},
+        ...                       'video': {'codec': 'h264', 'height': 360}})])
+
+        >>> for progress in conv:
+        ...   pass # can be used to inform the user about the progress
+        """
+        if not outputs:
+            raise ConverterError('No outputs specified')
+
+        for _, options in outputs:
+            if not isinstance(options, (dict, ConversionProfile)):
+                raise ConverterError('Invalid options')
+
+        if not os.path.exists(infile):
+            raise ConverterError("Source file doesn't exist: " + infile)
+
+        info = self.ffmpeg.probe(infile)
+        if info is None:
+            raise ConverterError("Can't get information about source file")
+
+        if not info.video and not info.audio:
+            raise ConverterError('Source file has no audio or video streams')
+
         if not info.format or not info.format.duration or not isinstance(info.format.duration, (float, int)) or info.format.duration < 0.01:
             raise ConverterError('Zero-length media')
 
-        if twopass:
-            optlist1 = self.parse_options(options, 1)
-            for timecode in self.ffmpeg.convert(infile, outfile, optlist1,
-                                                timeout=timeout, preopts=preoptlist):
-                yield float(timecode) / info.format.duration
-
-            optlist2 = self.parse_options(options, 2)
-            for timecode in self.ffmpeg.convert(infile, outfile, optlist2,
-                                                timeout=timeout, preopts=preoptlist):
-                yield 0.5 + float(timecode) / info.format.duration
+        preoptlist = None
+        branches = []
+        for outfile, options in outputs:
+            profile = None
+            if isinstance(options, ConversionProfile):
+                profile = options
+                options = profile._options  # not modified below
+            options, preopts = self._source_options(options, info)
+            if smart_copy:
+                copied = self._smart_copy(options, info)
+                if copied != options:
+                    options = copied
+                    profile = None
+            preoptlist = preoptlist or preopts
+            if profile is not None:
+                optlist = profile.bind(info)
+            else:
+                optlist = self.parse_options(options)
+            video = options.get('video', {}).get('codec')
+            audio = options.get('audio', {}).get('codec')
+            branches.append((outfile, optlist, video, audio))
+
+        graph = []
+        output_list = []
+        split = []
+        for outfile, optlist, video, audio in branches:
+            maps = []
+            if info.video and video == 'copy':
+                maps.extend(['-map', '0:%d' % info.video.index])
+            elif info.video and video:
+                optlist, filters = self._split_video_filters(optlist)
+                n = len(split)
+                split.append('[s%d]' % n)
+                graph.append('[s%d]%s[v%d]' % (n, filters or 'null', n))
+                maps.extend(['-map', '[v%d]' % n])
+            if info.audio and audio:
+                maps.extend(['-map', '0:%d' % info.audio.index])
+            output_list.append((outfile, maps + optlist))
+
+        opts = []
+        if split:
+            graph.insert(0, '[0:%d]split=%d%s' % (info.video.index, len(split),
+                                                  ''.join(split)))
+            opts.extend(['-filter_complex', ';'.join(graph)])
+
+        started = time.monotonic()
+        updates = self.ffmpeg.convert_multi(infile, output_list, opts,
+                                            timeout=timeout, deadline=deadline,
+                                            preopts=preoptlist,
+                                            detailed=progress_events)
+        for progress in self._progress(updates, info.format.duration,
+                                       progress_events, started):
+            yield progress
+
+    def package_hls(self, infile, outdir, ladder, segment_format='mpegts',
+                    segment_duration=6, master_playlist='master.m3u8',
+                    timeout=10, deadline=None, progress_events=False):
+        """
+        Package media file (infile) for HTTP Live Streaming at several
+        bitrates (an adaptive bitrate ladder), with a single ffmpeg
+        process that decodes the source once (see convert_multi()).
+
+        Ladder is a list of renditions, each a dict with 'video' and/or
+        'audio' options as for convert() (plus optionally 'threads'), and
+        an optional 'name' of the subdirectory of outdir it's saved to
+        (stream0, stream1, ... by default). Every rendition gets its own
+        playlist, name/index.m3u8, of segments of segment_duration seconds
+        in segment_format: 'mpegts' (.ts segments) or 'fmp4' (fragmented
+        MP4 .m4s segments, for CMAF; needs ffmpeg 3.4 or newer). Keyframes are forced at the segment
+        boundaries, so the segments of all renditions are aligned and
+        players can switch between them at any segment.
+
+        Finally, the master playlist (outdir/master_playlist) is written,
+        listing every rendition with its peak and average BANDWIDTH,
+        measured from the segments produced, and the RESOLUTION, FRAME-RATE
+        and CODECS reported by ffprobe.
+
+        Returns a generator yielding the fraction of the source processed
+        so far; timeout, deadline and progress_events are as for convert().
+
+        >>> conv = Converter().package_hls('test1.mp4', '/tmp/hls', [
+        ...    {'name': '720p', 'audio': {'codec': 'aac', 'bitrate': 128},
+        ...     'video': {'codec': 'h264', 'height': 720, 'bitrate': 3000}},
+        ...    {'name': '360p', 'audio': {'codec': 'aac', 'bitrate': 96},
+        ...     'video': {'codec': 'h264', 'height': 360, 'bitrate': 800}}])
+        >>> for progress in conv:
+        ...   pass
+        """
+        if segment_format not in ('mpegts', 'fmp4'):
+            raise ConverterError('Unsupported segment format: %s' % segment_format)
+        if segment_format == 'fmp4':
+            self._check_version((3, 4), 'fmp4 HLS segments')
+        if not ladder:
+            raise ConverterError('No renditions specified')
+
+        outdir = os.path.abspath(outdir)
+        ext = '.ts' if segment_format == 'mpegts' else '.m4s'
+        keyframes = 'expr:gte(t,n_forced*%g)' % segment_duration
+        outputs = []
+        variants = []
+        for i, rung in enumerate(ladder):
+            if not isinstance(rung, dict):
+                raise ConverterError('Invalid options')
+            name = rung.get('name') or 'stream%d' % i
+            directory = os.path.join(outdir, name)
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise e
+
+            options = {
+                'format': 'hls',
+                'segment_duration': segment_duration,
+                'segment_type': segment_format,
+                'segment_filename': os.path.join(directory, 'segment%05d' + ext),
+                'playlist_type': 'vod',
+            }
+            for key in ('audio', 'video', 'threads'):
+                if key in rung:
+                    options[key] = rung[key]
+            video = options.get('video')
+            if isinstance(video, dict) and video.get('codec') not in (None, 'copy'):
+                options['video'] = dict(video, force_keyframes=keyframes)
+
+            playlist = os.path.join(directory, 'index.m3u8')
+            outputs.append((playlist, options))
+            variants.append((name + '/index.m3u8', playlist))
+
+        for progress in self.convert_multi(infile, outputs, timeout, deadline,
+                                           progress_events):
+            yield progress
+
+        lines = ['#EXTM3U', '#EXT-X-VERSION:%d' % (7 if ext == '.m4s' else 3),
+                 '#EXT-X-INDEPENDENT-SEGMENTS']
+        for uri, playlist in variants:
+            peak, average = self._hls_bandwidth(playlist)
+            attrs = ['BANDWIDTH=%d' % peak, 'AVERAGE-BANDWIDTH=%d' % average]
+            codecs = []
+            info = self.ffmpeg.probe(playlist)
+            if info is not None and info.video:
+                attrs.append('RESOLUTION=%dx%d' % (info.video.video_width,
+                                                   info.video.video_height))
+                if info.video.video_fps:
+                    attrs.append('FRAME-RATE=%.3f' % info.video.video_fps)
+                codecs.append(self._codec_string(info.video))
+            if info is not None and info.audio:
+                codecs.append(self._codec_string(info.audio))
+            if codecs and None not in codecs:
+                attrs.append('CODECS="%s"' % ','.join(codecs))
+            lines.append('#EXT-X-STREAM-INF:' + ','.join(attrs))
+            lines.append(uri)
+        with open(os.path.join(outdir, master_playlist), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    @staticmethod
+    def _hls_bandwidth(playlist):
+        """
+        Return the peak and average bitrate (in bits/s) of the segments
+        of an HLS media playlist, from their sizes and durations.
+        """
+        base = os.path.dirname(playlist)
+        peak = total_size = total_duration = 0
+        duration = None
+        with open(playlist) as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith('#EXTINF:'):
+                    duration = float(line[8:].split(',')[0])
+                elif line and not line.startswith('#') and duration:
+                    size = os.path.getsize(os.path.join(base, line))
+                    peak = max(peak, size * 8 / duration)
+                    total_size += size
+                    total_duration += duration
+                    duration = None
+        average = total_size * 8 / total_duration if total_duration else 0
+        return int(math.ceil(peak)), int(math.ceil(average))
+
+    # ffprobe H.264 profile -> profile_idc and constraint flags (hex)
+    AVC_PROFILES = {
+        'Constrained Baseline': '42E0',
+        'Baseline': '4200',
+        'Main': '4D40',
+        'Extended': '5800',
+        'High': '6400',
+        'High 10': '6E00',
+        'High 4:2:2': '7A00',
+        'High 4:4:4 Predictive': 'F400',
+    }
+
+    # ffprobe AAC profile -> MPEG-4 audio object type
+    AAC_OBJECT_TYPES = {'Main': 1, 'LC': 2, 'SSR': 3, 'LTP': 4,
+                        'HE-AAC': 5, 'HE-AACv2': 29}
+
+    @classmethod
+    def _codec_string(cls, stream):
+        """
+        RFC 6381 codec string (as used in CODECS attributes of HLS
+        playlists) of the stream, or None if it isn't known.
+        """
+        level = stream.level if stream.level and stream.level > 0 else None
+        if stream.codec == 'h264':
+            profile = cls.AVC_PROFILES.get(stream.profile)
+            if profile and level:
+                return 'avc1.%s%02X' % (profile, level)
+        elif stream.codec == 'hevc':
+            if level:
+                if stream.profile == 'Main 10':
+                    return 'hvc1.2.4.L%d.B0' % level
+                return 'hvc1.1.6.L%d.B0' % level
+        elif stream.codec == 'aac':
+            return 'mp4a.40.%d' % cls.AAC_OBJECT_TYPES.get(stream.profile, 2)
+        elif stream.codec == 'mp3':
+            return 'mp4a.40.34'
+        elif stream.codec == 'ac3':
+            return 'ac-3'
+        elif stream.codec == 'eac3':
+            return 'ec-3'
+        return None
+
+    def package_dash(self, infile, outdir, ladder, segment_duration=6,
+                     manifest='manifest.mpd', hls_playlist=False, timeout=10,
+                     deadline=None, progress_events=False):
+        """
+        Package media file (infile) for MPEG-DASH at several bitrates,
+        with a single ffmpeg process that decodes the source once.
+
+        Ladder is a list of renditions as for package_hls(). Every video
+        rendition becomes a representation of one video adaptation set,
+        and every distinct audio rendition one of an audio adaptation set;
+        the 'threads' of a rendition apply to the encoders of its streams.
+        The MPD manifest (outdir/manifest) addresses the fragmented MP4
+        init and media segments, written to outdir, with SegmentTemplate.
+        Keyframes are forced at the segment boundaries, so that the
+        representations are aligned.
+
+        If hls_playlist is True, HLS playlists (master.m3u8 and one media
+        playlist per representation) referencing the same segments are
+        written alongside the manifest, so a single encode serves both
+        DASH and HLS clients.
+
+        Needs ffmpeg 4.0 or newer; ConverterError is raised for older
+        binaries.
+
+        Returns a generator yielding the fraction of the source processed
+        so far; timeout, deadline and progress_events are as for convert().
+
+        >>> conv = Converter().package_dash('test1.mp4', '/tmp/dash', [
+        ...    {'audio': {'codec': 'aac', 'bitrate': 128},
+        ...     'video': {'codec': 'h264', 'height': 720, 'bitrate': 3000}},
+        ...    {'audio': {'codec': 'aac', 'bitrate': 128},
+        ...     'video': {'codec': 'h264', 'height': 360, 'bitrate': 800}}],
+        ...    hls_playlist=True)
+        >>> for progress in conv:
+        ...   pass
+        """
+        if not ladder:
+            raise ConverterError('No renditions specified')
+        self._check_version(self.formats['dash'].ffmpeg_min_version,
+                            'DASH packaging')
+
+        if not os.path.exists(infile):
+            raise ConverterError("Source file doesn't exist: " + infile)
+
+        info = self.ffmpeg.probe(infile)
+        if info is None:
+            raise ConverterError("Can't get information about source file")
+
+        if not info.format or not info.format.duration or info.format.duration < 0.01:
+            raise ConverterError('Zero-length media')
+
+        keyframes = 'expr:gte(t,n_forced*%g)' % segment_duration
+        videos = []
+        audios = []
+        threads = {'v': [], 'a': []}
+        for rung in ladder:
+            if not isinstance(rung, dict):
+                raise ConverterError('Invalid options')
+            t = rung.get('threads')
+            if t is not None and (not isinstance(t, int) or t < 0):
+                raise ConverterError('threads needs to be a non-negative int')
+            video = rung.get('video')
+            if info.video and video and video.get('codec'):
+                if video['codec'] != 'copy':
+                    video = dict(video, force_keyframes=keyframes)
+                videos.append(video)
+                threads['v'].append(t)
+            audio = rung.get('audio')
+            if info.audio and audio and audio.get('codec') and audio not in audios:
+                audios.append(audio)
+                threads['a'].append(t)
+        if not videos and not audios:
+            raise ConverterError('Neither audio nor video streams requested')
+
+        graph = []
+        split = []
+        optlist = []
+        preoptlist = None
+        for i, video in enumerate(videos):
+            if not isinstance(video, dict) or video['codec'] not in self.video_codecs:
+                raise ConverterError('Requested unknown video codec ' + str(video.get('codec')))
+            self._check_supported(self.video_codecs[video['codec']].ffmpeg_codec_name, 'encoder')
+            options, preopts = self._source_options({'video': video}, info)
+            preoptlist = preoptlist or preopts
+            video_optlist = self.video_codecs[video['codec']]().parse_options(options['video'])
+            if video['codec'] == 'copy':
+                optlist.extend(['-map', '0:%d' % info.video.index])
+            else:
+                video_optlist, filters = self._split_video_filters(video_optlist)
+                split.append('[s%d]' % i)
+                graph.append('[s%d]%s[v%d]' % (i, filters or 'null', i))
+                optlist.extend(['-map', '[v%d]' % i])
+            if threads['v'][i] is not None:
+                video_optlist.extend(['-threads', str(threads['v'][i])])
+            optlist.extend(self._stream_options(video_optlist, 'v', i))
+        for i, audio in enumerate(audios):
+            if not isinstance(audio, dict) or audio['codec'] not in self.audio_codecs:
+                raise ConverterError('Requested unknown audio codec ' + str(audio.get('codec')))
+            self._check_supported(self.audio_codecs[audio['codec']].ffmpeg_codec_name, 'encoder')
+            audio_optlist = self.audio_codecs[audio['codec']]().parse_options(audio)
+            if threads['a'][i] is not None:
+                audio_optlist.extend(['-threads', str(threads['a'][i])])
+            optlist.extend(['-map', '0:%d' % info.audio.index])
+            optlist.extend(self._stream_options(audio_optlist, 'a', i))
+
+        sets = []
+        if videos:
+            sets.append('id=%d,streams=v' % len(sets))
+        if audios:
+            sets.append('id=%d,streams=a' % len(sets))
+        self._check_supported(self.formats['dash'].ffmpeg_format_name, 'muxer')
+        optlist.extend(self.formats['dash']().parse_options({
+            'format': 'dash',
+            'segment_duration': segment_duration,
+            'adaptation_sets': ' '.join(sets),
+            'hls_playlist': hls_playlist,
+        }))
+
+        opts = []
+        if split:
+            graph.insert(0, '[0:%d]split=%d%s' % (info.video.index, len(split),
+                                                  ''.join(split)))
+            opts.extend(['-filter_complex', ';'.join(graph)])
+
+        outdir = os.path.abspath(outdir)
+        try:
+            os.makedirs(outdir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise e
+
+        started = time.monotonic()
+        updates = self.ffmpeg.convert_multi(
+            infile, [(os.path.join(outdir, manifest), optlist)], opts,
+            timeout=timeout, deadline=deadline, preopts=preoptlist,
+            detailed=progress_events)
+        for progress in self._progress(updates, info.format.duration,
+                                       progress_events, started):
+            yield progress
+
+    @staticmethod
+    def _stream_options(optlist, kind, index):
+        """
+        Qualify the options of an audio or video codec option list with a
+        stream specifier (e.g. -vb 800k -> -b:v:1 800k), so the options of
+        several streams can be given to one output.
+
+        Every option must take a value; options that don't (e.g. -an)
+        apply to the whole output and raise ConverterError.
+        """
+        renamed = {'-vcodec': '-c', '-acodec': '-c', '-vb': '-b', '-ab': '-b'}
+        qualified = []
+        options = iter(optlist)
+        for name in options:
+            if name in ('-an', '-vn', '-sn'):
+                raise ConverterError("Option %s can't be given per stream" % name)
+            value = next(options, None)
+            if not name.startswith('-') or value is None:
+                raise ConverterError('Invalid %s stream option: %s' % (
+                    'video' if kind == 'v' else 'audio', name))
+            name = renamed.get(name, name)
+            if name.endswith(':v') or name.endswith(':a'):
+                name = name[:-2]
+            qualified.extend(['%s:%s:%d' % (name, kind, index), value])
+        return qualified
+
+    def _chunk_boundaries(self, infile, duration, chunks):
+        """
+        Split points (in seconds) dividing the media into about equally
+        long chunks, each starting at a keyframe.
+        """
+        index = self.ffmpeg.packet_index(infile)
+        points = [0.0]
+        for i in range(1, chunks):
+            t = index.keyframe_after(duration * i / chunks)
+            if t is not None and points[-1] < t < duration:
+                points.append(t)
+        points.append(duration)
+        return points
+
+    def _run_parallel(self, tasks, timeout=10, deadline=None):
+        """
+        Run several ffmpeg conversions concurrently. Tasks are lists of
+        FFMpeg.convert() arguments (infile, outfile, opts, preopts).
+        Returns a generator yielding (task index, timecode) tuples as the
+        conversions progress. If any of them fails, the others are
+        stopped and the error is raised.
+        """
+        events = queue.Queue()
+        stop = threading.Event()
+
+        def run(index, task):
+            try:
+                infile, outfile, opts, preopts = task
+                conv = self.ffmpeg.convert(infile, outfile, opts,
+                                           timeout=timeout, deadline=deadline,
+                                           preopts=preopts)
+                try:
+                    for timecode in conv:
+                        if stop.is_set():
+                            break
+                        events.put((index, timecode, None))
+                finally:
+                    conv.close()
+            except Exception as e:
+                events.put((index, None, e))
+            else:
+                events.put((index, None, None))
+
+        threads = [threading.Thread(target=run, args=(i, task))
+                   for i, task in enumerate(tasks)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        try:
+            running = len(threads)
+            while running:
+                index, timecode, error = events.get()
+                if error is not None:
+                    raise error
+                if timecode is None:
+                    running -= 1
+                else:
+                    yield index, timecode
+        finally:
+            stop.set()
+            for t in threads:
+                t.join()
+
+    def _convert_chunked(self, infile, outfile, options, info, chunks,
+                         timeout, deadline, preoptlist, events=False,
+                         started=None):
+        duration = info.format.duration
+        points = self._chunk_boundaries(infile, duration, chunks)
+        if len(points) < 3:
+            # too short or too few keyframes to split
+            optlist = self.parse_options(options)
+            updates = self.ffmpeg.convert(infile, outfile, optlist,
+                                          timeout=timeout, deadline=deadline,
+                                          preopts=preoptlist, detailed=events)
+            for progress in self._progress(updates, duration, events, started):
+                yield progress
+            return
+
+        self.parse_options(options)  # validate before spawning anything
+        format_options = self.formats[options['format']]().parse_options(options)
+
+        # Unless told otherwise, split the cores between the chunk encoders
+        threads = options.get('threads')
+        if threads is None:
+            threads = max(1, (os.cpu_count() or 1) // (len(points) - 1))
+        video_optlist = self.parse_options(
+            {'format': 'mkv', 'video': options['video'], 'threads': threads})
+        audio_options = None
+        if info.audio and options.get('audio', {}).get('codec'):
+            audio_options = {'format': 'mkv', 'audio': options['audio']}
+
+        scratch = tempfile.mkdtemp(prefix='converter-chunks-')
+        try:
+            tasks = []
+            chunk_files = []
+            for i, (start, end) in enumerate(zip(points, points[1:])):
+                chunk = os.path.join(scratch, 'chunk%04d.mkv' % i)
+                chunk_files.append(chunk)
+                opts = list(video_optlist)
+                if i < len(points) - 2:
+                    opts.extend(['-t', '%.6f' % (end - start)])
+                tasks.append((infile, chunk, opts,
+                              (preoptlist or []) + ['-ss', '%.6f' % start]))
+
+            audio_file = None
+            if audio_options:
+                audio_file = os.path.join(scratch, 'audio.mkv')
+                tasks.append((infile, audio_file,
+                              self.parse_options(audio_options), None))
+
+            done = [0.0] * len(tasks)
+            last = 0.0
+            for index, timecode in self._run_parallel(tasks, timeout, deadline):
+                if index >= len(chunk_files):
+                    continue
+                done[index] = timecode
+                progress = min(1.0, sum(done) / duration)
+                if progress > last:
+                    last = progress
+                    yield self._chunked_progress(progress, sum(done), events,
+                                                 started, duration)
+
+            concat_list = os.path.join(scratch, 'chunks.txt')
+            with open(concat_list, 'w') as f:
+                for chunk in chunk_files:
+                    f.write("file '%s'\n" % chunk.replace("'", "'\\''"))
+
+            preopts = ['-f', 'concat', '-safe', '0']
+            opts = ['-map', '0:v', '-c', 'copy']
+            if audio_file:
+                # the audio is the first input, so that -f concat applies
+                # to the chunk list
+                preopts = ['-i', audio_file] + preopts
+                opts = ['-map', '1:v', '-map', '0:a', '-c', 'copy']
+            for _ in self.ffmpeg.convert(concat_list, outfile,
+                                         opts + format_options,
+                                         timeout=timeout, deadline=deadline,
+                                         preopts=preopts):
+                pass
+            if last < 1.0:
+                yield self._chunked_progress(1.0, duration, events, started,
+                                             duration)
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    @staticmethod
+    def _chunked_progress(fraction, out_time, events, started, duration):
+        if not events:
+            return fraction
+        elapsed = time.monotonic() - started
+        # speed is the combined realtime factor of all chunk encoders
+        return ProgressEvent(fraction, out_time,
+                             speed=out_time / elapsed if elapsed > 0 else None,
+                             elapsed=elapsed,
+                             eta=elapsed / fraction * (1.0 - fraction),
+                             duration=duration)
+
+    def sprite_sheet(self, fname, interval, outfile, vtt_file, tile=(10, 10),
+                     size=None, quality=FFMpeg.DEFAULT_JPEG_QUALITY,
+                     processes=None, timeout=10, deadline=None,
+                     progress_events=False):
+        """
+        Create thumbnail sprite sheets of the video, for seek previews,
+        along with a WebVTT file mapping each time range to its thumbnail.
+
+        A thumbnail is taken every interval seconds, scaled to size and
+        tiled into JPEG sheets of cols x rows thumbnails (the tile
+        argument). The sheets are saved as outfile, which must be a
+        printf-style pattern like '/tmp/sprite%03d.jpg' (numbered from 1).
+        The cues of vtt_file point to the sheets relative to the directory
+        of vtt_file, e.g. 'sprite001.jpg#xywh=160,0,160,90'.
+
+        The source is decoded once, by up to processes concurrent ffmpeg
+        processes (defaults to the number of CPUs), each covering the time
+        range of a run of whole sheets.
+
+        :param size: 'WxH' size of a thumbnail, defaults to 160 pixels wide
+            keeping the aspect ratio of the video
+        :param quality: jpeg quality in range 2(best)-31(worst)
+
+        Like convert(), it returns a generator yielding the fraction of
+        the work done (or ProgressEvent objects if progress_events is
+        True), that needs to be iterated to drive the processes.
+
+        >>> for progress in Converter().sprite_sheet(
+        ...         'test1.ogg', 5, '/tmp/sprite%03d.jpg', '/tmp/sprite.vtt'):
+        ...     pass
+        """
+        if not os.path.exists(fname):
+            raise ConverterError("Source file doesn't exist: " + fname)
+        if interval <= 0:
+            raise ConverterError('Invalid thumbnail interval')
+        try:
+            outfile % 1
+        except TypeError:
+            raise ConverterError('Sprite sheet file name must be a pattern '
+                                 'like sprite%03d.jpg')
+        caps = self.ffmpeg.capabilities
+        if caps is not None and not caps.has_filter('tile'):
+            raise ConverterError('ffmpeg %s does not support the tile filter'
+                                 % (caps.version or self.ffmpeg.ffmpeg_path))
+
+        info = self.ffmpeg.probe(fname)
+        if info is None or not info.video:
+            raise ConverterError('Source file has no video stream')
+        duration = info.format.duration
+        if not duration or duration < 0.01:
+            raise ConverterError('Zero-length media')
+
+        if size:
+            width, height = [int(x) for x in str(size).split('x')]
         else:
-            optlist = self.parse_options(options, twopass)
-            for timecode in self.ffmpeg.convert(infile, outfile, optlist,
-                                                timeout=timeout, preopts=preoptlist):
-                yield float(timecode) / info.format.duration
+            width = 160
+            w, h = info.video.video_width, info.video.video_height
+            height = int(round(width * h / (2.0 * w))) * 2 if w and h else 90
+        cols, rows = tile
+        per_sheet = cols * rows
+        count = int(math.ceil(duration / interval))
+        sheets = int(math.ceil(float(count) / per_sheet))
+        if processes is None:
+            processes = os.cpu_count() or 1
+        processes = max(1, min(processes, sheets))
+
+        vf = 'fps=1/%s,scale=%d:%d,tile=%dx%d' % (interval, width, height,
+                                                  cols, rows)
+        tasks = []
+        span = per_sheet * interval
+        for i in range(processes):
+            first, last = sheets * i // processes, sheets * (i + 1) // processes
+            opts = ['-an', '-sn', '-vf', vf, '-q:v', str(quality),
+                    '-f', 'image2', '-start_number', str(first + 1)]
+            if last < sheets:
+                opts[:0] = ['-t', '%.6f' % ((last - first) * span)]
+            tasks.append((fname, outfile, opts, ['-ss', '%.6f' % (first * span)]))
+
+        started = time.monotonic()
+        done = [0.0] * len(tasks)
+        last = 0.0
+        for index, timecode in self._run_parallel(tasks, timeout, deadline):
+            done[index] = timecode
+            progress = min(1.0, sum(done) / duration)
+            if progress > last:
+                last = progress
+                yield self._chunked_progress(progress, sum(done),
+                                             progress_events, started,
+                                             duration)
+
+        base = os.path.dirname(os.path.abspath(vtt_file))
+        with open(vtt_file, 'w') as f:
+            f.write('WEBVTT\n')
+            for n in range(count):
+                sheet, pos = divmod(n, per_sheet)
+                row, col = divmod(pos, cols)
+                url = os.path.relpath(os.path.abspath(outfile % (sheet + 1)), base)
+                f.write('\n%s --> %s\n%s#xywh=%d,%d,%d,%d\n' % (
+                    self._vtt_timestamp(n * interval),
+                    self._vtt_timestamp(min((n + 1) * interval, duration)),
+                    url.replace(os.sep, '/'), col * width, row * height,
+                    width, height))
+        if last < 1.0:
+            yield self._chunked_progress(1.0, duration, progress_events,
+                                         started, duration)
+
+    @staticmethod
+    def _vtt_timestamp(seconds):
+        ms = int(round(seconds * 1000))
+        return '%02d:%02d:%02d.%03d' % (ms // 3600000, ms // 60000 % 60,
+                                        ms // 1000 % 60, ms % 1000)
 
-    def segment(self, infile, working_directory, output_file, output_directory, options, timeout=10):
+    def segment(self, infile, working_directory, output_file, output_directory, options, timeout=10,
+                deadline=None, progress_events=False):
+        """
+        Split the media file (infile) into 1-second MPEG-TS segments for
+        HTTP Live Streaming, copying the streams. The segments are saved
+        as output_directory/mediaNNNNN.ts and listed in the m3u8 playlist
+        output_file, both relative to working_directory.
+
+        Only absolute paths are passed to ffmpeg, and the current directory
+        is left alone, so any number of segment jobs can run concurrently
+        in one process.
+
+        Like convert(), it returns a generator yielding the fraction of
+        the job done (or ProgressEvent objects if progress_events is True),
+        and the timeout and deadline arguments work the same way.
+
+        >>> for progress in Converter().segment('test1.mp4', '/tmp/hls',
+        ...         'index.m3u8', 'segments', {}):
+        ...    pass
+        """
         if not os.path.exists(infile):
             raise ConverterError("Source file doesn't exist: " + infile)
 
@@ -227,13 +1398,13 @@ class Converter(object):
         if not info.video and not info.audio:
             raise ConverterError('Source file has no audio or video streams')
 
+        working_directory = os.path.abspath(working_directory)
+        segment_directory = os.path.join(working_directory, output_directory)
         try:
-            os.makedirs(os.path.join(working_directory, output_directory))
-        except Exception as e:
+            os.makedirs(segment_directory)
+        except OSError as e:
             if e.errno != errno.EEXIST:
                 raise e
-        current_directory = os.getcwd()
-        os.chdir(working_directory)
         if options.get("audio"):
             segment_time = max(1, math.ceil(options['audio'].get("start_time", 1)))
         else:
@@ -241,7 +1412,8 @@ class Converter(object):
         if segment_time > 1:
             logger.warning("Warning : HLS fragments size will be upper than 1 seconds probably that audio channel start at %s seconds." % (segment_time))
         optlist = [
-            "-flags", "-global_header", "-f", "segment", "-segment_time", "%s" % segment_time, "-segment_list", output_file, "-segment_list_type", "m3u8", "-segment_format", "mpegts",
+            "-flags", "-global_header", "-f", "segment", "-segment_time", "%s" % segment_time,
+            "-segment_list", os.path.join(working_directory, output_file), "-segment_list_type", "m3u8", "-segment_format", "mpegts",
             "-segment_list_entry_prefix", "%s/" % output_directory, "-map", "0", "-map", "-0:d", "-vcodec", "copy", "-acodec", "copy"
         ]
         try:
@@ -250,18 +1422,21 @@ class Converter(object):
             else:
                 codec = info.streams[1].codec
         except Exception as e:
-            print("could not determinate encoder: %s", e)
+            logger.warning("could not determinate encoder: %s" % e)
             codec = ""
         if "h264" in codec:
             optlist.insert(-4, "-vbsf")
             optlist.insert(-4, "h264_mp4toannexb")
 
-        outfile = "%s/media%%05d.ts" % output_directory
-        for timecode in self.ffmpeg.convert(infile, outfile, optlist, timeout=timeout):
-            yield int((100.0 * timecode) / info.format.duration)
-        os.chdir(current_directory)
+        outfile = os.path.join(segment_directory, "media%05d.ts")
+        started = time.monotonic()
+        updates = self.ffmpeg.convert(infile, outfile, optlist, timeout=timeout,
+                                      deadline=deadline, detailed=progress_events)
+        for progress in self._progress(updates, info.format.duration,
+                                       progress_events, started):
+            yield progress
 
-    def probe(self, fname, posters_as_video=True):
+    def probe(self, fname, posters_as_video=True, use_json=False):
         """
         Examine the media file.
 
@@ -269,8 +1444,91 @@ class Converter(object):
 
         :param posters_as_video: Take poster images (mainly for audio files) as
             A video stream, defaults to True
+        :param use_json: Parse ffprobe JSON output instead of the default
+            key=value output, defaults to False
+        """
+        return self.ffmpeg.probe(fname, posters_as_video, use_json)
+
+    def probe_many(self, paths, max_workers=None, posters_as_video=True,
+                   use_json=False):
         """
-        return self.ffmpeg.probe(fname, posters_as_video)
+        Examine many media files concurrently.
+
+        See the documentation of converter.FFMpeg.probe_many() for details.
+        """
+        return self.ffmpeg.probe_many(paths, max_workers, posters_as_video,
+                                      use_json)
+
+    def waveform(self, fname, points=1000, samplerate=None, timeout=10,
+                 deadline=None):
+        """
+        Compute the waveform of the audio of the media file, for drawing.
+        The audio is mixed down to mono and divided into points buckets of
+        equal duration, and for each bucket the minimum and maximum sample
+        and the RMS level are computed, in range -1..1.
+
+        Returns a tuple of three numpy arrays (minimums, maximums, rms)
+        with points entries (or fewer, if the audio turns out to be
+        shorter than its reported duration). The audio is streamed from
+        ffmpeg (see converter.FFMpeg.iter_audio()) and reduced block by
+        block, so memory use doesn't depend on the length of the file.
+        This requires numpy.
+
+        :param samplerate: sample rate to resample the audio to before
+            computing the waveform, defaults to the rate of the source.
+            Lower rates decode faster but may miss short peaks.
+
+        >>> mins, maxs, rms = Converter().waveform('test1.ogg', points=800)
+        """
+        if numpy is None:
+            raise ConverterError('Computing waveforms requires numpy')
+        if not os.path.exists(fname):
+            raise ConverterError("Source file doesn't exist: " + fname)
+
+        info = self.ffmpeg.probe(fname)
+        if info is None or not info.audio:
+            raise ConverterError('Source file has no audio stream')
+        duration = info.format.duration
+        if not duration or duration < 0.01:
+            raise ConverterError('Zero-length media')
+
+        samplerate = samplerate or int(info.audio.audio_samplerate)
+        total = int(math.ceil(duration * samplerate))
+        bucket = max(1, int(math.ceil(total / float(points))))
+        # whole buckets per block, so only the last one is partial
+        block_size = bucket * max(1, 65536 // bucket)
+
+        mins, maxs, sumsq, counts = [], [], [], []
+        for block in self.ffmpeg.iter_audio(fname, samplerate, 1, 'float32',
+                                            block_size=block_size,
+                                            timeout=timeout, deadline=deadline):
+            samples = block[:, 0]
+            whole = len(samples) - len(samples) % bucket
+            parts = []
+            if whole:
+                parts.append(samples[:whole].reshape(-1, bucket))
+            if whole < len(samples):
+                parts.append(samples[whole:].reshape(1, -1))
+            for part in parts:
+                mins.append(part.min(axis=1))
+                maxs.append(part.max(axis=1))
+                sumsq.append(numpy.square(part, dtype=numpy.float64).sum(axis=1))
+                counts.append(numpy.full(len(part), part.shape[1]))
+
+        if not mins:
+            empty = numpy.zeros(0, numpy.float32)
+            return empty, empty.copy(), empty.copy()
+        mins, maxs, sumsq, counts = [numpy.concatenate(a) for a in
+                                     (mins, maxs, sumsq, counts)]
+        if len(mins) > points:
+            # the audio is longer than reported: fold the excess into the
+            # last bucket
+            mins = numpy.append(mins[:points - 1], mins[points - 1:].min())
+            maxs = numpy.append(maxs[:points - 1], maxs[points - 1:].max())
+            sumsq = numpy.append(sumsq[:points - 1], sumsq[points - 1:].sum())
+            counts = numpy.append(counts[:points - 1], counts[points - 1:].sum())
+        rms = numpy.sqrt(sumsq / counts).astype(numpy.float32)
+        return mins, maxs, rms
 
     def thumbnail(self, fname, time, outfile, size=None, quality=FFMpeg.DEFAULT_JPEG_QUALITY):
         """
@@ -280,10 +1538,34 @@ class Converter(object):
         """
         return self.ffmpeg.thumbnail(fname, time, outfile, size, quality)
 
-    def thumbnails(self, fname, option_list):
+    def thumbnail_data(self, fname, time, size=None,
+                       quality=FFMpeg.DEFAULT_JPEG_QUALITY, buf=None):
+        """
+        Create a JPEG thumbnail of the media file in memory.
+
+        See the documentation of converter.FFMpeg.thumbnail_data() for details.
+        """
+        return self.ffmpeg.thumbnail_data(fname, time, size, quality, buf)
+
+    def thumbnails_data(self, fname, times, size=None,
+                        quality=FFMpeg.DEFAULT_JPEG_QUALITY, max_workers=None,
+                        bufs=None):
+        """
+        Create JPEG thumbnails of the media file in memory.
+
+        See the documentation of converter.FFMpeg.thumbnails_data() for details.
+        """
+        return self.ffmpeg.thumbnails_data(fname, times, size, quality,
+                                           max_workers, bufs)
+
+    def thumbnails(self, fname, option_list, input_seeking=False,
+                   max_workers=None, keyframes_only=False):
         """
         Create one or more thumbnail of the media file.
 
         See the documentation of converter.FFMpeg.thumbnails() for details.
         """
-        return self.ffmpeg.thumbnails(fname, option_list)
+        return self.ffmpeg.thumbnails(fname, option_list,
+                                      input_seeking=input_seeking,
+                                      max_workers=max_workers,
+                                      keyframes_only=keyframes_only)
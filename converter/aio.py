@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+
+"""
+asyncio flavour of the low-level ffmpeg wrapper.
+"""
+
+import asyncio
+import itertools
+import logging
+import os
+
+from converter.ffmpeg import FFMpeg, FFMpegError, FFMpegTimeoutError, \
+    OutputTail, ProgressReader, Watchdog
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncFFMpeg(FFMpeg):
+
+    """
+    FFMpeg wrapper for asyncio applications. It accepts the same
+    arguments as FFMpeg and mirrors its probe(), convert() and
+    thumbnails() methods as coroutines, driving the ffmpeg/ffprobe
+    processes with asyncio.create_subprocess_exec(), so no threads or
+    signal handlers are involved.
+
+    Cancelling a task that awaits one of the methods (or closing the
+    convert() generator early) kills the ffmpeg process.
+
+    >>> f = AsyncFFMpeg()
+    >>> info = await f.probe('test1.ogg')
+    """
+
+    @staticmethod
+    async def _spawn_async(cmds):
+        logger.debug('Spawning ffmpeg with command: ' + ' '.join(cmds))
+        return await asyncio.create_subprocess_exec(
+            *cmds, stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+            close_fds=True)
+
+    @staticmethod
+    async def _reap(p):
+        # Kill the process if it's still running and wait for it to exit
+        if p.returncode is None:
+            try:
+                p.kill()
+            except ProcessLookupError:
+                pass
+            await p.wait()
+
+    @staticmethod
+    async def _drain(stream, tail):
+        while True:
+            data = await stream.read(65536)
+            if not data:
+                break
+            tail.feed(data)
+
+    async def _communicate(self, cmds):
+        p = await self._spawn_async(cmds)
+        try:
+            return await p.communicate()
+        finally:
+            await self._reap(p)
+
+    async def probe(self, fname, posters_as_video=True, use_json=False):
+        """
+        Examine the media file and determine its format and media streams.
+
+        See the documentation of converter.FFMpeg.probe() for details.
+        """
+        # the cache is an SQLite database, so it's used from the default
+        # executor to keep the event loop responsive
+        loop = asyncio.get_running_loop()
+        key = None
+        if self.probe_cache is not None:
+            key, info = await loop.run_in_executor(
+                None, self._cached_probe, fname, posters_as_video)
+            if info is not None:
+                return info
+
+        stdout_data, _ = await self._communicate(
+            self._probe_cmds(fname, use_json))
+        info = self._parse_probe(stdout_data, posters_as_video, use_json)
+
+        if info is not None and key is not None:
+            await loop.run_in_executor(None, self._cache_probe, key, fname,
+                                       posters_as_video, info)
+        return info
+
+    def _cached_probe(self, fname, posters_as_video):
+        key = self.probe_cache.key(fname, posters_as_video)
+        if key is None:
+            return None, None
+        return key, self.probe_cache.get(key)
+
+    async def probe_many(self, paths, max_workers=None, posters_as_video=True,
+                         use_json=False):
+        """
+        Probe many files, keeping up to max_workers ffprobe processes
+        running at the same time. Returns an asynchronous generator
+        yielding (path, result) tuples in order of completion.
+
+        See the documentation of converter.FFMpeg.probe_many() for details.
+        """
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+
+        paths = iter(paths)
+        pending = {}
+
+        def submit(n):
+            for path in itertools.islice(paths, n):
+                task = asyncio.ensure_future(
+                    self.probe(path, posters_as_video, use_json))
+                pending[task] = path
+
+        try:
+            submit(max_workers)
+            while pending:
+                done, _ = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    path = pending.pop(task)
+                    try:
+                        result = task.result()
+                    except Exception as e:
+                        result = e
+                    yield path, result
+                submit(len(done))
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def convert(self, infile, outfile, opts, timeout=10, preopts=None,
+                      detailed=False, deadline=None,
+                      log_tail=FFMpeg.LOG_TAIL_SIZE,
+                      log_lines=None, log_file=None):
+        """
+        Convert the source media (infile) according to specified options
+        (a list of ffmpeg switches as strings) and save it to outfile.
+
+        Returns an asynchronous generator yielding the timecode of the
+        currently processed part of the file, or ConvertProgress objects
+        if detailed is True. The optional timeout (in seconds of wall time)
+        specifies how long to wait for ffmpeg to report back, and deadline
+        how long it may run in total, before it's killed and
+        FFMpegTimeoutError is raised. The log_tail, log_lines and log_file arguments control
+        how much of the ffmpeg log is kept, as in FFMpeg.convert().
+
+        >>> async for timecode in AsyncFFMpeg().convert(
+        ...         'test.ogg', '/tmp/output.mp3', ['-acodec', 'libmp3lame', '-vn']):
+        ...    pass  # can be used to inform the user about conversion progress
+
+        See the documentation of converter.FFMpeg.convert() for details.
+        """
+        if not os.path.exists(infile):
+            raise FFMpegError("Input file doesn't exist: " + infile)
+
+        cmds = self._convert_cmds(infile, outfile, opts, preopts)
+
+        # open the log first, so a failure can't leave ffmpeg running
+        sink = open(log_file, 'wb') if isinstance(log_file, str) else log_file
+        try:
+            p = await self._spawn_async(cmds)
+        except OSError:
+            if sink is not log_file:
+                sink.close()
+            raise FFMpegError('Error while calling ffmpeg binary')
+
+        yielded = False
+        tail = OutputTail(log_tail, log_lines, sink)
+        reader = ProgressReader()
+        stderr_reader = asyncio.ensure_future(self._drain(p.stderr, tail))
+
+        watchdog = Watchdog(timeout, deadline)
+
+        try:
+            while True:
+                wait = watchdog.remaining()
+                try:
+                    ret = await asyncio.wait_for(
+                        p.stdout.read(65536),
+                        None if wait is None else max(wait, 0))
+                except asyncio.TimeoutError:
+                    ret = None
+
+                if ret == b'':
+                    break
+
+                for progress in reader.feed(ret or b''):
+                    watchdog.progress()
+                    if detailed:
+                        yielded = True
+                        yield progress
+                    elif progress.timecode is not None:
+                        yielded = True
+                        yield progress.timecode
+                    # time spent in the async for body isn't an ffmpeg stall
+                    watchdog.progress()
+
+                expired = watchdog.expired()
+                if expired:
+                    raise FFMpegTimeoutError(
+                        'Timed out', ' '.join(cmds), tail.getvalue(),
+                        expired, pid=p.pid)
+
+            await stderr_reader
+            await p.wait()
+        finally:
+            stderr_reader.cancel()
+            await self._reap(p)
+            if sink is not log_file:
+                sink.close()
+
+        self._check_convert_output(cmds, infile, tail.getvalue(), yielded,
+                                   p.returncode, p.pid, tail.total_bytes)
+
+    async def thumbnail(self, fname, time, outfile, size=None,
+                        quality=FFMpeg.DEFAULT_JPEG_QUALITY):
+        """
+        Create a thumbnal of media file, and store it to outfile.
+
+        See the documentation of converter.FFMpeg.thumbnail() for details.
+        """
+        return await self.thumbnails(fname, [(time, outfile, size, quality)])
+
+    async def thumbnails(self, fname, option_list, output_seeking=False,
+                         input_seeking=False, max_workers=None,
+                         keyframes_only=False):
+        """
+        Create one or more thumbnails of video. With input_seeking, the
+        thumbnails are divided among up to max_workers ffmpeg processes
+        running concurrently.
+
+        See the documentation of converter.FFMpeg.thumbnails() for details.
+        """
+        if not os.path.exists(fname):
+            raise IOError('No such file: ' + fname)
+
+        if not input_seeking:
+            cmds = self._thumbnails_cmds(fname, option_list, output_seeking)
+            _, stderr_data = await self._communicate(cmds)
+            self._check_thumbnails_output(option_list, stderr_data)
+            return
+
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        n = max(1, min(max_workers, len(option_list)))
+
+        async def run(batch):
+            cmds = self._thumbnails_seek_cmds(fname, batch, keyframes_only)
+            _, stderr_data = await self._communicate(cmds)
+            self._check_thumbnails_output(batch, stderr_data)
+
+        tasks = [asyncio.ensure_future(run(option_list[i::n]))
+                 for i in range(n)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def file_identity(fname):
+    """
+    Return a tuple identifying the current version of a file:
+    (realpath, inode, size, mtime_ns). Any change to the file contents
+    made through the usual means changes at least one of these.
+
+    Raises OSError if the file can't be stat'ed.
+    """
+    path = os.path.realpath(fname)
+    st = os.stat(path)
+    return path, st.st_ino, st.st_size, st.st_mtime_ns
+
+
+def dump_info(info):
+    """
+    Serialize a MediaInfo object into a JSON-compatible dict.
+    """
+    return {
+        'posters_as_video': info.posters_as_video,
+        'format': dict(vars(info.format)),
+        'streams': [dict(vars(s)) for s in info.streams],
+    }
+
+
+def load_info(data):
+    """
+    Rebuild a MediaInfo object from the output of dump_info().
+    """
+    from converter.ffmpeg import MediaInfo, MediaStreamInfo
+
+    info = MediaInfo(data['posters_as_video'])
+    info.format.__dict__.update(data['format'])
+    for d in data['streams']:
+        stream = MediaStreamInfo()
+        stream.__dict__.update(d)
+        info.streams.append(stream)
+    return info
+
+
+class ProbeCache(object):
+
+    """
+    Cache of ffprobe results, keyed by file identity (see file_identity())
+    and the posters_as_video flag. Entries are kept in a bounded in-memory
+    LRU and, if a path is given, in an SQLite database that survives
+    restarts. A changed file (different inode, size or mtime) never
+    matches a stale entry, and stale on-disk entries are replaced on the
+    next probe.
+
+    Every lookup returns a fresh MediaInfo object, so callers are free to
+    modify it. The cache is safe to share between threads.
+
+    The attributes are:
+      * hits - lookups answered from memory
+      * disk_hits - lookups answered from the SQLite database
+      * misses - lookups that required running ffprobe
+
+    >>> cache = ProbeCache(maxsize=1024, path='/var/cache/probe.sqlite')
+    >>> c = Converter(probe_cache=cache)
+    """
+
+    def __init__(self, maxsize=256, path=None):
+        """
+        :param maxsize: Maximum number of entries kept in memory
+        :param path: Optional path of the SQLite database
+        """
+        self.maxsize = maxsize
+        self.path = path
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._latest = {}
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            with self._db:
+                self._db.execute(
+                    'CREATE TABLE IF NOT EXISTS probe ('
+                    'path TEXT NOT NULL, posters_as_video INTEGER NOT NULL, '
+                    'inode INTEGER NOT NULL, size INTEGER NOT NULL, '
+                    'mtime_ns INTEGER NOT NULL, info TEXT NOT NULL, '
+                    'PRIMARY KEY (path, posters_as_video))')
+
+    @staticmethod
+    def key(fname, posters_as_video=True):
+        """
+        Cache key for the current version of fname, or None if the file
+        can't be stat'ed (and thus can't be cached).
+        """
+        try:
+            return file_identity(fname) + (bool(posters_as_video),)
+        except OSError:
+            return None
+
+    def get(self, key):
+        """
+        Return the cached MediaInfo for key, or None.
+        """
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return load_info(data)
+
+            data = self._db_get(key)
+            if data is not None:
+                self._remember(key, data)
+                self.disk_hits += 1
+                return load_info(data)
+
+            self.misses += 1
+            return None
+
+    def put(self, key, info):
+        """
+        Store the MediaInfo for key.
+        """
+        data = dump_info(info)
+        with self._lock:
+            self._remember(key, data)
+            self._db_put(key, data)
+
+    def clear(self):
+        """
+        Drop all entries, both from memory and from disk.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._latest.clear()
+            if self._db is not None:
+                with self._db:
+                    self._db.execute('DELETE FROM probe')
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'entries': len(self._entries),
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remember(self, key, data):
+        # drop the entry for an older version of the same file
+        latest = self._latest.get((key[0], key[4]))
+        if latest is not None and latest != key:
+            self._entries.pop(latest, None)
+        self._latest[(key[0], key[4])] = key
+
+        self._entries[key] = data
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            old, _ = self._entries.popitem(last=False)
+            if self._latest.get((old[0], old[4])) == old:
+                del self._latest[(old[0], old[4])]
+
+    def _db_get(self, key):
+        if self._db is None:
+            return None
+        path, inode, size, mtime_ns, posters_as_video = key
+        row = self._db.execute(
+            'SELECT inode, size, mtime_ns, info FROM probe '
+            'WHERE path = ? AND posters_as_video = ?',
+            (path, int(posters_as_video))).fetchone()
+        if row is None:
+            return None
+        if tuple(row[:3]) != (inode, size, mtime_ns):
+            # the file has changed since it was probed
+            with self._db:
+                self._db.execute(
+                    'DELETE FROM probe WHERE path = ? AND posters_as_video = ?',
+                    (path, int(posters_as_video)))
+            return None
+        try:
+            return json.loads(row[3])
+        except ValueError:
+            logger.warning('Ignoring corrupt probe cache entry for %s' % path)
+            return None
+
+    def _db_put(self, key, data):
+        if self._db is None:
+            return
+        path, inode, size, mtime_ns, posters_as_video = key
+        with self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO probe VALUES (?, ?, ?, ?, ?, ?)',
+                (path, int(posters_as_video), inode, size, mtime_ns,
+                 json.dumps(data)))
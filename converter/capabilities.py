@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+
+"""
+Detection of the encoders, muxers and filters an ffmpeg binary supports.
+"""
+
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+from subprocess import Popen, PIPE
+
+from converter.cache import file_identity
+
+logger = logging.getLogger(__name__)
+
+
+_CODEC_ALIAS = re.compile(r'\(codec (\S+)\)\s*$')
+_RELEASE_VERSION = re.compile(r'n?(\d+)\.(\d+)(?:\.(\d+))?')
+
+
+class Capabilities(object):
+
+    """
+    Features supported by an ffmpeg binary. The attributes are:
+      * version - version string (e.g. "4.4.2"), or None
+      * encoders - set of encoder names (e.g. "libx264"), and of the
+        names of the codecs they produce (e.g. "h264")
+      * muxers - set of muxer (output format) names (e.g. "mp4")
+      * filters - set of filter names (e.g. "scale")
+
+    >>> caps = FFMpeg().capabilities
+    >>> caps.has_encoder('libfdk_aac')
+    False
+    """
+
+    def __init__(self, version=None, encoders=(), muxers=(), filters=()):
+        self.version = version
+        self.encoders = set(encoders)
+        self.muxers = set(muxers)
+        self.filters = set(filters)
+
+    @property
+    def version_info(self):
+        """
+        The release version as a tuple of ints (e.g. (4, 4, 2)), or None
+        if it's unknown or the binary is a git snapshot (e.g. "N-109421").
+        """
+        m = _RELEASE_VERSION.match(self.version or '')
+        if m is None:
+            return None
+        return tuple(int(x or 0) for x in m.groups())
+
+    def has_encoder(self, name):
+        return name in self.encoders
+
+    def has_muxer(self, name):
+        return name in self.muxers
+
+    def has_filter(self, name):
+        return name in self.filters
+
+    @staticmethod
+    def parse_version(output):
+        """
+        Parse the output of ffmpeg -version.
+        """
+        for line in output.split('\n'):
+            parts = line.split()
+            if len(parts) >= 3 and parts[1] == 'version':
+                return parts[2]
+        return None
+
+    @staticmethod
+    def parse_encoders(output):
+        """
+        Parse the output of ffmpeg -encoders. The list follows a legend
+        that ends with a line of dashes; each entry is a flags column,
+        the name and a description. Encoders named differently from the
+        codec they produce end the description with "(codec <name>)",
+        and the codec name is included as well (e.g. both "dca" and
+        "dts"), so codecs can be checked by either name.
+        """
+        names = set()
+        started = False
+        for line in output.split('\n'):
+            parts = line.split()
+            if not started:
+                started = len(parts) == 1 and parts[0].startswith('---')
+                continue
+            if len(parts) >= 2:
+                names.add(parts[1])
+                alias = _CODEC_ALIAS.search(line)
+                if alias:
+                    names.add(alias.group(1))
+        return names
+
+    @staticmethod
+    def parse_muxers(output):
+        """
+        Parse the output of ffmpeg -muxers (or -formats). Entries list
+        the flags (D for demuxing, E for muxing), a comma-separated list
+        of names and a description.
+        """
+        names = set()
+        started = False
+        for line in output.split('\n'):
+            parts = line.split()
+            if not started:
+                started = len(parts) == 1 and parts[0].startswith('--')
+                continue
+            if len(parts) >= 2 and 'E' in parts[0]:
+                names.update(parts[1].split(','))
+        return names
+
+    @staticmethod
+    def parse_filters(output):
+        """
+        Parse the output of ffmpeg -filters. Entries list the flags, the
+        name, the input/output types (e.g. "V->V") and a description.
+        """
+        names = set()
+        for line in output.split('\n'):
+            parts = line.split()
+            if len(parts) >= 3 and '->' in parts[2]:
+                names.add(parts[1])
+        return names
+
+    def to_dict(self):
+        return {
+            'version': self.version,
+            'encoders': sorted(self.encoders),
+            'muxers': sorted(self.muxers),
+            'filters': sorted(self.filters),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data.get('version'), data.get('encoders', ()),
+                   data.get('muxers', ()), data.get('filters', ()))
+
+    def __repr__(self):
+        return 'Capabilities(version=%s, encoders=%d, muxers=%d, filters=%d)' % (
+            self.version, len(self.encoders), len(self.muxers),
+            len(self.filters))
+
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def detect(ffmpeg_path):
+    """
+    Run the ffmpeg binary to find out its capabilities. Returns a
+    Capabilities object, or None if the binary can't be run or its
+    output isn't understood. The version is taken from the banner ffmpeg
+    prints before the encoder list.
+    """
+    outputs = []
+    for option in ('-encoders', '-muxers', '-filters'):
+        try:
+            p = Popen([ffmpeg_path, option], shell=False, stdin=PIPE,
+                      stdout=PIPE, stderr=PIPE, close_fds=True)
+            stdout_data, stderr_data = p.communicate()
+        except OSError:
+            return None
+        if p.returncode != 0:
+            return None
+        outputs.append((stdout_data.decode('utf-8', 'replace'),
+                        stderr_data.decode('utf-8', 'replace')))
+
+    (encoders, banner), (muxers, _), (filters, _) = outputs
+    caps = Capabilities(Capabilities.parse_version(banner + '\n' + encoders),
+                        Capabilities.parse_encoders(encoders),
+                        Capabilities.parse_muxers(muxers),
+                        Capabilities.parse_filters(filters))
+    if not caps.encoders or not caps.muxers:
+        return None
+    return caps
+
+
+def get_capabilities(ffmpeg_path, cache_path=None):
+    """
+    Return the Capabilities of the ffmpeg binary, or None if they can't
+    be detected. Results are cached by the identity of the binary (its
+    path, inode, size and modification time) in memory and, if
+    cache_path (a JSON file name) is given, on disk to be shared between
+    runs, so the binary is only run again after it's been replaced.
+    """
+    try:
+        identity = file_identity(ffmpeg_path)
+    except OSError:
+        return None
+
+    with _cache_lock:
+        if identity in _cache:
+            return _cache[identity]
+
+    caps = _load(cache_path, identity)
+    if caps is None:
+        caps = detect(ffmpeg_path)
+        if caps is not None:
+            _store(cache_path, identity, caps)
+        else:
+            logger.warning("Can't detect the capabilities of " + ffmpeg_path)
+
+    with _cache_lock:
+        _cache[identity] = caps
+    return caps
+
+
+def _read(cache_path):
+    try:
+        with open(cache_path) as f:
+            data = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def _load(cache_path, identity):
+    if cache_path is None:
+        return None
+    entry = _read(cache_path).get(identity[0])
+    if not isinstance(entry, dict) or entry.get('identity') != list(identity):
+        return None
+    return Capabilities.from_dict(entry)
+
+
+def _store(cache_path, identity, caps):
+    if cache_path is None:
+        return
+    data = _read(cache_path)
+    entry = caps.to_dict()
+    entry['identity'] = list(identity)
+    data[identity[0]] = entry
+    try:
+        directory = os.path.dirname(cache_path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, tmp = tempfile.mkstemp(dir=directory or '.', prefix='.capabilities-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            os.rename(tmp, cache_path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+    except (IOError, OSError) as e:
+        logger.warning("Can't store ffmpeg capabilities: %s" % e)
@@ -1,6 +1,5 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from six import with_metaclass
 
 codec_lists = dict()
 formats_supported = list()
@@ -26,7 +25,7 @@ class MetaBaseCodec(type):
         return sub_class
 
 
-class BaseCodec(with_metaclass(MetaBaseCodec, object)):
+class BaseCodec(object, metaclass=MetaBaseCodec):
 
     """
     Base audio/video codec class.
@@ -35,12 +34,36 @@ class BaseCodec(with_metaclass(MetaBaseCodec, object)):
     encoder_options = {}
     codec_name = None
     ffmpeg_codec_name = None
+    # codec name of streams in this format, as reported by ffprobe
+    ffprobe_codec_name = None
+    # options that don't prevent copying a matching source stream
+    copy_ignored_options = ('codec',)
 
     def parse_options(self, opt):
         if 'codec' not in opt or opt['codec'] != self.codec_name:
             raise ValueError('invalid codec name')
         return None
 
+    def can_copy(self, stream, opt):
+        """
+        Check whether the source stream (a MediaStreamInfo object)
+        already satisfies the options, so it can be copied instead of
+        re-encoded. Options this method can't verify never match.
+        """
+        if not self.ffprobe_codec_name or stream.codec != self.ffprobe_codec_name:
+            return False
+        if 'codec' not in opt or opt['codec'] != self.codec_name:
+            return False
+        safe = self.safe_options(opt)
+        for k in safe:
+            if k not in self.copy_ignored_options and \
+                    not self._codec_specific_can_copy(stream, k, safe[k]):
+                return False
+        return True
+
+    def _codec_specific_can_copy(self, stream, key, value):
+        return False
+
     def _codec_specific_parse_options(self, safe):
         return safe
 
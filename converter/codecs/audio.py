@@ -25,6 +25,23 @@ class AudioCodec(BaseCodec):
         'samplerate': int
     }
 
+    copy_ignored_options = ('codec', 'quality')
+
+    def can_copy(self, stream, opt):
+        if 'filter' in opt:
+            return False
+        return super(AudioCodec, self).can_copy(stream, opt)
+
+    def _codec_specific_can_copy(self, stream, key, value):
+        if key == 'channels':
+            return stream.audio_channels == value
+        if key == 'samplerate':
+            return stream.audio_samplerate == value
+        if key == 'bitrate':
+            # re-encoding to a higher bitrate doesn't improve anything
+            return stream.bitrate is not None and stream.bitrate <= value * 1000
+        return False
+
     def parse_options(self, opt):
         super(AudioCodec, self).parse_options(opt)
 
@@ -91,6 +108,7 @@ class VorbisCodec(AudioCodec):
     """
     codec_name = 'vorbis'
     ffmpeg_codec_name = 'libvorbis'
+    ffprobe_codec_name = 'vorbis'
     encoder_options = AudioCodec.encoder_options.copy()
     encoder_options.update({
         'quality': int,  # audio quality. Range is 0-10(highest quality)
@@ -111,6 +129,7 @@ class AacCodec(AudioCodec):
     """
     codec_name = 'aac'
     ffmpeg_codec_name = 'aac'
+    ffprobe_codec_name = 'aac'
     aac_experimental_enable = ['-strict', 'experimental']
     encoder_options = AudioCodec.encoder_options.copy()
     encoder_options.update({
@@ -139,6 +158,7 @@ class FdkAacCodec(AudioCodec):
     """
     codec_name = 'libfdk_aac'
     ffmpeg_codec_name = 'libfdk_aac'
+    ffprobe_codec_name = 'aac'
     encoder_options = AudioCodec.encoder_options.copy()
     encoder_options.update({
         'quality': int,  # audio quality. Range is 1-5(highest quality)
@@ -166,6 +186,7 @@ class Ac3Codec(AudioCodec):
     """
     codec_name = 'ac3'
     ffmpeg_codec_name = 'ac3'
+    ffprobe_codec_name = 'ac3'
 
 
 class FlacCodec(AudioCodec):
@@ -175,6 +196,7 @@ class FlacCodec(AudioCodec):
     """
     codec_name = 'flac'
     ffmpeg_codec_name = 'flac'
+    ffprobe_codec_name = 'flac'
 
 
 class DtsCodec(AudioCodec):
@@ -184,6 +206,7 @@ class DtsCodec(AudioCodec):
     """
     codec_name = 'dts'
     ffmpeg_codec_name = 'dts'
+    ffprobe_codec_name = 'dts'
 
 
 class Mp3Codec(AudioCodec):
@@ -193,6 +216,7 @@ class Mp3Codec(AudioCodec):
     """
     codec_name = 'mp3'
     ffmpeg_codec_name = 'libmp3lame'
+    ffprobe_codec_name = 'mp3'
     encoder_options = AudioCodec.encoder_options.copy()
     encoder_options.update({
         'quality': int,  # audio quality. Range is 0-9(lowest quality)
@@ -220,6 +244,7 @@ class Mp2Codec(AudioCodec):
     """
     codec_name = 'mp2'
     ffmpeg_codec_name = 'mp2'
+    ffprobe_codec_name = 'mp2'
 
 
 class WmaCodec(AudioCodec):
@@ -229,3 +254,4 @@ class WmaCodec(AudioCodec):
     """
     codec_name = "wma"
     ffmpeg_codec_name = "wmav2"
+    ffprobe_codec_name = "wmav2"
@@ -18,6 +18,8 @@ class VideoCodec(BaseCodec):
       * max_bitrate (string) - maximum stream bitrate
       * fps (integer) - frames per second
       * keyframe_interval (integer) - keyframe interval
+      * force_keyframes (string) - times or expression of keyframes
+            that must be placed (see ffmpeg -force_key_frames)
       * width (integer) - video width
       * height (integer) - video height
       * mode (string) - aspect preserval mode; one of:
@@ -56,6 +58,7 @@ class VideoCodec(BaseCodec):
         'display_aspect_ratio': float,
         'sample_aspect_ratio': float,
         'rotate': str,
+        'force_keyframes': str,
     }
 
     formats_supported = [
@@ -90,6 +93,33 @@ class VideoCodec(BaseCodec):
         "ayuv64le", "ayuv64be", "videotoolbox_vld",
     ]
 
+    copy_ignored_options = ('codec', 'mode', 'src_width', 'src_height',
+                            'display_aspect_ratio', 'sample_aspect_ratio',
+                            'rotate', 'quality', 'preset', 'tune')
+
+    def can_copy(self, stream, opt):
+        rotate = opt.get('rotate')
+        if rotate and rotate != '0' and ('width' in opt or 'height' in opt):
+            # the encoder would get the video rotated
+            return False
+        if stream.video_pixel_format != opt.get('pix_fmt', 'yuv420p'):
+            return False
+        return super(VideoCodec, self).can_copy(stream, opt)
+
+    def _codec_specific_can_copy(self, stream, key, value):
+        if key == 'pix_fmt':
+            return True  # checked in can_copy()
+        if key == 'width':
+            return stream.video_width == value
+        if key == 'height':
+            return stream.video_height == value
+        if key == 'fps':
+            return stream.video_fps is not None and abs(stream.video_fps - value) < 0.01
+        if key == 'bitrate':
+            # re-encoding to a higher bitrate doesn't improve anything
+            return stream.bitrate is not None and stream.bitrate <= value * 1000
+        return False
+
     def _aspect_corrections(self, sw, sh, w, h, sar, rotate, mode):
         # If we don't have source info, we don't try to calculate
         # aspect corrections
@@ -250,6 +280,8 @@ class VideoCodec(BaseCodec):
             optlist.extend(['-vb', str(safe['bitrate']) + 'k'])  # FIXED
         if 'max_bitrate' in safe:
             optlist.extend(['-maxrate', str(safe['max_bitrate']) + 'k', '-bufsize', str(safe['max_bitrate']) + 'k'])
+        if 'force_keyframes' in safe:
+            optlist.extend(['-force_key_frames', safe['force_keyframes']])
         if w and h:
             optlist.extend(['-s', '%dx%d' % (w, h)])
 
@@ -290,6 +322,7 @@ class TheoraCodec(VideoCodec):
 
     codec_name = 'theora'
     ffmpeg_codec_name = 'libtheora'
+    ffprobe_codec_name = 'theora'
     encoder_options = VideoCodec.encoder_options.copy()
     encoder_options.update({
         'quality': int,  # audio quality. Range is 0-10(highest quality)
@@ -319,6 +352,7 @@ class H264Codec(VideoCodec):
 
     codec_name = 'h264'
     ffmpeg_codec_name = 'libx264'
+    ffprobe_codec_name = 'h264'
     encoder_options = VideoCodec.encoder_options.copy()
     encoder_options.update({
         'preset': str,  # common presets are ultrafast, superfast, veryfast,
@@ -362,6 +396,7 @@ class VaapiH264Codec(VideoCodec):
 
     codec_name = 'h264_vaapi'
     ffmpeg_codec_name = 'h264_vaapi'
+    ffprobe_codec_name = 'h264'
     encoder_options = VideoCodec.encoder_options.copy()
     encoder_options.update({
         'preset': str,  # common presets are ultrafast, superfast, veryfast,
@@ -399,6 +434,7 @@ class DivxCodec(VideoCodec):
 
     codec_name = 'divx'
     ffmpeg_codec_name = 'mpeg4'
+    ffprobe_codec_name = 'mpeg4'
     encoder_options = VideoCodec.encoder_options.copy()
     encoder_options.update({
         'quality': int,  # quality, range:1(lossless)-31(worst)
@@ -425,6 +461,7 @@ class Vp8Codec(VideoCodec):
 
     codec_name = 'vp8'
     ffmpeg_codec_name = 'libvpx'
+    ffprobe_codec_name = 'vp8'
     encoder_options = VideoCodec.encoder_options.copy()
     encoder_options.update({
         'quality': int,  # quality, range:0(lossless)-63(worst)
@@ -460,6 +497,7 @@ class Vp9Codec(VideoCodec):
 
     codec_name = 'vp9'
     ffmpeg_codec_name = 'libvpx-vp9'
+    ffprobe_codec_name = 'vp9'
     encoder_options = VideoCodec.encoder_options.copy()
     encoder_options.update({
         'deadline': str,  # realtime, good, or best
@@ -488,6 +526,7 @@ class H263Codec(VideoCodec):
 
     codec_name = 'h263'
     ffmpeg_codec_name = 'h263'
+    ffprobe_codec_name = 'h263'
 
 
 class FlvCodec(VideoCodec):
@@ -495,6 +534,7 @@ class FlvCodec(VideoCodec):
 
     codec_name = 'flv'
     ffmpeg_codec_name = 'flv'
+    ffprobe_codec_name = 'flv1'
 
 
 class MpegCodec(VideoCodec):
@@ -544,6 +584,7 @@ class Mpeg1Codec(MpegCodec):
 
     codec_name = 'mpeg1'
     ffmpeg_codec_name = 'mpeg1video'
+    ffprobe_codec_name = 'mpeg1video'
 
 
 class Mpeg2Codec(MpegCodec):
@@ -551,6 +592,7 @@ class Mpeg2Codec(MpegCodec):
 
     codec_name = 'mpeg2'
     ffmpeg_codec_name = 'mpeg2video'
+    ffprobe_codec_name = 'mpeg2video'
 
 
 class WmvCodec(VideoCodec):
@@ -558,6 +600,7 @@ class WmvCodec(VideoCodec):
 
     codec_name = 'wmv'
     ffmpeg_codec_name = 'msmpeg4'
+    ffprobe_codec_name = 'msmpeg4v3'
     encoder_options = VideoCodec.encoder_options.copy()
     encoder_options.update({
         'quality': int,  # quality, range:1(lossless)-31(worst)
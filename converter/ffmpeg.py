@@ -2,16 +2,54 @@
 
 import os.path
 import os
-import re
-import signal
+import json
+import selectors
+import sys
+import threading
+import time
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from subprocess import Popen, PIPE
 import logging
 import locale
+import struct
+import bisect
+from array import array
+from collections import OrderedDict
+
+from converter import capabilities
+from converter.cache import file_identity
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 logger = logging.getLogger(__name__)
 
 console_encoding = locale.getdefaultlocale()[1] or 'UTF-8'
 
+_which_cache = {}
+
+
+def which(name):
+    """
+    Find the executable name in $PATH. Results are remembered (per
+    $PATH) for as long as the file exists.
+    """
+    path = os.environ.get('PATH', os.defpath)
+    fpath = _which_cache.get((name, path))
+    if fpath is not None and os.path.exists(fpath):
+        return fpath
+
+    for d in path.split(':'):
+        fpath = os.path.join(d, name)
+        if os.path.exists(fpath) and os.access(fpath, os.X_OK):
+            _which_cache[(name, path)] = fpath
+            return fpath
+    return None
+
 
 class FFMpegError(Exception):
     pass
@@ -27,7 +65,8 @@ class FFMpegConvertError(Exception):
         @param    cmd: Full command string used to spawn ffmpeg.
         @type     cmd: C{str}
 
-        @param    output: Full stdout output from the ffmpeg command.
+        @param    output: Last part of the stderr output from the ffmpeg
+            command (see the log_tail argument of FFMpeg.convert()).
         @type     output: C{str}
 
         @param    details: Optional error details.
@@ -49,6 +88,205 @@ class FFMpegConvertError(Exception):
         return self.__repr__()
 
 
+class FFMpegTimeoutError(FFMpegConvertError):
+
+    """
+    Raised when ffmpeg stops reporting progress for longer than the stall
+    timeout, or runs past its deadline. The ffmpeg process is killed.
+    """
+
+    def __repr__(self):
+        error = self.details if self.details else self.args[0]
+        return ('<FFMpegTimeoutError error="%s", pid=%s, cmd="%s">' %
+                (error, self.pid, self.cmd))
+
+
+class FFMpegMemoryError(FFMpegConvertError):
+
+    """
+    Raised when the resident memory of ffmpeg exceeds the max_rss limit.
+    The ffmpeg process is killed.
+    """
+
+    def __repr__(self):
+        error = self.details if self.details else self.args[0]
+        return ('<FFMpegMemoryError error="%s", pid=%s, cmd="%s">' %
+                (error, self.pid, self.cmd))
+
+
+class JobStats(object):
+
+    """
+    Resource usage of one ffmpeg/ffprobe process. Pass an instance as the
+    stats argument of the FFMpeg methods, and it's filled in as the
+    process runs. The attributes are:
+      * cmd - the command that was run
+      * pid - process id
+      * returncode - exit code of the process
+      * spawn_latency - time it took to start the process (seconds)
+      * wall_time - time from spawning the process until it exited
+      * user_time - CPU time spent in user mode (seconds)
+      * sys_time - CPU time spent in the kernel (seconds)
+      * max_rss - peak resident memory (bytes)
+      * read_bytes - bytes read from storage
+      * write_bytes - bytes written to storage
+      * read_chars - bytes read by the process, including cached and
+        piped data
+      * write_chars - bytes written by the process, including piped data
+    CPU times come from the rusage of the exited process (Unix only),
+    the I/O counters from sampling /proc/<pid>/io (Linux only). Values
+    that aren't available are None.
+    """
+
+    # seconds between two samples of a running process
+    SAMPLE_INTERVAL = 0.5
+
+    def __init__(self):
+        self.cmd = None
+        self.pid = None
+        self.returncode = None
+        self.spawn_latency = None
+        self.wall_time = None
+        self.user_time = None
+        self.sys_time = None
+        self.max_rss = None
+        self.read_bytes = None
+        self.write_bytes = None
+        self.read_chars = None
+        self.write_chars = None
+        self._started = None
+
+    @property
+    def cpu_time(self):
+        """
+        Total (user + system) CPU time in seconds, or None.
+        """
+        if self.user_time is None:
+            return None
+        return self.user_time + self.sys_time
+
+    def start(self, cmds):
+        """
+        Record that the process is about to be spawned.
+        """
+        self.cmd = ' '.join(cmds)
+        self._started = time.monotonic()
+
+    def spawned(self, p):
+        """
+        Record that the process p has been spawned.
+        """
+        self.pid = p.pid
+        self.spawn_latency = time.monotonic() - self._started
+
+    def sample(self):
+        """
+        Sample the memory and I/O counters of the running process from
+        /proc. Returns its current resident memory in bytes, or None if
+        it can't be determined.
+        """
+        rss = None
+        try:
+            with open('/proc/%d/status' % self.pid) as f:
+                for line in f:
+                    key, _, val = line.partition(':')
+                    if key in ('VmRSS', 'VmHWM'):
+                        # reported in kB
+                        val = int(val.split()[0]) * 1024
+                        self.max_rss = max(self.max_rss or 0, val)
+                        if key == 'VmRSS':
+                            rss = val
+            with open('/proc/%d/io' % self.pid) as f:
+                for line in f:
+                    key, _, val = line.partition(':')
+                    if key in ('read_bytes', 'write_bytes'):
+                        setattr(self, key, int(val))
+                    elif key in ('rchar', 'wchar'):
+                        attr = 'read_chars' if key == 'rchar' else 'write_chars'
+                        setattr(self, attr, int(val))
+        except (IOError, OSError, ValueError, IndexError):
+            pass
+        return rss
+
+    def reap(self, p):
+        """
+        Wait for the process p to exit, and record its resource usage.
+        """
+        self.sample()
+        try:
+            _, status, rusage = os.wait4(p.pid, 0)
+        except (AttributeError, ChildProcessError):
+            # no wait4() on this platform, or the process has been reaped
+            p.wait()
+        else:
+            if os.WIFSIGNALED(status):
+                p.returncode = -os.WTERMSIG(status)
+            else:
+                p.returncode = os.WEXITSTATUS(status)
+            self.user_time = rusage.ru_utime
+            self.sys_time = rusage.ru_stime
+            # ru_maxrss is in kB, except on macOS
+            max_rss = rusage.ru_maxrss
+            if sys.platform != 'darwin':
+                max_rss *= 1024
+            self.max_rss = max(self.max_rss or 0, max_rss)
+        self.returncode = p.returncode
+        if self._started is not None:
+            self.wall_time = time.monotonic() - self._started
+
+    def __repr__(self):
+        return ('JobStats(pid=%s, wall_time=%s, user_time=%s, sys_time=%s, '
+                'max_rss=%s, read_bytes=%s, write_bytes=%s)' % (
+                    self.pid, self.wall_time, self.user_time, self.sys_time,
+                    self.max_rss, self.read_bytes, self.write_bytes))
+
+
+class Watchdog(object):
+
+    """
+    Wall-clock limits for a running ffmpeg process: timeout is the
+    longest allowed pause between two progress updates, deadline the
+    longest allowed total run time (both in seconds, None to disable).
+    It doesn't use signals or timers, so it works in any thread.
+    """
+
+    def __init__(self, timeout=None, deadline=None):
+        self.timeout = timeout
+        self.deadline = deadline
+        self.started = self.last_progress = time.monotonic()
+
+    def progress(self):
+        """
+        Record a progress update.
+        """
+        self.last_progress = time.monotonic()
+
+    def remaining(self):
+        """
+        Seconds until the nearest limit expires (negative if it already
+        has), or None if there are no limits.
+        """
+        now = time.monotonic()
+        left = None
+        if self.timeout:
+            left = self.last_progress + self.timeout - now
+        if self.deadline:
+            d = self.started + self.deadline - now
+            left = d if left is None else min(left, d)
+        return left
+
+    def expired(self):
+        """
+        Describe the expired limit, or return None if none has expired.
+        """
+        now = time.monotonic()
+        if self.deadline and now >= self.started + self.deadline:
+            return 'deadline of %ss exceeded' % self.deadline
+        if self.timeout and now >= self.last_progress + self.timeout:
+            return 'no progress for %ss' % self.timeout
+        return None
+
+
 class MediaFormatInfo(object):
 
     """
@@ -60,6 +298,16 @@ class MediaFormatInfo(object):
       * filesize - file size
     """
 
+    # ffprobe JSON key -> (attribute, MediaStreamInfo parser, default),
+    # mirroring the key handling in parse_ffprobe()
+    json_fields = {
+        'format_name': ('format', None, None),
+        'format_long_name': ('fullname', None, None),
+        'bit_rate': ('bitrate', 'parse_float', None),
+        'duration': ('duration', 'parse_float', None),
+        'size': ('size', 'parse_float', None),
+    }
+
     def __init__(self):
         self.format = None
         self.fullname = None
@@ -87,6 +335,18 @@ class MediaFormatInfo(object):
             value = val
             self.metadata[key] = value
 
+    def parse_ffprobe_json(self, data):
+        """
+        Parse the "format" object of ffprobe JSON output.
+        """
+        for key, (attr, parser, default) in self.json_fields.items():
+            if key in data:
+                val = data[key]
+                if parser:
+                    val = getattr(MediaStreamInfo, parser)(val, default)
+                setattr(self, attr, val)
+        self.metadata.update(data.get('tags', {}))
+
     def __repr__(self):
         d = ''
         metadata_str = ['%s=%s' % (key, value) for key, value
@@ -116,6 +376,8 @@ class MediaStreamInfo(object):
       * metadata - optional metadata associated with a video or audio stream
       * bitrate - stream bitrate in bytes/second
       * attached_pic - (0, 1 or None) is stream a poster image? (e.g. in mp3)
+      * profile - codec profile (e.g. "High", "LC"), if any
+      * level - codec level (e.g. 31 for H.264 level 3.1), if any
     Video-specific attributes are:
       * video_width - width of video in pixels
       * video_height - height of video in pixels
@@ -126,6 +388,66 @@ class MediaStreamInfo(object):
       * audio_samplerate - sample rate (Hz)
     """
 
+    # ffprobe JSON key -> (attribute, parser, default) for the fields
+    # that are parsed the same way for every stream type
+    json_fields = {
+        'index': ('index', 'parse_int', 0),
+        'codec_type': ('type', None, None),
+        'codec_name': ('codec', None, None),
+        'codec_long_name': ('codec_desc', None, None),
+        'duration': ('duration', 'parse_float', 0.0),
+        'bit_rate': ('bitrate', 'parse_int', None),
+        'width': ('video_width', 'parse_int', 0),
+        'height': ('video_height', 'parse_int', 0),
+        'pix_fmt': ('video_pixel_format', None, None),
+        'channels': ('audio_channels', 'parse_int', 0),
+        'sample_rate': ('audio_samplerate', 'parse_float', 0.0),
+        'start_time': ('start_time', 'parse_float', 0.0),
+        'profile': ('profile', None, None),
+        'level': ('level', 'parse_int', None),
+    }
+
+    # The JSON writer omits optional fields that the flat writer prints
+    # as "N/A" or "unknown": JSON key -> the value the flat writer prints,
+    # so missing fields are parsed the same way
+    json_optional_fields = {
+        'codec_type': 'unknown',
+        'codec_name': 'unknown',
+        'codec_long_name': 'unknown',
+        'profile': 'unknown',
+        'duration': 'N/A',
+        'start_time': 'N/A',
+        'bit_rate': 'N/A',
+    }
+
+    # the same, per stream type
+    json_type_optional_fields = {
+        'video': {
+            'pix_fmt': 'unknown',
+            'sample_aspect_ratio': 'N/A',
+            'display_aspect_ratio': 'N/A',
+        },
+    }
+
+    # ffprobe JSON key -> (attribute, parser) per stream type
+    json_type_fields = {
+        'audio': {
+            'avg_frame_rate': ('video_fps', 'parse_frame_rate'),
+        },
+        'video': {
+            'r_frame_rate': ('video_fps', 'parse_frame_rate'),
+            'sample_aspect_ratio': ('video_sample_aspect_ratio',
+                                    'parse_sample_aspect_ratio'),
+            'display_aspect_ratio': ('video_display_aspect_ratio',
+                                     'parse_display_aspect_ratio'),
+        },
+    }
+
+    # stream type -> (disposition flag, attribute)
+    json_dispositions = {
+        'subtitle': (('forced', 'sub_forced'), ('default', 'sub_default')),
+    }
+
     def __init__(self):
         self.index = None
         self.type = None
@@ -143,6 +465,8 @@ class MediaStreamInfo(object):
         self.audio_samplerate = None
         self.start_time = None
         self.attached_pic = None
+        self.profile = None
+        self.level = None
         self.sub_forced = None
         self.sub_default = None
         self.metadata = {}
@@ -161,6 +485,47 @@ class MediaStreamInfo(object):
         except:
             return default
 
+    @staticmethod
+    def parse_frame_rate(val, default=None):
+        """
+        Parse a frame rate given either as a fraction ("25/1") or as
+        a decimal number ("29.97").
+        """
+        if '/' in val:
+            n, d = val.split('/')
+            n = MediaStreamInfo.parse_float(n)
+            d = MediaStreamInfo.parse_float(d)
+            if n > 0.0 and d > 0.0:
+                return float(n) / float(d)
+        elif '.' in val:
+            return MediaStreamInfo.parse_float(val)
+        return default
+
+    @staticmethod
+    def parse_sample_aspect_ratio(val):
+        if val == "N/A":
+            logger.warning('Could not determinate sample aspect ratio, n')
+            return None
+        n, d = val.split(':')
+        n = MediaStreamInfo.parse_float(n)
+        d = MediaStreamInfo.parse_float(d)
+        if d > 0.0:
+            return float(n) / float(d)
+        return None
+
+    @staticmethod
+    def parse_display_aspect_ratio(val):
+        if val == "N/A":
+            logger.warning('Could not determinate display aspect ratio, n')
+            return 0
+        n, d = val.split(':')
+        n = MediaStreamInfo.parse_float(n)
+        d = MediaStreamInfo.parse_float(d)
+        if d > 0.0:
+            return float(n) / float(d)
+        logger.warning('Could not determinate video ratio, n : %s d : %s' % (n, d))
+        return 16.0 / 9.0
+
     def parse_ffprobe(self, key, val):
         """
         Parse raw ffprobe output (key=value).
@@ -190,6 +555,10 @@ class MediaStreamInfo(object):
             self.audio_samplerate = self.parse_float(val)
         elif key == 'start_time':
             self.start_time = self.parse_float(val)
+        elif key == 'profile':
+            self.profile = val
+        elif key == 'level':
+            self.level = self.parse_int(val, None)
         elif key == 'DISPOSITION:attached_pic':
             self.attached_pic = self.parse_int(val)
 
@@ -200,54 +569,56 @@ class MediaStreamInfo(object):
 
         if self.type == 'audio':
             if key == 'avg_frame_rate':
-                if '/' in val:
-                    n, d = val.split('/')
-                    n = self.parse_float(n)
-                    d = self.parse_float(d)
-                    if n > 0.0 and d > 0.0:
-                        self.video_fps = float(n) / float(d)
-                elif '.' in val:
-                    self.video_fps = self.parse_float(val)
+                self.video_fps = self.parse_frame_rate(val, self.video_fps)
 
         if self.type == 'video':
             if key == 'r_frame_rate':
-                if '/' in val:
-                    n, d = val.split('/')
-                    n = self.parse_float(n)
-                    d = self.parse_float(d)
-                    if n > 0.0 and d > 0.0:
-                        self.video_fps = float(n) / float(d)
-                elif '.' in val:
-                    self.video_fps = self.parse_float(val)
+                self.video_fps = self.parse_frame_rate(val, self.video_fps)
             elif key == 'sample_aspect_ratio':
-                if val == "N/A":
-                    self.video_sample_aspect_ration = 0
-                    logger.warning('Could not determinate sample aspect ratio, n')
-                else:
-                    n, d = val.split(':')
-                    n = self.parse_float(n)
-                    d = self.parse_float(d)
-                    self.video_sample_aspect_ratio = float(n) / float(d)
+                self.video_sample_aspect_ratio = self.parse_sample_aspect_ratio(val)
             elif key == 'display_aspect_ratio':
-                if val == "N/A":
-                    self.video_display_aspect_ratio = 0
-                    logger.warning('Could not determinate display aspect ratio, n')
-                else:
-                    n, d = val.split(':')
-                    n = self.parse_float(n)
-                    d = self.parse_float(d)
-                    if d > 0.0:
-                        self.video_display_aspect_ratio = float(n) / float(d)
-                    else:
-                        logger.warning('Could not determinate video ratio, n : %s d : %s' % (n, d))
-                        self.video_display_aspect_ratio = 16.0 / 9.0
+                self.video_display_aspect_ratio = self.parse_display_aspect_ratio(val)
 
         if self.type == 'subtitle':
-            if key == 'disposition:forced':
+            if key in ('DISPOSITION:forced', 'disposition:forced'):
                 self.sub_forced = self.parse_int(val)
-            if key == 'disposition:default':
+            if key in ('DISPOSITION:default', 'disposition:default'):
                 self.sub_default = self.parse_int(val)
 
+    def parse_ffprobe_json(self, data):
+        """
+        Parse one element of the "streams" array of ffprobe JSON output.
+        """
+        optional = dict(self.json_optional_fields)
+        optional.update(self.json_type_optional_fields.get(
+            data.get('codec_type', 'unknown'), {}))
+
+        for key, (attr, parser, default) in self.json_fields.items():
+            if key in data:
+                val = data[key]
+            elif key in optional:
+                val = optional[key]
+            else:
+                continue
+            if parser:
+                val = getattr(self, parser)(val, default)
+            setattr(self, attr, val)
+
+        for key, (attr, parser) in self.json_type_fields.get(self.type, {}).items():
+            if key in data:
+                setattr(self, attr, getattr(self, parser)(data[key]))
+            elif key in optional:
+                setattr(self, attr, getattr(self, parser)(optional[key]))
+
+        disposition = data.get('disposition', {})
+        if 'attached_pic' in disposition:
+            self.attached_pic = self.parse_int(disposition['attached_pic'])
+        for key, attr in self.json_dispositions.get(self.type, ()):
+            if key in disposition:
+                setattr(self, attr, self.parse_int(disposition[key]))
+
+        self.metadata.update(data.get('tags', {}))
+
     def __repr__(self):
         d = ''
         metadata_str = ['%s=%s' % (key, value) for key, value
@@ -321,6 +692,24 @@ class MediaInfo(object):
                 elif in_format:
                     self.format.parse_ffprobe(k, v)
 
+    def parse_ffprobe_json(self, raw):
+        """
+        Parse ffprobe output produced with "-print_format json".
+        """
+        try:
+            data = json.loads(raw)
+        except ValueError:
+            return
+
+        for s in data.get('streams', ()):
+            stream = MediaStreamInfo()
+            stream.parse_ffprobe_json(s)
+            if stream.type:
+                self.streams.append(stream)
+
+        if 'format' in data:
+            self.format.parse_ffprobe_json(data['format'])
+
     def __repr__(self):
         return 'MediaInfo(format=%s, streams=%s)' % (repr(self.format),
                                                      repr(self.streams))
@@ -351,6 +740,399 @@ class MediaInfo(object):
         return None
 
 
+class OutputTail(object):
+
+    """
+    Bounded buffer keeping only the last max_bytes bytes (and optionally
+    the last max_lines lines) of a process output, so long-running jobs
+    use constant memory no matter how much they log. If a sink file-like
+    object is given, all of the output is also written to it. A
+    max_bytes of 0 or None keeps nothing, for when the sink keeps the
+    whole log.
+    """
+
+    def __init__(self, max_bytes=64 * 1024, max_lines=None, sink=None):
+        self.max_bytes = max_bytes
+        self.max_lines = max_lines
+        self.sink = sink
+        self.total_bytes = 0
+        self._chunks = deque()
+        self._size = 0
+
+    def feed(self, data):
+        self.total_bytes += len(data)
+        if self.sink is not None:
+            self.sink.write(data)
+        if not self.max_bytes:
+            return
+
+        self._chunks.append(data)
+        self._size += len(data)
+        while self._size - len(self._chunks[0]) >= self.max_bytes:
+            self._size -= len(self._chunks.popleft())
+        if self._size > self.max_bytes:
+            excess = self._size - self.max_bytes
+            self._chunks[0] = self._chunks[0][excess:]
+            self._size -= excess
+
+    def getvalue(self):
+        """
+        Return the retained output, decoded.
+        """
+        out = b''.join(self._chunks).decode(console_encoding, "replace")
+        if self.max_lines is not None:
+            # keep the trailing newline out of the line count
+            lines = out.split('\n')
+            if len(lines) > self.max_lines + 1:
+                out = '\n'.join(lines[-(self.max_lines + 1):])
+        return out
+
+
+class ConvertProgress(object):
+
+    """
+    One progress update reported by ffmpeg through its -progress
+    protocol. The attributes are:
+      * frame - number of frames encoded so far
+      * fps - encoding speed in frames per second
+      * bitrate - current output bitrate (kbit/s)
+      * total_size - output size so far (bytes)
+      * out_time_us - timecode of the processed content (microseconds)
+      * speed - encoding speed as a multiple of realtime
+      * finished - True for the final update of the process
+    Any attribute ffmpeg reports as "N/A" is None.
+    """
+
+    def __init__(self):
+        self.frame = None
+        self.fps = None
+        self.bitrate = None
+        self.total_size = None
+        self.out_time_us = None
+        self.speed = None
+        self.finished = False
+
+    def parse_progress(self, key, val):
+        """
+        Parse one line of ffmpeg -progress output (key=value).
+        """
+        if key == 'frame':
+            self.frame = MediaStreamInfo.parse_int(val, None)
+        elif key == 'fps':
+            self.fps = MediaStreamInfo.parse_float(val, None)
+        elif key == 'bitrate':
+            if val.endswith('kbits/s'):
+                val = val[:-7]
+            self.bitrate = MediaStreamInfo.parse_float(val, None)
+        elif key == 'total_size':
+            self.total_size = MediaStreamInfo.parse_int(val, None)
+        elif key in ('out_time_us', 'out_time_ms'):
+            # out_time_ms is (despite the name) in microseconds too, and
+            # is the only one older ffmpeg versions report
+            if key == 'out_time_us' or self.out_time_us is None:
+                self.out_time_us = MediaStreamInfo.parse_int(val, None)
+        elif key == 'speed':
+            if val.endswith('x'):
+                val = val[:-1]
+            self.speed = MediaStreamInfo.parse_float(val, None)
+        elif key == 'progress':
+            self.finished = val == 'end'
+
+    @property
+    def timecode(self):
+        """
+        Timecode of the processed content in seconds, or None.
+        """
+        if self.out_time_us is None:
+            return None
+        return self.out_time_us / 1000000.0
+
+    def __repr__(self):
+        return ('ConvertProgress(frame=%s, fps=%s, bitrate=%s, total_size=%s, '
+                'out_time_us=%s, speed=%s%s)' % (
+                    self.frame, self.fps, self.bitrate, self.total_size,
+                    self.out_time_us, self.speed,
+                    ', finished' if self.finished else ''))
+
+
+class ProgressEvent(object):
+
+    """
+    Progress of a conversion, as reported by Converter methods called
+    with progress_events=True. The attributes are:
+      * fraction - fraction (0..1) of the whole job completed so far
+      * out_time - timecode of the processed content (seconds)
+      * fps - encoding speed in frames per second
+      * speed - encoding speed as a multiple of realtime
+      * bitrate - current output bitrate (kbit/s)
+      * size - output size so far (bytes)
+      * elapsed - wall time since the job started (seconds)
+      * eta - estimated wall time until the job is done (seconds)
+      * duration - duration of the source media (seconds)
+    Unknown values are None.
+    """
+
+    __slots__ = ('fraction', 'out_time', 'fps', 'speed', 'bitrate', 'size',
+                 'elapsed', 'eta', 'duration')
+
+    def __init__(self, fraction, out_time=None, fps=None, speed=None,
+                 bitrate=None, size=None, elapsed=None, eta=None,
+                 duration=None):
+        self.fraction = fraction
+        self.out_time = out_time
+        self.fps = fps
+        self.speed = speed
+        self.bitrate = bitrate
+        self.size = size
+        self.elapsed = elapsed
+        self.eta = eta
+        self.duration = duration
+
+    def __float__(self):
+        return float(self.fraction)
+
+    def __repr__(self):
+        return 'ProgressEvent(%s)' % ', '.join(
+            '%s=%s' % (k, getattr(self, k)) for k in self.__slots__)
+
+
+class ProgressReader(object):
+
+    """
+    Incremental parser for ffmpeg -progress output. Feed it raw chunks
+    as they are read from the pipe, and it returns the ConvertProgress
+    updates completed by each chunk.
+    """
+
+    def __init__(self):
+        self._buf = b''
+        self._current = ConvertProgress()
+
+    def feed(self, data):
+        lines = (self._buf + data).split(b'\n')
+        self._buf = lines.pop()
+        updates = []
+        for line in lines:
+            key, _, val = line.decode('ascii', 'replace').strip().partition('=')
+            self._current.parse_progress(key, val)
+            if key == 'progress':
+                updates.append(self._current)
+                self._current = ConvertProgress()
+        return updates
+
+
+class JpegReader(object):
+
+    """
+    Incremental splitter for a stream of concatenated JPEG images, as
+    written by ffmpeg's mjpeg encoder to -f image2pipe. Feed it raw
+    chunks as they are read from the pipe, and it returns the images
+    completed by each chunk (as bytes), or passes each of them to
+    callback as soon as it's complete, if one is given.
+
+    Image boundaries are found by walking the marker segments of each
+    image, and scanning its entropy-coded data (where 0xFF bytes are
+    stuffed) for the marker that ends it, so 0xFFD9 bytes inside
+    metadata segments don't confuse it.
+    """
+
+    def __init__(self, callback=None):
+        self._buf = bytearray()
+        self._pos = 0  # where to resume parsing the current image
+        self._scan = False  # whether _pos is in entropy-coded data
+        self._callback = callback
+
+    def feed(self, data):
+        self._buf += data
+        images = []
+        end = self._find_end()
+        while end is not None:
+            if self._callback is not None:
+                self._callback(bytes(self._buf[:end]))
+            else:
+                images.append(bytes(self._buf[:end]))
+            del self._buf[:end]
+            self._pos = 0
+            self._scan = False
+            end = self._find_end()
+        return images
+
+    def pending(self):
+        """Number of bytes of an incomplete image buffered so far."""
+        return len(self._buf)
+
+    def _find_end(self):
+        buf = self._buf
+        n = len(buf)
+        pos = self._pos
+        if pos == 0:
+            if n < 2:
+                return None
+            if buf[0] != 0xFF or buf[1] != 0xD8:
+                raise FFMpegError('Invalid JPEG stream')
+            pos = 2
+
+        while True:
+            if self._scan:
+                i = buf.find(b'\xff', pos)
+                if i < 0 or i + 1 >= n:
+                    pos = n if i < 0 else i
+                    break
+                marker = buf[i + 1]
+                if marker == 0 or 0xD0 <= marker <= 0xD7:
+                    pos = i + 2  # stuffed byte or restart marker
+                else:
+                    self._scan = False
+                    pos = i
+                continue
+
+            if pos + 2 > n:
+                break
+            if buf[pos] != 0xFF:
+                raise FFMpegError('Invalid JPEG stream')
+            marker = buf[pos + 1]
+            if marker == 0xFF:
+                pos += 1  # fill byte
+            elif marker == 0xD9:
+                return pos + 2
+            elif 0xD0 <= marker <= 0xD7 or marker == 0x01:
+                pos += 2  # markers without a payload
+            else:
+                if pos + 4 > n:
+                    break
+                length = (buf[pos + 2] << 8) | buf[pos + 3]
+                if pos + 2 + length > n:
+                    break
+                pos += 2 + length
+                if marker == 0xDA:
+                    self._scan = True
+
+        self._pos = pos
+        return None
+
+
+class PacketIndex(object):
+
+    """
+    Compact index of the packets of one stream of a media file, as built
+    by FFMpeg.packet_index(). Packets are stored in file order in typed
+    arrays rather than as objects, so an index of a long video takes a
+    few megabytes at most. The attributes are:
+      * pts - presentation timestamps in seconds (array of doubles, NaN
+        where unknown)
+      * pos - byte offsets in the file (array of int64, -1 where unknown)
+      * size - packet sizes in bytes (array of int64)
+    and whether each packet is a keyframe is kept in a bitmap (see
+    is_keyframe()).
+
+    The index is filled incrementally from ffprobe -show_packets output
+    (in compact format with keys) with feed(), like ProgressReader.
+
+    >>> index = FFMpeg().packet_index('test1.ogg')
+    >>> index.keyframe_before(10.0)
+    7.68
+    """
+
+    def __init__(self):
+        self.pts = array('d')
+        self.pos = array('q')
+        self.size = array('q')
+        self._flags = bytearray()
+        self._keyframes = None
+        self._buf = b''
+
+    def __len__(self):
+        return len(self.pts)
+
+    def append(self, pts, pos, size, keyframe):
+        n = len(self.pts)
+        if n & 7 == 0:
+            self._flags.append(0)
+        if keyframe:
+            self._flags[n >> 3] |= 1 << (n & 7)
+        self.pts.append(pts)
+        self.pos.append(pos)
+        self.size.append(size)
+        self._keyframes = None
+
+    def feed(self, data):
+        lines = (self._buf + data).split(b'\n')
+        self._buf = lines.pop()
+        for line in lines:
+            self._parse_line(line)
+
+    def close(self):
+        """Parse any incomplete last line fed so far."""
+        if self._buf:
+            self._parse_line(self._buf)
+            self._buf = b''
+
+    def _parse_line(self, line):
+        pts = float('nan')
+        pos = -1
+        size = 0
+        keyframe = False
+        for field in line.strip().split(b'|'):
+            key, _, val = field.partition(b'=')
+            try:
+                if key == b'pts_time':
+                    pts = float(val)
+                elif key == b'pos':
+                    pos = int(val)
+                elif key == b'size':
+                    size = int(val)
+                elif key == b'flags':
+                    keyframe = b'K' in val
+            except ValueError:
+                pass  # N/A
+        if line.strip():
+            self.append(pts, pos, size, keyframe)
+
+    def is_keyframe(self, i):
+        """Whether packet number i is a keyframe."""
+        if i < 0:
+            i += len(self.pts)
+        if not 0 <= i < len(self.pts):
+            raise IndexError('packet index out of range')
+        return bool(self._flags[i >> 3] >> (i & 7) & 1)
+
+    def keyframes(self):
+        """
+        Sorted timestamps (in seconds) of the keyframes with a known
+        timestamp, as an array of doubles.
+        """
+        if self._keyframes is None:
+            pts = self.pts
+            flags = self._flags
+            times = array('d', sorted(
+                pts[i] for i in range(len(pts))
+                if flags[i >> 3] >> (i & 7) & 1 and pts[i] == pts[i]))
+            self._keyframes = times
+        return self._keyframes
+
+    def keyframe_before(self, t):
+        """
+        Timestamp of the last keyframe at or before t, or None if there
+        is none.
+        """
+        times = self.keyframes()
+        k = bisect.bisect_right(times, t)
+        return times[k - 1] if k else None
+
+    def keyframe_after(self, t):
+        """
+        Timestamp of the first keyframe at or after t, or None if there
+        is none.
+        """
+        times = self.keyframes()
+        k = bisect.bisect_left(times, t)
+        return times[k] if k < len(times) else None
+
+    def __repr__(self):
+        return 'PacketIndex(packets=%d, keyframes=%d)' % (
+            len(self.pts), len(self.keyframes()))
+
+
 class FFMpeg(object):
 
     """
@@ -360,21 +1142,44 @@ class FFMpeg(object):
     >>> f = FFMpeg()
     """
     DEFAULT_JPEG_QUALITY = 4
-
-    def __init__(self, ffmpeg_path=None, ffprobe_path=None):
+    LOG_TAIL_SIZE = 64 * 1024
+
+    # packed pixel formats supported by iter_frames() ->
+    # (components per pixel, struct format of a component)
+    RAW_PIXEL_FORMATS = {
+        'gray': (1, 'B'),
+        'gray16le': (1, 'H'),
+        'grayf32le': (1, 'f'),
+        'rgb24': (3, 'B'),
+        'bgr24': (3, 'B'),
+        'rgb48le': (3, 'H'),
+        'rgba': (4, 'B'),
+        'bgra': (4, 'B'),
+        'argb': (4, 'B'),
+        'abgr': (4, 'B'),
+        'rgba64le': (4, 'H'),
+    }
+
+    # sample types supported by iter_audio() ->
+    # (ffmpeg output format, struct format of a sample)
+    AUDIO_SAMPLE_FORMATS = {
+        'int16': ('s16le', 'h'),
+        'int32': ('s32le', 'i'),
+        'float32': ('f32le', 'f'),
+    }
+
+    # number of packet_index() results remembered per FFMpeg object
+    PACKET_INDEX_CACHE_SIZE = 32
+
+    def __init__(self, ffmpeg_path=None, ffprobe_path=None, probe_cache=None,
+                 capabilities_cache=None):
         """
         Initialize a new FFMpeg wrapper object. Optional parameters specify
-        the paths to ffmpeg and ffprobe utilities.
+        the paths to ffmpeg and ffprobe utilities, a
+        converter.cache.ProbeCache used to remember probe() results, and
+        the name of a JSON file used to remember the capabilities of the
+        ffmpeg binary between runs.
         """
-
-        def which(name):
-            path = os.environ.get('PATH', os.defpath)
-            for d in path.split(':'):
-                fpath = os.path.join(d, name)
-                if os.path.exists(fpath) and os.access(fpath, os.X_OK):
-                    return fpath
-            return None
-
         if ffmpeg_path is None:
             ffmpeg_path = 'ffmpeg'
 
@@ -388,6 +1193,12 @@ class FFMpeg(object):
 
         self.ffmpeg_path = ffmpeg_path
         self.ffprobe_path = ffprobe_path
+        self.probe_cache = probe_cache
+        self.capabilities_cache = capabilities_cache
+        self._capabilities = None
+        self._capabilities_lock = threading.Lock()
+        self._packet_indexes = OrderedDict()
+        self._packet_indexes_lock = threading.Lock()
 
         if not os.path.exists(self.ffmpeg_path):
             raise FFMpegError("ffmpeg binary not found: " + self.ffmpeg_path)
@@ -395,13 +1206,80 @@ class FFMpeg(object):
         if not os.path.exists(self.ffprobe_path):
             raise FFMpegError("ffprobe binary not found: " + self.ffprobe_path)
 
+    @property
+    def capabilities(self):
+        """
+        The converter.capabilities.Capabilities of the ffmpeg binary (the
+        encoders, muxers and filters it supports, and its version), or None
+        if they can't be detected. They're detected on first use, and
+        cached across FFMpeg objects (and across runs, in the
+        capabilities_cache file, if one was given).
+        """
+        with self._capabilities_lock:
+            if self._capabilities is None:
+                self._capabilities = (capabilities.get_capabilities(
+                    self.ffmpeg_path, self.capabilities_cache),)
+            return self._capabilities[0]
+
     @staticmethod
     def _spawn(cmds):
         logger.debug('Spawning ffmpeg with command: ' + ' '.join(cmds))
         return Popen(cmds, shell=False, stdin=PIPE, stdout=PIPE, stderr=PIPE,
                      close_fds=True)
 
-    def probe(self, fname, posters_as_video=True):
+    def _start(self, cmds, stats=None):
+        if stats is None:
+            return self._spawn(cmds)
+        stats.start(cmds)
+        p = self._spawn(cmds)
+        stats.spawned(p)
+        return p
+
+    @staticmethod
+    def _wait(p, stats=None):
+        if stats is None:
+            p.wait()
+        else:
+            stats.reap(p)
+
+    def _communicate(self, cmds, stats=None, sink=None):
+        """
+        Run cmds and return their (stdout, stderr) output. If stats is
+        given, it's filled with the resource usage of the process. If sink
+        is given, the standard output is passed to sink.feed() as it's
+        read instead of being collected (and b'' is returned for it).
+        """
+        p = self._start(cmds, stats)
+        if stats is None and sink is None:
+            return p.communicate()
+
+        # Popen.communicate() would reap the process, losing its rusage
+        p.stdin.close()
+        output = {p.stdout: [], p.stderr: []}
+        sel = selectors.DefaultSelector()
+        sel.register(p.stdout, selectors.EVENT_READ)
+        sel.register(p.stderr, selectors.EVENT_READ)
+        try:
+            while sel.get_map():
+                for key, _ in sel.select(JobStats.SAMPLE_INTERVAL):
+                    data = os.read(key.fd, 65536)
+                    if not data:
+                        sel.unregister(key.fileobj)
+                    elif sink is not None and key.fileobj is p.stdout:
+                        sink.feed(data)
+                    else:
+                        output[key.fileobj].append(data)
+                if stats is not None:
+                    stats.sample()
+        except BaseException:
+            p.kill()
+            raise
+        finally:
+            sel.close()
+            self._wait(p, stats)
+        return b''.join(output[p.stdout]), b''.join(output[p.stderr])
+
+    def probe(self, fname, posters_as_video=True, use_json=False, stats=None):
         """
         Examine the media file and determine its format and media streams.
         Returns the MediaInfo object, or None if the specified file is
@@ -424,22 +1302,163 @@ class FFMpeg(object):
         2
         :param posters_as_video: Take poster images (mainly for audio files) as
             A video stream, defaults to True
+        :param use_json: Have ffprobe print JSON and parse it with
+            MediaInfo.parse_ffprobe_json() instead of parsing the default
+            key=value output, defaults to False
+        :param stats: Optional JobStats object to fill in with the
+            resource usage of ffprobe
+
+        If the object has a probe_cache, results for unchanged files are
+        returned from the cache without running ffprobe.
+        """
+        key = None
+        if self.probe_cache is not None:
+            key = self.probe_cache.key(fname, posters_as_video)
+            if key is not None:
+                info = self.probe_cache.get(key)
+                if info is not None:
+                    return info
+
+        stdout_data, _ = self._communicate(self._probe_cmds(fname, use_json),
+                                           stats)
+        info = self._parse_probe(stdout_data, posters_as_video, use_json)
+
+        if info is not None and key is not None:
+            self._cache_probe(key, fname, posters_as_video, info)
+        return info
+
+    def probe_many(self, paths, max_workers=None, posters_as_video=True,
+                   use_json=False):
+        """
+        Probe many files, keeping up to max_workers ffprobe processes
+        running at the same time. Returns a generator yielding
+        (path, result) tuples in order of completion, where result is
+        what probe() returned for the path (a MediaInfo object or None),
+        or the exception it raised.
+
+        Paths are consumed lazily, so paths can be a generator walking
+        an arbitrarily large directory tree.
+
+        >>> for path, info in FFMpeg().probe_many(paths, max_workers=8):
+        ...    if isinstance(info, Exception):
+        ...        pass  # handle the error
+
+        :param max_workers: Number of concurrent ffprobe processes,
+            defaults to the number of CPUs
+        """
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+
+        paths = iter(paths)
+        pending = {}
+
+        with ThreadPoolExecutor(max_workers) as pool:
+            def submit(n):
+                for path in itertools.islice(paths, n):
+                    future = pool.submit(self.probe, path, posters_as_video,
+                                         use_json)
+                    pending[future] = path
+
+            submit(max_workers)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        result = e
+                    yield path, result
+                submit(len(done))
+
+    def packet_index(self, fname, stream='v:0', stats=None):
+        """
+        Return a PacketIndex of the packets (timestamps, byte offsets,
+        sizes and keyframe flags) of the selected stream of the media file,
+        for fast keyframe lookups. The ffprobe output is parsed as it's
+        read, into compact arrays.
+
+        Indexes are cached by file identity (see
+        converter.cache.file_identity()), so asking again for the same
+        version of a file doesn't run ffprobe.
+
+        >>> index = FFMpeg().packet_index('test1.ogg')
+        >>> index.keyframe_after(3.0)
+        5.12
+        """
+        key = self._identity(fname, stream)
+        if key is not None:
+            with self._packet_indexes_lock:
+                index = self._packet_indexes.get(key)
+                if index is not None:
+                    self._packet_indexes.move_to_end(key)
+                    return index
+
+        index = PacketIndex()
+        self._communicate([self.ffprobe_path, '-v', 'error',
+                           '-select_streams', stream,
+                           '-show_entries', 'packet=pts_time,pos,size,flags',
+                           '-of', 'compact=print_section=0', fname],
+                          stats, index)
+        index.close()
+
+        # Don't store the result if the file was modified while probing
+        if key is not None and len(index) and \
+                self._identity(fname, stream) == key:
+            with self._packet_indexes_lock:
+                self._packet_indexes[key] = index
+                while len(self._packet_indexes) > self.PACKET_INDEX_CACHE_SIZE:
+                    self._packet_indexes.popitem(last=False)
+        return index
+
+    @staticmethod
+    def _identity(fname, stream):
+        try:
+            return file_identity(fname) + (stream,)
+        except OSError:
+            return None
+
+    def keyframes(self, fname, stream='v:0', stats=None):
         """
+        Return the sorted list of keyframe timestamps (in seconds) of the
+        selected stream of the media file, or an empty list if there are
+        none. See packet_index().
 
+        >>> FFMpeg().keyframes('test1.ogg')
+        [0.0, 2.56, 5.12, ...]
+        """
+        return self.packet_index(fname, stream, stats).keyframes().tolist()
+
+    def _cache_probe(self, key, fname, posters_as_video, info):
+        # Don't store the result if the file was modified while probing
+        if self.probe_cache.key(fname, posters_as_video) == key:
+            self.probe_cache.put(key, info)
+
+    def _probe_cmds(self, fname, use_json=False):
+        cmds = [self.ffprobe_path, '-show_format', '-show_streams']
+        if use_json:
+            cmds.extend(['-print_format', 'json'])
+        cmds.append(fname)
+        return cmds
+
+    @staticmethod
+    def _parse_probe(stdout_data, posters_as_video=True, use_json=False):
         info = MediaInfo(posters_as_video)
 
-        p = self._spawn([self.ffprobe_path,
-                         '-show_format', '-show_streams', fname])
-        stdout_data, _ = p.communicate()
-        stdout_data = stdout_data.decode(console_encoding, "replace")
-        info.parse_ffprobe(stdout_data)
+        if use_json:
+            # ffprobe always writes JSON as UTF-8
+            info.parse_ffprobe_json(stdout_data.decode('utf-8', 'replace'))
+        else:
+            info.parse_ffprobe(stdout_data.decode(console_encoding, "replace"))
 
         if not info.format.format and len(info.streams) == 0:
             return None
 
         return info
 
-    def convert(self, infile, outfile, opts, timeout=10, preopts=None):
+    def convert(self, infile, outfile, opts, timeout=10, preopts=None,
+                detailed=False, deadline=None, log_tail=LOG_TAIL_SIZE, log_lines=None,
+                log_file=None, stats=None, max_rss=None):
         """
         Convert the source media (infile) according to specified options
         (a list of ffmpeg switches as strings) and save it to outfile.
@@ -447,12 +1466,33 @@ class FFMpeg(object):
         Convert returns a generator that needs to be iterated to drive the
         conversion process. The generator will periodically yield timecode
         of currently processed part of the file (ie. at which second in the
-        content is the conversion process currently).
-
-        The optional timeout argument specifies how long should the operation
-        be blocked in case ffmpeg gets stuck and doesn't report back. See
-        the documentation in Converter.convert() for more details about this
-        option.
+        content is the conversion process currently). If detailed is True,
+        it yields the ConvertProgress objects reported by ffmpeg instead.
+
+        The optional timeout argument specifies how long (in seconds of
+        wall time) should the operation be blocked in case ffmpeg gets stuck
+        and doesn't report back, and the optional deadline argument limits
+        the total conversion time. When either expires, ffmpeg is killed
+        and FFMpegTimeoutError is raised. Both are enforced by the
+        generator itself without signals, so convert can be used from
+        any thread. See the documentation in Converter.convert() for more
+        details about these options.
+
+        Progress is read from ffmpeg's machine-readable -progress output on
+        stdout, while stderr is drained separately for error reporting.
+        Closing the generator before it's exhausted kills ffmpeg.
+
+        Only the last log_tail bytes (and, if log_lines is set, at most that
+        many lines) of the ffmpeg log are kept in memory, for error
+        reporting in FFMpegConvertError.output. To keep the full log, pass
+        a file name or a binary file-like object as log_file.
+
+        If a JobStats object is passed as stats, it's filled in with the
+        resource usage of ffmpeg (CPU time, peak memory, I/O) by the time
+        the generator is exhausted. If max_rss is set, ffmpeg is killed and
+        FFMpegMemoryError is raised once its resident memory exceeds
+        max_rss bytes (checked every JobStats.SAMPLE_INTERVAL seconds, on
+        Linux only).
 
         >>> conv = FFMpeg().convert('test.ogg', '/tmp/output.mp3',
         ...    ['-acodec libmp3lame', '-vn'])
@@ -463,80 +1503,151 @@ class FFMpeg(object):
         if not os.path.exists(infile):
             raise FFMpegError("Input file doesn't exist: " + infile)
 
-        cmds = [self.ffmpeg_path]
-        if preopts:
-            cmds.extend(preopts)
-        cmds.extend(['-i', infile])
-        cmds.extend(['-max_muxing_queue_size', '500'])
-        cmds.extend(opts)
-        cmds.extend(['-y', outfile])
+        cmds = self._convert_cmds(infile, outfile, opts, preopts)
+        for progress in self._run(cmds, infile, timeout, deadline, detailed,
+                                  log_tail, log_lines, log_file, stats, max_rss):
+            yield progress
 
+    def convert_multi(self, infile, outputs, opts=None, timeout=10,
+                      preopts=None, detailed=False, deadline=None,
+                      log_tail=LOG_TAIL_SIZE, log_lines=None, log_file=None,
+                      stats=None, max_rss=None):
+        """
+        Convert the source media (infile) into several outputs with a
+        single ffmpeg process, so the source is only read and decoded once.
+        Outputs is a list of (outfile, options) tuples, where options are
+        the ffmpeg switches of that output; opts are switches shared by all
+        outputs (e.g. -filter_complex), placed right after the input.
+
+        Returns a generator like convert(); see its documentation for the
+        other arguments.
+
+        >>> conv = FFMpeg().convert_multi('test.ogg', [
+        ...    ('/tmp/output.mp3', ['-acodec', 'libmp3lame', '-vn']),
+        ...    ('/tmp/output.ogg', ['-acodec', 'libvorbis', '-vn'])])
+        >>> for timecode in conv:
+        ...    pass
+        """
+        if not os.path.exists(infile):
+            raise FFMpegError("Input file doesn't exist: " + infile)
+
+        cmds = self._convert_cmds(infile, None, opts or [], preopts)
+        for outfile, output_opts in outputs:
+            cmds.extend(['-max_muxing_queue_size', '500'])
+            cmds.extend(output_opts)
+            cmds.extend(['-y', outfile])
+        for progress in self._run(cmds, infile, timeout, deadline, detailed,
+                                  log_tail, log_lines, log_file, stats, max_rss):
+            yield progress
+
+    def _run(self, cmds, infile, timeout=10, deadline=None, detailed=False,
+             log_tail=LOG_TAIL_SIZE, log_lines=None, log_file=None,
+             stats=None, max_rss=None):
+        """
+        Run an ffmpeg conversion command, yielding its progress. See
+        convert() for the arguments.
+        """
+        if stats is None and max_rss:
+            stats = JobStats()
+
+        # open the log first, so a failure can't leave ffmpeg running
+        sink = open(log_file, 'wb') if isinstance(log_file, str) else log_file
         try:
-            p = self._spawn(cmds)
+            p = self._start(cmds, stats)
         except OSError:
+            if sink is not log_file:
+                sink.close()
             raise FFMpegError('Error while calling ffmpeg binary')
 
-        if timeout:
-            def on_sigvtalrm(*_):
-                signal.signal(signal.SIGVTALRM, signal.SIG_DFL)
-                if p.poll() is None:
-                    p.kill()
-                raise Exception('timed out while waiting for ffmpeg')
-
-            signal.signal(signal.SIGVTALRM, on_sigvtalrm)
-
         yielded = False
-        buf = ''
-        total_output = ''
-        pat = re.compile(r'time=([0-9.:]+)')
-
-        def get_timecode(out):
-            tmp = pat.findall(out)
-            if len(tmp) == 1:
-                timespec = tmp[0]
-                if ':' in timespec:
-                    timecode = 0
-                    for part in timespec.split(':'):
-                        timecode = 60 * timecode + float(part)
-                else:
-                    timecode = float(tmp[0])
-                return timecode
-            return None
+        tail = OutputTail(log_tail, log_lines, sink)
+        reader = ProgressReader()
+        sel = selectors.DefaultSelector()
+        sel.register(p.stdout, selectors.EVENT_READ)
+        sel.register(p.stderr, selectors.EVENT_READ)
+        watchdog = Watchdog(timeout, deadline)
+        sampled = time.monotonic()
 
-        while True:
-            if timeout:
-                signal.setitimer(signal.ITIMER_VIRTUAL, timeout)
-
-            ret = p.stderr.read(10)
-
-            if timeout:
-                signal.setitimer(signal.ITIMER_VIRTUAL, 0)
-
-            if not ret:
-                break
+        try:
+            while sel.get_map():
+                wait = watchdog.remaining()
+                if stats is not None:
+                    interval = sampled + JobStats.SAMPLE_INTERVAL - time.monotonic()
+                    wait = interval if wait is None else min(wait, interval)
+                events = sel.select(None if wait is None else max(wait, 0))
+
+                for key, _ in events:
+                    ret = os.read(key.fd, 65536)
+                    if not ret:
+                        sel.unregister(key.fileobj)
+                    elif key.fileobj is p.stderr:
+                        tail.feed(ret)
+                    else:
+                        for progress in reader.feed(ret):
+                            watchdog.progress()
+                            if detailed:
+                                yielded = True
+                                yield progress
+                            elif progress.timecode is not None:
+                                yielded = True
+                                yield progress.timecode
+                            # time spent by the caller isn't an ffmpeg stall
+                            watchdog.progress()
+
+                expired = watchdog.expired()
+                if expired:
+                    p.kill()
+                    raise FFMpegTimeoutError(
+                        'Timed out', ' '.join(cmds), tail.getvalue(),
+                        expired, pid=p.pid)
+
+                if stats is not None and \
+                        time.monotonic() >= sampled + JobStats.SAMPLE_INTERVAL:
+                    sampled = time.monotonic()
+                    rss = stats.sample()
+                    if max_rss and rss and rss > max_rss:
+                        p.kill()
+                        raise FFMpegMemoryError(
+                            'Memory limit exceeded', ' '.join(cmds),
+                            tail.getvalue(),
+                            'resident memory of %d bytes exceeds %d' % (
+                                rss, max_rss), pid=p.pid)
+
+            self._wait(p, stats)  # wait for process to exit
+        finally:
+            sel.close()
+            if p.returncode is None:
+                p.kill()
+                self._wait(p, stats)
+            if sink is not log_file:
+                sink.close()
+
+        self._check_convert_output(cmds, infile, tail.getvalue(), yielded,
+                                   p.returncode, p.pid, tail.total_bytes)
+
+    def _convert_cmds(self, infile, outfile, opts, preopts=None):
+        cmds = [self.ffmpeg_path, '-nostats', '-progress', 'pipe:1']
+        if preopts:
+            cmds.extend(preopts)
+        cmds.extend(['-i', infile])
+        if outfile is None:
+            # outputs are added by the caller
+            cmds.extend(opts)
+            return cmds
+        cmds.extend(['-max_muxing_queue_size', '500'])
+        cmds.extend(opts)
+        cmds.extend(['-y', outfile])
+        return cmds
 
-            ret = ret.decode(console_encoding, "replace")
-            total_output += ret
-            buf += ret
-            if '\r' in buf:
-                line, buf = buf.split('\r', 1)
-                timecode = get_timecode(line)
-                if timecode is not None:
-                    yielded = True
-                    yield timecode
-        if not yielded:
-            # There may have been a single time, check it
-            timecode = get_timecode(total_output)
-            if timecode is not None:
-                yielded = True
-                yield timecode
-
-        if timeout:
-            signal.signal(signal.SIGALRM, signal.SIG_DFL)
-
-        p.communicate()  # wait for process to exit
-
-        if total_output == '':
+    @staticmethod
+    def _check_convert_output(cmds, infile, total_output, yielded, returncode,
+                              pid, output_bytes=None):
+        """
+        Raise the appropriate exception if the ffmpeg process that ran cmds
+        failed, judging by its output (the retained tail, and the size of
+        the whole output, if known) and exit code.
+        """
+        if total_output == '' and not output_bytes:
             raise FFMpegError('Error while calling ffmpeg binary')
 
         cmd = ' '.join(cmds)
@@ -546,20 +1657,20 @@ class FFMpeg(object):
             if line.startswith('Received signal'):
                 # Received signal 15: terminating.
                 raise FFMpegConvertError(
-                    line.split(':')[0], cmd, total_output, pid=p.pid)
+                    line.split(':')[0], cmd, total_output, pid=pid)
             if line.startswith(infile + ': '):
                 err = line[len(infile) + 2:]
                 raise FFMpegConvertError('Encoding error', cmd, total_output,
-                                         err, pid=p.pid)
+                                         err, pid=pid)
             if line.startswith('Error while '):
                 raise FFMpegConvertError('Encoding error', cmd, total_output,
-                                         line, pid=p.pid)
+                                         line, pid=pid)
             if not yielded:
                 raise FFMpegConvertError('Unknown ffmpeg error', cmd,
-                                         total_output, line, pid=p.pid)
-        if p.returncode != 0:
-            raise FFMpegConvertError('Exited with code %d' % p.returncode, cmd,
-                                     total_output, pid=p.pid)
+                                         total_output, line, pid=pid)
+        if returncode != 0:
+            raise FFMpegConvertError('Exited with code %d' % returncode, cmd,
+                                     total_output, pid=pid)
 
     def thumbnail(self, fname, time, outfile,
                   size=None, quality=DEFAULT_JPEG_QUALITY):
@@ -575,7 +1686,9 @@ class FFMpeg(object):
         """
         return self.thumbnails(fname, [(time, outfile, size, quality)])
 
-    def thumbnails(self, fname, option_list, output_seeking=False):
+    def thumbnails(self, fname, option_list, output_seeking=False, stats=None,
+                   input_seeking=False, max_workers=None, keyframes_only=False,
+                   stats_list=None):
         """
         Create one or more thumbnails of video.
         @param option_list: a list of tuples like:
@@ -584,6 +1697,21 @@ class FFMpeg(object):
         @param output_seeking: a boolean whether the seeking should be done
             on the output (slow but doesn't reset the timestamps) or on the
             input
+        @param stats: optional JobStats object to fill in with the
+            resource usage of ffmpeg. Not supported with input_seeking,
+            which runs several processes; use stats_list instead.
+        @param input_seeking: seek to every thumbnail separately, before
+            decoding, instead of decoding the video up to the last
+            thumbnail. The thumbnails are divided among up to max_workers
+            ffmpeg processes running in parallel. This is much faster for
+            several thumbnails of a long video.
+        @param max_workers: number of ffmpeg processes used with
+            input_seeking, defaults to the number of CPUs
+        @param keyframes_only: with input_seeking, decode only keyframes
+            (-skip_frame nokey), so each thumbnail is the first keyframe
+            at or after its time. Faster still, but less exact.
+        @param stats_list: optional list to append a JobStats object to
+            for every ffmpeg process run, in either mode.
 
         >>> FFMpeg().thumbnails('test1.ogg', [(5, '/tmp/shot.png', '320x240'),
         >>>                                   (10, '/tmp/shot2.png', None, 5)])
@@ -591,6 +1719,145 @@ class FFMpeg(object):
         if not os.path.exists(fname):
             raise IOError('No such file: ' + fname)
 
+        if input_seeking:
+            if stats is not None:
+                raise ValueError('Use stats_list with input_seeking')
+            self._thumbnails_parallel(fname, option_list, stats_list,
+                                      max_workers, keyframes_only)
+            return
+
+        cmds = self._thumbnails_cmds(fname, option_list, output_seeking)
+
+        if stats is None and stats_list is not None:
+            stats = JobStats()
+        try:
+            _, stderr_data = self._communicate(cmds, stats)
+        finally:
+            if stats_list is not None:
+                stats_list.append(stats)
+        self._check_thumbnails_output(option_list, stderr_data)
+
+    def _thumbnails_parallel(self, fname, option_list, stats_list, max_workers,
+                             keyframes_only):
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        n = max(1, min(max_workers, len(option_list)))
+
+        def run(batch):
+            job_stats = JobStats() if stats_list is not None else None
+            cmds = self._thumbnails_seek_cmds(fname, batch, keyframes_only)
+            try:
+                _, stderr_data = self._communicate(cmds, job_stats)
+            finally:
+                if job_stats is not None:
+                    stats_list.append(job_stats)
+            self._check_thumbnails_output(batch, stderr_data)
+
+        with ThreadPoolExecutor(n) as pool:
+            futures = [pool.submit(run, option_list[i::n]) for i in range(n)]
+        for future in futures:
+            future.result()
+
+    def thumbnail_data(self, fname, time, size=None,
+                       quality=DEFAULT_JPEG_QUALITY, buf=None):
+        """
+        Create a JPEG thumbnail of media file in memory, without writing
+        it to disk. Returns the image as bytes or, if buf (a writable
+        buffer like a bytearray or memoryview) is given, stores it at the
+        start of buf and returns its size.
+
+        See the documentation of `converter.FFMpeg.thumbnail()` for details
+        of the arguments.
+
+        >>> jpeg = FFMpeg().thumbnail_data('test1.ogg', 5, '320x240')
+        """
+        bufs = None if buf is None else [buf]
+        return self.thumbnails_data(fname, [time], size, quality,
+                                    bufs=bufs)[0]
+
+    def thumbnails_data(self, fname, times, size=None,
+                        quality=DEFAULT_JPEG_QUALITY, max_workers=None,
+                        bufs=None):
+        """
+        Create JPEG thumbnails of video at the given times (in seconds)
+        in memory. ffmpeg seeks to every time separately and streams the
+        images to a pipe (-f image2pipe), so nothing is written to disk.
+        The times are divided among up to max_workers ffmpeg processes
+        running in parallel (defaults to the number of CPUs).
+
+        Returns the list of images (as bytes) in the order of times. If
+        bufs (a list of writable buffers, one per time) is given, every
+        image is stored at the start of its buffer instead, and the list
+        of their sizes is returned. FFMpegError is raised if an image
+        doesn't fit its buffer. Images are stored as soon as they're read
+        from the pipe, so with bufs no more than one image per process is
+        held in memory.
+
+        >>> shots = FFMpeg().thumbnails_data('test1.ogg', [5, 10, 15])
+        """
+        if not os.path.exists(fname):
+            raise IOError('No such file: ' + fname)
+        if bufs is not None and len(bufs) != len(times):
+            raise ValueError('Expected one buffer per thumbnail')
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        n = max(1, min(max_workers, len(times)))
+        results = [None] * len(times)
+
+        def run(first):
+            # every image is stored as soon as it's read from the pipe
+            positions = range(first, len(times), n)
+            done = []
+
+            def store(image):
+                if len(done) == len(positions):
+                    raise FFMpegError('Unexpected thumbnail in ffmpeg output')
+                i = positions[len(done)]
+                if bufs is None:
+                    results[i] = image
+                else:
+                    view = memoryview(bufs[i]).cast('B')
+                    if len(image) > len(view):
+                        raise FFMpegError(
+                            'Thumbnail of %d bytes does not fit the buffer '
+                            'of %d bytes' % (len(image), len(view)))
+                    view[:len(image)] = image
+                    results[i] = len(image)
+                done.append(i)
+
+            cmds = self._thumbnails_pipe_cmds(fname, times[first::n], size,
+                                              quality)
+            reader = JpegReader(store)
+            _, stderr_data = self._communicate(cmds, sink=reader)
+            if len(done) != len(positions) or reader.pending():
+                raise FFMpegError('Error creating thumbnail: %s' %
+                                  stderr_data.decode(console_encoding, 'replace'))
+
+        with ThreadPoolExecutor(n) as pool:
+            futures = [pool.submit(run, i) for i in range(n)]
+        for future in futures:
+            future.result()
+        return results
+
+    def _thumbnails_pipe_cmds(self, fname, times, size=None,
+                              quality=DEFAULT_JPEG_QUALITY):
+        # Seek every input separately, take a frame of each and join
+        # them into one stream of JPEG images on stdout
+        cmds = [self.ffmpeg_path]
+        for t in times:
+            cmds.extend(['-ss', str(t), '-i', fname])
+        graph = ''.join('[%d:v:0]trim=end_frame=1[v%d];' % (i, i)
+                        for i in range(len(times)))
+        graph += ''.join('[v%d]' % i for i in range(len(times)))
+        graph += 'concat=n=%d:v=1:a=0' % len(times)
+        if size:
+            graph += ',scale=%s' % str(size).replace('x', ':')
+        cmds.extend(['-filter_complex', graph + '[out]', '-map', '[out]',
+                     '-vsync', 'passthrough', '-f', 'image2pipe',
+                     '-c:v', 'mjpeg', '-q:v', str(quality), 'pipe:1'])
+        return cmds
+
+    def _thumbnails_cmds(self, fname, option_list, output_seeking=False):
         output_seeking = len(option_list) > 1 or output_seeking
 
         cmds = [self.ffmpeg_path]
@@ -610,11 +1877,240 @@ class FFMpeg(object):
                 cmds.extend(['-ss', str(thumb[0]), thumb[1]])
             else:
                 cmds.append(thumb[1])
+        return cmds
 
-        p = self._spawn(cmds)
-        _, stderr_data = p.communicate()
+    def _thumbnails_seek_cmds(self, fname, option_list, keyframes_only=False):
+        # Open the file once per thumbnail, seeking each input separately
+        cmds = [self.ffmpeg_path]
+        for thumb in option_list:
+            if keyframes_only:
+                cmds.extend(['-skip_frame', 'nokey'])
+            cmds.extend(['-ss', str(thumb[0]), '-i', fname])
+        cmds.append('-y')
+        for i, thumb in enumerate(option_list):
+            cmds.extend(['-map', '%d:v:0' % i])
+            if len(thumb) > 2 and thumb[2]:
+                cmds.extend(['-s', str(thumb[2])])
+            cmds.extend([
+                '-f', 'image2', '-vframes', '1',
+                '-q:v', str(
+                    FFMpeg.DEFAULT_JPEG_QUALITY if len(
+                        thumb) < 4 else str(thumb[3])),
+                thumb[1],
+            ])
+        return cmds
+
+    @staticmethod
+    def _check_thumbnails_output(option_list, stderr_data):
         if stderr_data == '':
             raise FFMpegError('Error while calling ffmpeg binary')
         stderr_data.decode(console_encoding, "replace")
         if any(not os.path.exists(option[1]) for option in option_list):
             raise FFMpegError('Error creating thumbnail: %s' % stderr_data)
+
+    def iter_frames(self, fname, pix_fmt='rgb24', size=None, fps=None,
+                    start=None, duration=None, timeout=10, deadline=None):
+        """
+        Decode the video of the media file and yield its frames as
+        uncompressed images, streamed from ffmpeg through a pipe
+        (-f rawvideo pipe:1) instead of being written to disk.
+
+        Frames are numpy arrays of shape (height, width, components), or
+        (height, width) for gray formats, with a dtype matching pix_fmt
+        (e.g. uint8 for rgb24, uint16 for rgb48le). Without numpy,
+        they're memoryviews of the same shape instead.
+
+        To avoid allocating memory for every frame, the same array is
+        reused: ffmpeg's output is read straight into it, so each frame
+        is only valid until the next one is requested. Copy it to keep it.
+
+        @param pix_fmt: pixel format, one of RAW_PIXEL_FORMATS
+        @param size: 'WxH' size to scale the frames to, defaults to the
+            size of the video reported by probe()
+        @param fps: frame rate to resample the video to (frames are
+            dropped or duplicated), defaults to the rate of the video
+        @param start: time (in seconds) of the first frame
+        @param duration: time span (in seconds) to decode
+        @param timeout: how long to wait for ffmpeg to produce data, and
+        @param deadline: how long it may run in total, as in convert().
+            The time spent by the caller between frames doesn't count
+            towards the timeout.
+
+        >>> for frame in FFMpeg().iter_frames('test1.ogg', size='320x200'):
+        ...    frame.mean()
+        """
+        if pix_fmt not in self.RAW_PIXEL_FORMATS:
+            raise FFMpegError('Unsupported pixel format: %s' % pix_fmt)
+        if not os.path.exists(fname):
+            raise IOError('No such file: ' + fname)
+
+        if size:
+            width, height = [int(x) for x in str(size).split('x')]
+        else:
+            info = self.probe(fname)
+            if info is None or info.video is None:
+                raise FFMpegError('No video stream in ' + fname)
+            width, height = info.video.video_width, info.video.video_height
+            if info.video.metadata.get('rotate') in ('90', '270', '-90'):
+                width, height = height, width  # ffmpeg rotates the frames
+
+        components, typecode = self.RAW_PIXEL_FORMATS[pix_fmt]
+        shape = (height, width, components) if components > 1 else (height, width)
+        buf = bytearray(width * height * components * struct.calcsize(typecode))
+        if numpy is not None:
+            frame = numpy.frombuffer(buf, numpy.dtype('<' + typecode)).reshape(shape)
+        else:
+            frame = memoryview(buf).cast(typecode, shape)
+
+        preopts = ['-ss', str(start)] if start is not None else []
+        opts = ['-map', '0:v:0', '-an', '-sn']
+        if duration is not None:
+            opts.extend(['-t', str(duration)])
+        if fps:
+            opts.extend(['-r', str(fps)])
+        opts.extend(['-s', '%dx%d' % (width, height), '-pix_fmt', pix_fmt,
+                     '-f', 'rawvideo', 'pipe:1'])
+        cmds = [self.ffmpeg_path] + preopts + ['-i', fname] + opts
+
+        for filled in self._read_blocks(cmds, buf, timeout, deadline):
+            if filled < len(buf):
+                raise FFMpegConvertError('Incomplete frame', ' '.join(cmds),
+                                         '', '%d of %d bytes' % (filled, len(buf)))
+            yield frame
+
+    def iter_audio(self, fname, samplerate=None, channels=None, dtype='int16',
+                   start=None, duration=None, block_size=65536, timeout=10,
+                   deadline=None):
+        """
+        Decode the audio of the media file and yield it as blocks of PCM
+        samples, streamed from ffmpeg through a pipe (-f s16le pipe:1 or
+        similar) instead of being written to a temporary file.
+
+        Blocks are numpy arrays of shape (frames, channels) holding
+        block_size frames each, except for the last one, which may be
+        shorter. Without numpy, they're memoryviews of the same shape.
+        The same buffer is reused for every block, so each is only valid
+        until the next one is requested.
+
+        @param samplerate: sample rate to resample the audio to, defaults
+            to the rate reported by probe()
+        @param channels: number of channels to mix the audio to, defaults
+            to the number reported by probe()
+        @param dtype: sample type, one of AUDIO_SAMPLE_FORMATS ('int16',
+            'int32' or 'float32', the latter in range -1..1)
+        @param start: time (in seconds) to start at
+        @param duration: time span (in seconds) to decode
+        @param block_size: number of frames (samples of all the channels)
+            per block
+        @param timeout: how long to wait for ffmpeg to produce data, and
+        @param deadline: how long it may run in total, as in iter_frames()
+
+        >>> for block in FFMpeg().iter_audio('test1.ogg', 8000, 1, 'float32'):
+        ...    abs(block).max()
+        """
+        if dtype not in self.AUDIO_SAMPLE_FORMATS:
+            raise FFMpegError('Unsupported sample type: %s' % dtype)
+        if not os.path.exists(fname):
+            raise IOError('No such file: ' + fname)
+
+        if not samplerate or not channels:
+            info = self.probe(fname)
+            if info is None or info.audio is None:
+                raise FFMpegError('No audio stream in ' + fname)
+            samplerate = samplerate or int(info.audio.audio_samplerate)
+            channels = channels or info.audio.audio_channels
+
+        fmt, typecode = self.AUDIO_SAMPLE_FORMATS[dtype]
+        frame_size = channels * struct.calcsize(typecode)
+        buf = bytearray(block_size * frame_size)
+        if numpy is not None:
+            block = numpy.frombuffer(buf, numpy.dtype('<' + typecode)).reshape(
+                (block_size, channels))
+        else:
+            block = memoryview(buf).cast(typecode, (block_size, channels))
+
+        cmds = [self.ffmpeg_path]
+        if start is not None:
+            cmds.extend(['-ss', str(start)])
+        cmds.extend(['-i', fname, '-map', '0:a:0', '-vn', '-sn'])
+        if duration is not None:
+            cmds.extend(['-t', str(duration)])
+        cmds.extend(['-ar', str(samplerate), '-ac', str(channels),
+                     '-f', fmt, 'pipe:1'])
+
+        for filled in self._read_blocks(cmds, buf, timeout, deadline):
+            frames = filled // frame_size
+            if frames == block_size:
+                yield block
+            elif frames and numpy is not None:
+                yield block[:frames]
+            elif frames:
+                # memoryviews can't slice several dimensions
+                yield memoryview(buf)[:frames * frame_size].cast(
+                    typecode, (frames, channels))
+
+    def _read_blocks(self, cmds, buf, timeout=10, deadline=None):
+        """
+        Run cmds, reading their standard output straight into buf. Yields
+        the number of bytes in buf each time it's been filled, and once
+        more for the remaining data (if any) when the output ends. The
+        caller has to process buf before asking for the next block.
+        """
+        try:
+            p = self._spawn(cmds)
+        except OSError:
+            raise FFMpegError('Error while calling ffmpeg binary')
+        p.stdin.close()
+
+        view = memoryview(buf)
+        tail = OutputTail(self.LOG_TAIL_SIZE)
+        sel = selectors.DefaultSelector()
+        sel.register(p.stdout, selectors.EVENT_READ)
+        sel.register(p.stderr, selectors.EVENT_READ)
+        watchdog = Watchdog(timeout, deadline)
+        filled = 0
+
+        try:
+            while sel.get_map():
+                wait = watchdog.remaining()
+                for key, _ in sel.select(None if wait is None else max(wait, 0)):
+                    if key.fileobj is p.stderr:
+                        ret = os.read(key.fd, 65536)
+                        if ret:
+                            tail.feed(ret)
+                        else:
+                            sel.unregister(key.fileobj)
+                        continue
+
+                    n = os.readv(key.fd, [view[filled:]])
+                    if not n:
+                        sel.unregister(key.fileobj)
+                        continue
+                    filled += n
+                    watchdog.progress()
+                    if filled == len(view):
+                        filled = 0
+                        yield len(view)
+                        watchdog.progress()
+
+                expired = watchdog.expired()
+                if expired:
+                    p.kill()
+                    raise FFMpegTimeoutError(
+                        'Timed out', ' '.join(cmds), tail.getvalue(),
+                        expired, pid=p.pid)
+
+            p.wait()
+        finally:
+            sel.close()
+            view.release()
+            if p.returncode is None:
+                p.kill()
+                p.wait()
+
+        if p.returncode != 0:
+            raise FFMpegConvertError('Exited with code %d' % p.returncode,
+                                     ' '.join(cmds), tail.getvalue(),
+                                     pid=p.pid)
+        if filled:
+            yield filled
@@ -1,10 +1,25 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from six import with_metaclass
 
 format_list = list()
 
 
+def _flag(value):
+    """
+    Parse a boolean option given as a bool, an int or a string such as
+    '1', '0', 'true', 'false', 'yes' or 'no'.
+    """
+    if isinstance(value, str):
+        v = value.strip().lower()
+        if v in ('1', 'true', 'yes', 'on'):
+            return True
+        if v in ('0', 'false', 'no', 'off'):
+            return False
+    elif isinstance(value, int):
+        return bool(value)
+    raise ValueError('Invalid flag: %r' % (value,))
+
+
 class MetaBaseFormat(type):
 
     def __new__(mcl, name, bases, dct):
@@ -20,16 +35,18 @@ class MetaBaseFormat(type):
         return sub_class
 
 
-class BaseFormat(with_metaclass(MetaBaseFormat, object)):
+class BaseFormat(object, metaclass=MetaBaseFormat):
 
     """
     Base format class.
 
-    Supported formats are: ogg, avi, mkv, webm, flv, mov, mp4, mpeg, wmv
+    Supported formats are: ogg, avi, mkv, webm, flv, mov, mp4, mpeg, wmv,
+    hls, dash
     """
 
     format_name = None
     ffmpeg_format_name = None
+    ffmpeg_min_version = None  # oldest ffmpeg release the options work with
     format_options = {
         'format': str
     }
@@ -43,6 +60,13 @@ class BaseFormat(with_metaclass(MetaBaseFormat, object)):
         optlist.extend(self._format_specific_produce_ffmpeg_list(safe))
         return optlist
 
+    def required_ffmpeg_version(self, opt):
+        """
+        Oldest ffmpeg release (as a version tuple) the options in opt work
+        with, or None if any release does.
+        """
+        return self.ffmpeg_min_version
+
     def _format_specific_parse_options(self, safe):
         return safe
 
@@ -167,3 +191,74 @@ class WmvFormat(BaseFormat):
     """
     format_name = 'wmv'
     ffmpeg_format_name = 'msmpeg4'
+
+
+class HlsFormat(BaseFormat):
+
+    """
+    HTTP Live Streaming: the output file is an m3u8 playlist of media
+    segments, written next to it unless segment_filename says otherwise.
+    """
+    format_name = 'hls'
+    ffmpeg_format_name = 'hls'
+    format_options = BaseFormat.format_options.copy()
+    format_options.update({
+        'segment_duration': float,  # target segment duration in seconds
+        'segment_type': str,  # 'mpegts' (default) or 'fmp4' (ffmpeg 3.4+)
+        'segment_filename': str,  # printf-style pattern of segment files
+        'playlist_type': str,  # 'vod' or 'event'
+    })
+
+    def required_ffmpeg_version(self, opt):
+        if self.safe_options(opt).get('segment_type') == 'fmp4':
+            return (3, 4)  # -hls_segment_type
+        return self.ffmpeg_min_version
+
+    def _format_specific_produce_ffmpeg_list(self, safe):
+        optlist = []
+        if safe.get('segment_duration', 0) > 0:
+            optlist.extend(['-hls_time', '%g' % safe['segment_duration']])
+        if safe.get('segment_type') == 'fmp4':
+            optlist.extend(['-hls_segment_type', 'fmp4'])
+        if 'segment_filename' in safe:
+            optlist.extend(['-hls_segment_filename', safe['segment_filename']])
+        if safe.get('playlist_type') in ('vod', 'event'):
+            optlist.extend(['-hls_playlist_type', safe['playlist_type']])
+        return optlist
+
+
+class DashFormat(BaseFormat):
+
+    """
+    MPEG-DASH: the output file is an MPD manifest of fragmented MP4
+    init and media segments, written next to it and addressed with a
+    SegmentTemplate.
+    """
+    format_name = 'dash'
+    ffmpeg_format_name = 'dash'
+    ffmpeg_min_version = (4, 0)  # -seg_duration, -hls_playlist
+    format_options = BaseFormat.format_options.copy()
+    format_options.update({
+        'segment_duration': float,  # target segment duration in seconds
+        'use_timeline': _flag,  # SegmentTimeline instead of fixed durations
+        'init_segment_name': str,  # template of init segment names
+        'media_segment_name': str,  # template of media segment names
+        'adaptation_sets': str,  # e.g. 'id=0,streams=v id=1,streams=a'
+        'hls_playlist': _flag,  # also write HLS playlists of the segments
+    })
+
+    def _format_specific_produce_ffmpeg_list(self, safe):
+        optlist = ['-use_template', '1']
+        if safe.get('segment_duration', 0) > 0:
+            optlist.extend(['-seg_duration', '%g' % safe['segment_duration']])
+        if 'use_timeline' in safe:
+            optlist.extend(['-use_timeline', '1' if safe['use_timeline'] else '0'])
+        if 'init_segment_name' in safe:
+            optlist.extend(['-init_seg_name', safe['init_segment_name']])
+        if 'media_segment_name' in safe:
+            optlist.extend(['-media_seg_name', safe['media_segment_name']])
+        if 'adaptation_sets' in safe:
+            optlist.extend(['-adaptation_sets', safe['adaptation_sets']])
+        if safe.get('hls_playlist'):
+            optlist.extend(['-hls_playlist', '1'])
+        return optlist
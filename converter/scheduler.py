@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+
+"""
+Running many Converter jobs concurrently.
+"""
+
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+
+from converter import ConversionProfile
+
+logger = logging.getLogger(__name__)
+
+
+class ConversionCancelled(Exception):
+    pass
+
+
+class ConversionJob(object):
+
+    """
+    A job submitted to a ConversionQueue. The attributes are:
+      * id - sequential job number
+      * kind - 'convert', 'segment' or 'thumbnails'
+      * priority - higher priorities run first
+      * status - 'pending', 'running', 'done', 'failed' or 'cancelled'
+      * progress - fraction (0..1) of the job completed so far
+      * speed - current encoding speed as a multiple of realtime
+      * eta - estimated seconds until the job is done
+      * threads - number of threads the job's encoders were given
+      * duration - media duration in seconds, if known
+      * error - the exception that failed the job, if any
+      * submitted, started, finished - time.time() timestamps
+    """
+
+    def __init__(self, id, kind, args, kwargs, priority=0):
+        self.id = id
+        self.kind = kind
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.status = 'pending'
+        self.progress = 0.0
+        self.speed = None
+        self.eta = None
+        self.threads = None
+        self.duration = None
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self._cancelled = False
+        self._done = threading.Event()
+
+    def cancel(self):
+        """
+        Cancel the job. A pending job won't be started; a running job's
+        ffmpeg process is killed at its next progress update.
+        """
+        self._cancelled = True
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Wait for the job to finish. Returns True if it did, False on
+        timeout.
+        """
+        return self._done.wait(timeout)
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return None
+        return (self.finished or time.time()) - self.started
+
+    def __repr__(self):
+        return 'ConversionJob(id=%d, kind=%s, status=%s, progress=%.2f)' % (
+            self.id, self.kind, self.status, self.progress)
+
+
+class ConversionQueue(object):
+
+    """
+    Priority queue of Converter jobs run by a bounded pool of worker
+    threads (each job drives its own ffmpeg process).
+
+    Concurrency is derived from the number of CPU cores: every job gets
+    threads_per_job encoder threads (passed to ffmpeg as -threads), and
+    max_workers jobs run at the same time, so that together they don't
+    oversubscribe the machine. By default jobs get up to 4 threads each
+    (encoders scale sub-linearly beyond that, so several narrower jobs
+    give more throughput than one wide one), and the pool is sized to
+    fill all cores.
+
+    >>> queue = ConversionQueue(Converter())
+    >>> job = queue.convert('test1.ogg', '/tmp/output.mkv', options)
+    >>> job.wait()
+    >>> queue.stats()
+    >>> queue.shutdown()
+    """
+
+    DEFAULT_THREADS_PER_JOB = 4
+
+    def __init__(self, converter, max_workers=None, threads_per_job=None,
+                 cores=None):
+        """
+        :param converter: Converter object used to run the jobs
+        :param max_workers: Number of jobs running at the same time
+        :param threads_per_job: Number of encoder threads per job
+        :param cores: Number of cores to plan for, defaults to all of them
+        """
+        cores = cores or os.cpu_count() or 1
+        if threads_per_job is None:
+            if max_workers:
+                threads_per_job = max(1, cores // max_workers)
+            else:
+                threads_per_job = min(cores, self.DEFAULT_THREADS_PER_JOB)
+        if max_workers is None:
+            max_workers = max(1, cores // threads_per_job)
+
+        self.converter = converter
+        self.cores = cores
+        self.max_workers = max_workers
+        self.threads_per_job = threads_per_job
+
+        self._heap = []
+        self._counter = itertools.count(1)
+        self._profiles = {}  # profile -> (profile with threads, threads)
+        self._jobs = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._closed = False
+        self._started = time.time()
+        self._workers = []
+        for i in range(max_workers):
+            t = threading.Thread(target=self._worker,
+                                 name='ConversionQueue-%d' % i)
+            t.daemon = True
+            t.start()
+            self._workers.append(t)
+
+    def submit(self, kind, args, kwargs=None, priority=0):
+        """
+        Queue a call of Converter.<kind>(*args, **kwargs) and return its
+        ConversionJob.
+        """
+        if kind not in ('convert', 'segment', 'thumbnails'):
+            raise ValueError('Unsupported job kind: %s' % kind)
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('ConversionQueue has been shut down')
+            job = ConversionJob(next(self._counter), kind, args,
+                                dict(kwargs or {}), priority)
+            self._jobs.append(job)
+            heapq.heappush(self._heap, (-priority, job.id, job))
+            self._wakeup.notify()
+        return job
+
+    def convert(self, infile, outfile, options, priority=0, **kwargs):
+        """
+        Queue Converter.convert(infile, outfile, options, **kwargs).
+        Unless options (a dict or a ConversionProfile) set 'threads', it's
+        set to threads_per_job.
+        """
+        return self.submit('convert', (infile, outfile, options), kwargs,
+                           priority)
+
+    def segment(self, infile, working_directory, output_file,
+                output_directory, options, priority=0, **kwargs):
+        """
+        Queue Converter.segment(...).
+        """
+        return self.submit('segment', (infile, working_directory, output_file,
+                                       output_directory, options), kwargs,
+                           priority)
+
+    def thumbnails(self, fname, option_list, priority=0, **kwargs):
+        """
+        Queue Converter.thumbnails(fname, option_list).
+        """
+        return self.submit('thumbnails', (fname, option_list), kwargs,
+                           priority)
+
+    def jobs(self):
+        with self._lock:
+            return list(self._jobs)
+
+    def stats(self):
+        """
+        Aggregate statistics: job counts by status, plus
+          * media_seconds - media duration of the finished jobs
+          * busy_seconds - wall time spent in finished jobs
+          * elapsed - wall time since the queue was created
+          * throughput - media seconds converted per second of elapsed
+            time, summed over all workers (the aggregate realtime factor)
+        """
+        with self._lock:
+            jobs = list(self._jobs)
+        stats = dict((s, 0) for s in ('pending', 'running', 'done', 'failed',
+                                      'cancelled'))
+        media = busy = 0.0
+        for job in jobs:
+            stats[job.status] += 1
+            if job.status == 'done':
+                media += job.duration or 0.0
+                busy += job.elapsed or 0.0
+        elapsed = time.time() - self._started
+        stats.update({
+            'submitted': len(jobs),
+            'media_seconds': media,
+            'busy_seconds': busy,
+            'elapsed': elapsed,
+            'throughput': media / elapsed if elapsed > 0 else 0.0,
+        })
+        return stats
+
+    def shutdown(self, wait=True, cancel_pending=False):
+        """
+        Stop accepting jobs, and let the workers exit once the queue is
+        empty. If cancel_pending is True, queued jobs are cancelled
+        instead of run.
+        """
+        with self._lock:
+            self._closed = True
+            if cancel_pending:
+                for _, _, job in self._heap:
+                    job.cancel()
+            self._wakeup.notify_all()
+        if wait:
+            for t in self._workers:
+                t.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    def _next_job(self):
+        with self._lock:
+            while not self._heap:
+                if self._closed:
+                    return None
+                self._wakeup.wait()
+            return heapq.heappop(self._heap)[2]
+
+    def _worker(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            if job.cancelled:
+                self._finish(job, 'cancelled')
+                continue
+            job.status = 'running'
+            job.started = time.time()
+            try:
+                self._run(job)
+            except ConversionCancelled:
+                self._finish(job, 'cancelled')
+            except Exception as e:
+                logger.warning('Job %d failed: %s' % (job.id, e))
+                job.error = e
+                self._finish(job, 'failed')
+            else:
+                job.progress = 1.0
+                job.eta = 0.0
+                self._finish(job, 'done')
+
+    def _finish(self, job, status):
+        job.status = status
+        job.finished = time.time()
+        job._done.set()
+
+    def _threaded_profile(self, profile):
+        """
+        The profile, recompiled with threads set to threads_per_job unless
+        it sets them, and the number of threads. Profiles are only
+        recompiled once.
+        """
+        with self._lock:
+            entry = self._profiles.get(profile)
+        if entry is None:
+            options = profile.options
+            if 'threads' in options:
+                entry = (profile, options['threads'])
+            else:
+                options['threads'] = self.threads_per_job
+                entry = (self.converter.compile_profile(options),
+                         self.threads_per_job)
+            with self._lock:
+                entry = self._profiles.setdefault(profile, entry)
+        return entry
+
+    def _run(self, job):
+        c = self.converter
+        if job.kind == 'thumbnails':
+            c.thumbnails(*job.args, **job.kwargs)
+            return
+
+        kwargs = dict(job.kwargs, progress_events=True)
+        if job.kind == 'convert':
+            infile, outfile, options = job.args
+            if isinstance(options, dict):
+                if 'threads' not in options:
+                    options = dict(options, threads=self.threads_per_job)
+                job.threads = options['threads']
+            elif isinstance(options, ConversionProfile):
+                options, job.threads = self._threaded_profile(options)
+            gen = c.convert(infile, outfile, options, **kwargs)
+        else:
+            gen = c.segment(*job.args, **kwargs)
+
+        try:
+            for event in gen:
+                if job.duration is None:
+                    job.duration = event.duration
+                job.progress = min(1.0, event.fraction)
+                job.speed = event.speed
+                job.eta = event.eta
+                if job.cancelled:
+                    raise ConversionCancelled()
+        finally:
+            gen.close()
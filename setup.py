@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-from distutils.core import setup, Command
+from setuptools import setup, Command
 import os
 
 
@@ -53,7 +53,5 @@ setup(
         'converter.codecs',
     ],
 
-    setup_requires=[
-        'six',
-    ],
+    python_requires='>=3.7',
 )
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+"""
+Micro-benchmarks for the parts of the library that run in Python rather
+than in the ffmpeg binaries, and for the ways the library drives them.
+
+    python benchmark.py [name ...]
+
+Without arguments all benchmarks are run. The ones that need the ffmpeg
+binaries are skipped if they aren't found in $PATH.
+"""
+
+# modify the path so that parent directory is in it
+import sys
+
+sys.path.append('../')
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import timeit
+
+from converter import ffmpeg, Converter
+
+
+def _probe_output(streams, tags):
+    """
+    Build equivalent flat and JSON ffprobe outputs for a file with the
+    given number of streams, each carrying the given number of tags.
+    """
+    flat = []
+    data = {'streams': [], 'format': {}}
+    for i in range(streams):
+        stream = {
+            'index': i,
+            'codec_name': 'h264' if i % 2 == 0 else 'aac',
+            'codec_long_name': 'codec %d' % i,
+            'codec_type': 'video' if i % 2 == 0 else 'audio',
+            'r_frame_rate': '30000/1001',
+            'avg_frame_rate': '30000/1001',
+            'start_time': '0.000000',
+            'duration': '3600.000000',
+            'bit_rate': '128000',
+            'disposition': {'default': 1, 'forced': 0, 'attached_pic': 0},
+            'tags': dict(('tag%d' % t, 'value %d' % t) for t in range(tags)),
+        }
+        if i % 2 == 0:
+            stream.update({'width': 1920, 'height': 1080, 'pix_fmt': 'yuv420p',
+                           'sample_aspect_ratio': '1:1',
+                           'display_aspect_ratio': '16:9'})
+        else:
+            stream.update({'sample_rate': '48000', 'channels': 2})
+        data['streams'].append(stream)
+
+        flat.append('[STREAM]')
+        for k, v in stream.items():
+            if k == 'disposition':
+                flat.extend('DISPOSITION:%s=%s' % d for d in v.items())
+            elif k == 'tags':
+                flat.extend('TAG:%s=%s' % t for t in v.items())
+            else:
+                flat.append('%s=%s' % (k, v))
+        flat.append('[/STREAM]')
+
+    data['format'] = {'format_name': 'matroska,webm', 'duration': '3600.000000',
+                      'size': '1000000000', 'bit_rate': '2000000',
+                      'tags': {'title': 'benchmark'}}
+    flat.append('[FORMAT]')
+    flat.extend('%s=%s' % (k, v) for k, v in data['format'].items() if k != 'tags')
+    flat.append('TAG:title=benchmark')
+    flat.append('[/FORMAT]')
+
+    return '\n'.join(flat) + '\n', json.dumps(data, indent=4)
+
+
+def bench_probe_parsing(number=200):
+    """Flat key=value parser vs. JSON parser."""
+    for streams, tags in ((2, 5), (24, 20), (64, 200)):
+        flat, js = _probe_output(streams, tags)
+
+        def parse_flat():
+            ffmpeg.MediaInfo().parse_ffprobe(flat)
+
+        def parse_json():
+            ffmpeg.MediaInfo().parse_ffprobe_json(js)
+
+        t_flat = min(timeit.repeat(parse_flat, number=number, repeat=3))
+        t_json = min(timeit.repeat(parse_json, number=number, repeat=3))
+        print('probe parsing, %3d streams x %3d tags: flat %8.3f ms, '
+              'json %8.3f ms (%.1fx)' % (streams, tags,
+                                         1000.0 * t_flat / number,
+                                         1000.0 * t_json / number,
+                                         t_flat / t_json))
+
+
+def bench_profile_bind(number=2000):
+    """parse_options() per conversion vs. a compiled profile."""
+    c = Converter(ffmpeg_path=sys.executable, ffprobe_path=sys.executable)
+    options = {'format': 'mp4', 'audio': {'codec': 'aac', 'bitrate': 128},
+               'video': {'codec': 'h264', 'width': 1280, 'height': 720,
+                         'mode': 'pad', 'bitrate': 2500, 'preset': 'fast'}}
+    info = ffmpeg.MediaInfo()
+    info.parse_ffprobe(_probe_output(2, 5)[0])
+    profile = c.compile_profile(options)
+
+    def parse():
+        c.parse_options(c._source_options(options, info)[0])
+
+    def bind():
+        profile.bind(info)
+
+    t_parse = min(timeit.repeat(parse, number=number, repeat=3))
+    t_bind = min(timeit.repeat(bind, number=number, repeat=3))
+    print('conversion options: parse_options %8.3f us, profile %8.3f us '
+          '(%.1fx)' % (1000000.0 * t_parse / number,
+                       1000000.0 * t_bind / number, t_parse / t_bind))
+
+
+def bench_packet_index(packets=100000, gop=50, number=10000):
+    """Parsing ffprobe packet output, and keyframe lookups in the index."""
+    output = ''.join('pts_time=%f|size=%d|pos=%d|flags=%s\n' % (
+        i / 25.0, 1000 + i % 7, i * 1000, 'K_' if i % gop == 0 else '__')
+        for i in range(packets)).encode('ascii')
+
+    index = ffmpeg.PacketIndex()
+    t = time.time()
+    for i in range(0, len(output), 65536):
+        index.feed(output[i:i + 65536])
+    index.close()
+    t_parse = time.time() - t
+    size = sum(a.itemsize * len(a) for a in (index.pts, index.pos,
+                                             index.size))
+    size += (len(index) + 7) // 8
+    print('packet index, %d packets: parse %8.3f ms, %.1f bytes/packet' % (
+        packets, 1000.0 * t_parse, float(size) / packets))
+
+    duration = packets / 25.0
+    index.keyframes()
+
+    def lookup():
+        for i in range(number):
+            index.keyframe_after(duration * i / number)
+
+    t_lookup = min(timeit.repeat(lookup, number=1, repeat=3))
+    print('packet index, %d keyframes: lookup %8.3f us' % (
+        len(index.keyframes()), 1000000.0 * t_lookup / number))
+
+
+def bench_thumbnails(fname='test1.ogg', count=8):
+    """Output seeking in one process vs. parallel input seeking."""
+    try:
+        f = ffmpeg.FFMpeg()
+    except ffmpeg.FFMpegError as e:
+        print('thumbnails: skipped (%s)' % e)
+        return
+    info = f.probe(fname)
+    if info is None or info.video is None:
+        print('thumbnails: skipped (no video in %s)' % fname)
+        return
+
+    duration = info.format.duration
+    tmp = tempfile.mkdtemp()
+    try:
+        option_list = [(duration * (i + 0.5) / count,
+                        os.path.join(tmp, 'thumb%d.jpg' % i))
+                       for i in range(count)]
+        modes = (('output seeking', {}),
+                 ('input seeking', {'input_seeking': True}),
+                 ('keyframes only', {'input_seeking': True,
+                                     'keyframes_only': True}))
+        for name, kwargs in modes:
+            t = time.time()
+            f.thumbnails(fname, option_list, **kwargs)
+            print('thumbnails, %d of %.0fs: %-15s %8.3f s' % (
+                count, duration, name, time.time() - t))
+    finally:
+        shutil.rmtree(tmp)
+
+
+BENCHMARKS = {
+    'packet_index': bench_packet_index,
+    'probe_parsing': bench_probe_parsing,
+    'profile_bind': bench_profile_bind,
+    'thumbnails': bench_thumbnails,
+}
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or sorted(BENCHMARKS):
+        BENCHMARKS[name]()
@@ -5,14 +5,18 @@ import sys
 
 sys.path.append('../')
 
+import asyncio
+import io
 import random
 import string
 import shutil
+import threading
+import time
 import unittest
 import os
 from os.path import join as pjoin
 
-from converter import ffmpeg, formats, codecs, Converter, ConverterError
+from converter import ffmpeg, formats, codecs, cache, aio, scheduler, capabilities, Converter, ConverterError
 
 
 def verify_progress(p):
@@ -119,6 +123,206 @@ class TestFFMpeg(unittest.TestCase):
                                      'MediaStreamInfo(type=video, codec=theora, width=720, height=400, fps=25.0, ENCODER=ffmpeg2theora 0.19), '
                                      'MediaStreamInfo(type=audio, codec=vorbis, channels=2, rate=48000, bitrate=80000, ENCODER=ffmpeg2theora 0.19)])')
 
+    FFPROBE_FLAT_OUTPUT = """[STREAM]
+index=0
+codec_name=h264
+codec_long_name=H.264 / AVC / MPEG-4 AVC / MPEG-4 part 10
+profile=High
+codec_type=video
+width=1280
+height=720
+sample_aspect_ratio=1:1
+display_aspect_ratio=16:9
+pix_fmt=yuv420p
+r_frame_rate=30000/1001
+avg_frame_rate=30000/1001
+start_time=0.000000
+duration=N/A
+bit_rate=2000000
+DISPOSITION:default=1
+DISPOSITION:forced=0
+DISPOSITION:attached_pic=0
+TAG:rotate=90
+[/STREAM]
+[STREAM]
+index=1
+codec_name=aac
+codec_long_name=AAC (Advanced Audio Coding)
+profile=LC
+codec_type=audio
+sample_rate=44100
+channels=2
+r_frame_rate=0/0
+avg_frame_rate=0/0
+start_time=N/A
+duration=10.000000
+bit_rate=N/A
+DISPOSITION:default=1
+DISPOSITION:forced=0
+DISPOSITION:attached_pic=0
+TAG:language=eng
+[/STREAM]
+[STREAM]
+index=2
+codec_name=mov_text
+codec_long_name=MOV text
+profile=unknown
+codec_type=subtitle
+start_time=0.000000
+duration=10.000000
+DISPOSITION:default=0
+DISPOSITION:forced=1
+DISPOSITION:attached_pic=0
+[/STREAM]
+[FORMAT]
+format_name=mov,mp4,m4a,3gp,3g2,mj2
+format_long_name=QuickTime / MOV
+duration=10.000000
+size=2600000
+bit_rate=2080000
+TAG:title=Test
+[/FORMAT]
+"""
+
+    FFPROBE_JSON_OUTPUT = """{
+    "streams": [
+        {
+            "index": 0,
+            "codec_name": "h264",
+            "codec_long_name": "H.264 / AVC / MPEG-4 AVC / MPEG-4 part 10",
+            "profile": "High",
+            "codec_type": "video",
+            "width": 1280,
+            "height": 720,
+            "sample_aspect_ratio": "1:1",
+            "display_aspect_ratio": "16:9",
+            "pix_fmt": "yuv420p",
+            "r_frame_rate": "30000/1001",
+            "avg_frame_rate": "30000/1001",
+            "start_time": "0.000000",
+            "bit_rate": "2000000",
+            "disposition": {"default": 1, "forced": 0, "attached_pic": 0},
+            "tags": {"rotate": "90"}
+        },
+        {
+            "index": 1,
+            "codec_name": "aac",
+            "codec_long_name": "AAC (Advanced Audio Coding)",
+            "profile": "LC",
+            "codec_type": "audio",
+            "sample_rate": "44100",
+            "channels": 2,
+            "r_frame_rate": "0/0",
+            "avg_frame_rate": "0/0",
+            "duration": "10.000000",
+            "disposition": {"default": 1, "forced": 0, "attached_pic": 0},
+            "tags": {"language": "eng"}
+        },
+        {
+            "index": 2,
+            "codec_name": "mov_text",
+            "codec_long_name": "MOV text",
+            "codec_type": "subtitle",
+            "start_time": "0.000000",
+            "duration": "10.000000",
+            "disposition": {"default": 0, "forced": 1, "attached_pic": 0}
+        }
+    ],
+    "format": {
+        "format_name": "mov,mp4,m4a,3gp,3g2,mj2",
+        "format_long_name": "QuickTime / MOV",
+        "duration": "10.000000",
+        "size": "2600000",
+        "bit_rate": "2080000",
+        "tags": {"title": "Test"}
+    }
+}
+"""
+
+    def test_ffprobe_json_parity(self):
+        flat = ffmpeg.MediaInfo()
+        flat.parse_ffprobe(self.FFPROBE_FLAT_OUTPUT)
+        parsed = ffmpeg.MediaInfo()
+        parsed.parse_ffprobe_json(self.FFPROBE_JSON_OUTPUT)
+
+        self.assertEqual(vars(flat.format), vars(parsed.format))
+        self.assertEqual(3, len(parsed.streams))
+        for a, b in zip(flat.streams, parsed.streams):
+            self.assertEqual(vars(a), vars(b))
+        self.assertEqual(repr(flat), repr(parsed))
+
+        self.assertEqual(1, parsed.streams[2].sub_forced)
+        self.assertAlmostEqual(29.97, parsed.video.video_fps, places=2)
+        self.assertEqual('90', parsed.video.metadata['rotate'])
+
+        # fields the flat writer prints as N/A or unknown are left out of JSON
+        flat = ffmpeg.MediaInfo()
+        flat.parse_ffprobe('[STREAM]\nindex=0\ncodec_name=mpeg2video\n'
+                           'codec_long_name=MPEG-2 video\nprofile=unknown\n'
+                           'codec_type=video\nwidth=720\nheight=576\n'
+                           'sample_aspect_ratio=N/A\ndisplay_aspect_ratio=N/A\n'
+                           'pix_fmt=unknown\nr_frame_rate=25/1\n'
+                           'start_time=N/A\nduration=N/A\nbit_rate=N/A\n'
+                           '[/STREAM]\n[FORMAT]\nformat_name=mpeg\n'
+                           'duration=N/A\n[/FORMAT]\n')
+        parsed = ffmpeg.MediaInfo()
+        parsed.parse_ffprobe_json(
+            '{"streams": [{"index": 0, "codec_name": "mpeg2video", '
+            '"codec_long_name": "MPEG-2 video", "codec_type": "video", '
+            '"width": 720, "height": 576, "r_frame_rate": "25/1"}], '
+            '"format": {"format_name": "mpeg"}}')
+        self.assertEqual(vars(flat.video), vars(parsed.video))
+        self.assertEqual(0, parsed.video.video_display_aspect_ratio)
+        self.assertEqual('unknown', parsed.video.profile)
+
+        empty = ffmpeg.MediaInfo()
+        empty.parse_ffprobe_json('')
+        self.assertEqual([], empty.streams)
+
+    def test_probe_cache(self):
+        fname = pjoin(self.temp_dir, 'media.mp4')
+        with open(fname, 'w') as f:
+            f.write('x')
+        info = ffmpeg.MediaInfo()
+        info.parse_ffprobe(self.FFPROBE_FLAT_OUTPUT)
+
+        db = pjoin(self.temp_dir, 'probe.sqlite')
+        c = cache.ProbeCache(maxsize=1, path=db)
+        key = c.key(fname)
+        self.assertEqual(None, c.get(key))
+        c.put(key, info)
+        cached = c.get(key)
+        self.assertEqual(repr(info), repr(cached))
+        self.assertFalse(cached is c.get(key))
+        self.assertEqual(None, c.get(c.key(fname, posters_as_video=False)))
+        self.assertEqual((2, 2), (c.hits, c.misses))
+        c.close()
+
+        # survives restarts
+        c = cache.ProbeCache(path=db)
+        self.assertEqual(repr(info), repr(c.get(key)))
+        self.assertEqual(1, c.disk_hits)
+
+        # changed files don't match
+        with open(fname, 'w') as f:
+            f.write('xy')
+        self.assertNotEqual(key, c.key(fname))
+        self.assertEqual(None, c.get(c.key(fname)))
+        self.assertEqual(None, c.key('nonexistent'))
+        c.close()
+
+    def test_ffmpeg_probe_many(self):
+        f = ffmpeg.FFMpeg(ffmpeg_path="ffmpeg-3.2.10", ffprobe_path="ffprobe-3.2.10")
+
+        paths = ['test1.ogg', 'nonexistent', 'test.mp3', 'test1.ogg']
+        results = list(f.probe_many(iter(paths), max_workers=2))
+        self.assertEqual(sorted(paths), sorted(p for p, _ in results))
+        for path, info in results:
+            if path == 'nonexistent':
+                self.assertEqual(None, info)
+            else:
+                self.assertEqual(repr(f.probe(path)), repr(info))
+
     def test_ffmpeg_convert(self):
         f = ffmpeg.FFMpeg(ffmpeg_path="ffmpeg-3.2.10", ffprobe_path="ffprobe-3.2.10")
 
@@ -166,6 +370,135 @@ class TestFFMpeg(unittest.TestCase):
         self.assertEqual(1, info.audio.audio_channels)
         self.assertEqual(11025, info.audio.audio_samplerate)
 
+    def test_progress_reader(self):
+        reader = ffmpeg.ProgressReader()
+        output = (b'frame=50\nfps=25.00\nbitrate= 128.4kbits/s\n'
+                  b'total_size=32000\nout_time_ms=2000000\nspeed=1.5x\n'
+                  b'progress=continue\nframe=75\nfps=N/A\nbitrate=N/A\n'
+                  b'out_time_us=3000000\nout_time_ms=3000000\nspeed=N/A\n'
+                  b'progress=end\n')
+
+        self.assertEqual([], reader.feed(output[:20]))
+        first, last = reader.feed(output[20:])
+
+        self.assertEqual(50, first.frame)
+        self.assertEqual(25.0, first.fps)
+        self.assertEqual(128.4, first.bitrate)
+        self.assertEqual(32000, first.total_size)
+        self.assertEqual(2.0, first.timecode)
+        self.assertEqual(1.5, first.speed)
+        self.assertFalse(first.finished)
+
+        self.assertEqual(75, last.frame)
+        self.assertEqual(None, last.fps)
+        self.assertEqual(None, last.total_size)
+        self.assertEqual(3000000, last.out_time_us)
+        self.assertTrue(last.finished)
+
+    def test_progress_events(self):
+        reader = ffmpeg.ProgressReader()
+        updates = reader.feed(b'fps=25\nspeed=2x\ntotal_size=1000\nout_time_us=5000000\n'
+                              b'progress=continue\nout_time_us=N/A\nprogress=continue\n'
+                              b'out_time_us=10000000\nprogress=end\n')
+
+        # the first pass of a two-pass job
+        events = list(Converter._progress(updates, 10.0, True, time.monotonic(),
+                                          weight=0.5, after=1.0))
+        self.assertEqual(2, len(events))
+        first, last = events
+        self.assertTrue(isinstance(first, ffmpeg.ProgressEvent))
+        self.assertEqual(0.25, first.fraction)
+        self.assertEqual(0.25, float(first))
+        self.assertEqual(5.0, first.out_time)
+        self.assertEqual(25.0, first.fps)
+        self.assertEqual(2.0, first.speed)
+        self.assertEqual(1000, first.size)
+        self.assertTrue(first.elapsed >= 0)
+        self.assertTrue(first.eta >= 0)
+        self.assertEqual(0.5, last.fraction)
+        self.assertEqual(None, last.speed)
+        # the second pass is still left
+        self.assertTrue(last.eta >= 0)
+        self.assertRaises(AttributeError, setattr, last, 'foo', 1)
+
+        self.assertEqual([0.5, 0.625], list(Converter._progress([5.0, 7.5], 10.0, offset=0.25,
+                                                              weight=0.5)))
+
+    def test_job_stats(self):
+        f = ffmpeg.FFMpeg(ffmpeg_path=sys.executable, ffprobe_path=sys.executable)
+
+        stats = ffmpeg.JobStats()
+        stdout_data, _ = f._communicate(
+            [sys.executable, '-c', 'import sys; sys.stdout.write("x" * 100000)'], stats)
+        self.assertEqual(b'x' * 100000, stdout_data)
+        self.assertEqual(0, stats.returncode)
+        self.assertTrue(stats.pid > 0)
+        self.assertTrue(0 <= stats.spawn_latency <= stats.wall_time)
+        if hasattr(os, 'wait4'):
+            self.assertTrue(stats.cpu_time > 0)
+            self.assertTrue(stats.max_rss > 0)
+
+        stats = ffmpeg.JobStats()
+        f._communicate([sys.executable, '-c', 'import sys; sys.exit(3)'], stats)
+        self.assertEqual(3, stats.returncode)
+        stats = ffmpeg.JobStats()
+        f._communicate([sys.executable, '-c',
+                        'import os, signal; os.kill(os.getpid(), signal.SIGTERM)'], stats)
+        self.assertEqual(-15, stats.returncode)
+
+        # the log is opened before ffmpeg is started
+        stats = ffmpeg.JobStats()
+        conv = f.convert(__file__, self.video_file_path, [], stats=stats,
+                         log_file=pjoin(self.temp_dir, 'missing', 'log.txt'))
+        self.assertRaises(IOError, list, conv)
+        self.assertEqual(None, stats.pid)
+
+        f = ffmpeg.FFMpeg(ffmpeg_path="ffmpeg-3.2.10", ffprobe_path="ffprobe-3.2.10")
+        stats = ffmpeg.JobStats()
+        info = f.probe('test1.ogg', stats=stats)
+        self.assertEqual('ogg', info.format.format)
+        self.assertEqual(0, stats.returncode)
+
+        stats = ffmpeg.JobStats()
+        convert_options = ['-acodec', 'libvorbis', '-ab', '16k', '-ac', '1', '-ar', '11025',
+                           '-vcodec', 'libtheora', '-r', '15', '-s', '360x200', '-b', '128k']
+        list(f.convert('test1.ogg', self.video_file_path, convert_options, stats=stats))
+        self.assertEqual(0, stats.returncode)
+        self.assertTrue(stats.wall_time > 0)
+
+        conv = f.convert('test1.ogg', self.video_file_path, convert_options, max_rss=1024)
+        if os.path.exists('/proc/self/status'):
+            self.assertRaisesSpecific(ffmpeg.FFMpegMemoryError, list, conv)
+
+    def test_output_tail(self):
+        sink = io.BytesIO()
+        tail = ffmpeg.OutputTail(max_bytes=10, sink=sink)
+        for chunk in (b'first\n', b'second\n', b'third\nfourth\n'):
+            tail.feed(chunk)
+        self.assertEqual('rd\nfourth\n', tail.getvalue())
+        self.assertEqual(26, tail.total_bytes)
+        self.assertEqual(b'first\nsecond\nthird\nfourth\n', sink.getvalue())
+
+        tail = ffmpeg.OutputTail(max_bytes=1024, max_lines=2)
+        for chunk in (b'first\n', b'second\n', b'third\nfourth\n'):
+            tail.feed(chunk)
+        self.assertEqual('third\nfourth\n', tail.getvalue())
+
+        # keep nothing, the sink has the whole log
+        for max_bytes in (0, None):
+            sink = io.BytesIO()
+            tail = ffmpeg.OutputTail(max_bytes=max_bytes, sink=sink)
+            for chunk in (b'first\n', b'second\n'):
+                tail.feed(chunk)
+            self.assertEqual('', tail.getvalue())
+            self.assertEqual(13, tail.total_bytes)
+            self.assertEqual(b'first\nsecond\n', sink.getvalue())
+
+        f = ffmpeg.FFMpeg(ffmpeg_path=sys.executable, ffprobe_path=sys.executable)
+        f._convert_cmds = lambda *args: [sys.executable, '-c', self.FAKE_FFMPEG]
+        self.assertEqual([1.0, 2.0, 3.0],
+                         list(f.convert(__file__, None, [], log_tail=0)))
+
     def test_ffmpeg_termination(self):
         # test when ffmpeg is killed
         f = ffmpeg.FFMpeg(ffmpeg_path="ffmpeg-3.2.10", ffprobe_path="ffprobe-3.2.10")
@@ -181,6 +514,146 @@ class TestFFMpeg(unittest.TestCase):
         p.terminate()
         self.assertRaisesSpecific(ffmpeg.FFMpegConvertError, list, conv)
 
+    def test_ffmpeg_convert_in_thread(self):
+        f = ffmpeg.FFMpeg(ffmpeg_path="ffmpeg-3.2.10", ffprobe_path="ffprobe-3.2.10")
+        convert_options = [
+            '-acodec', 'libvorbis', '-ab', '16k', '-ac', '1', '-ar', '11025',
+            '-vcodec', 'libtheora', '-r', '15', '-s', '360x200', '-b', '128k']
+        result = {}
+
+        def run():
+            try:
+                result['timecodes'] = list(f.convert(
+                    'test1.ogg', self.video_file_path, convert_options,
+                    timeout=10, deadline=600))
+            except Exception as e:
+                result['error'] = e
+
+        t = threading.Thread(target=run)
+        t.start()
+        t.join()
+        self.assertEqual(None, result.get('error'))
+        self.assertTrue(result['timecodes'])
+        self._assert_converted_video_file()
+
+        conv = f.convert('test1.ogg', self.video_file_path, convert_options,
+                         deadline=0.01)
+        self.assertRaisesSpecific(ffmpeg.FFMpegTimeoutError, list, conv)
+
+    # reports progress like ffmpeg -progress pipe:1, every 0.05s
+    FAKE_FFMPEG = (
+        'import sys, time\n'
+        'sys.stderr.write("ffmpeg banner\\n")\n'
+        'for i in (1, 2, 3):\n'
+        '    sys.stdout.write("out_time_us=%d000000\\nprogress=continue\\n" % i)\n'
+        '    sys.stdout.flush()\n'
+        '    time.sleep(0.05)\n'
+        'sys.stdout.write("progress=end\\n")\n')
+
+    def test_watchdog(self):
+        w = ffmpeg.Watchdog()
+        self.assertEqual(None, w.remaining())
+        self.assertEqual(None, w.expired())
+
+        w = ffmpeg.Watchdog(timeout=0.05, deadline=10)
+        self.assertTrue(0 < w.remaining() <= 0.05)
+        time.sleep(0.06)
+        self.assertTrue(w.remaining() < 0)
+        self.assertEqual('no progress for 0.05s', w.expired())
+        w.progress()
+        self.assertEqual(None, w.expired())
+
+        w = ffmpeg.Watchdog(timeout=10, deadline=0.01)
+        time.sleep(0.02)
+        self.assertEqual('deadline of 0.01s exceeded', w.expired())
+
+        # a slow consumer of the progress updates isn't an ffmpeg stall
+        f = ffmpeg.FFMpeg(ffmpeg_path=sys.executable, ffprobe_path=sys.executable)
+        f._convert_cmds = lambda *args: [sys.executable, '-c', self.FAKE_FFMPEG]
+        timecodes = []
+        for timecode in f.convert(__file__, None, [], timeout=0.2):
+            time.sleep(0.3)
+            timecodes.append(timecode)
+        self.assertEqual([1.0, 2.0, 3.0], timecodes)
+
+        async def consume():
+            f = aio.AsyncFFMpeg(ffmpeg_path=sys.executable, ffprobe_path=sys.executable)
+            f._convert_cmds = lambda *args: [sys.executable, '-c', self.FAKE_FFMPEG]
+            timecodes = []
+            async for timecode in f.convert(__file__, None, [], timeout=0.2):
+                await asyncio.sleep(0.3)
+                timecodes.append(timecode)
+            return timecodes
+
+        self.assertEqual([1.0, 2.0, 3.0], asyncio.run(consume()))
+
+    def test_capabilities(self):
+        C = capabilities.Capabilities
+        self.assertEqual('4.4.2-0ubuntu0.22.04.1', C.parse_version(
+            'ffmpeg version 4.4.2-0ubuntu0.22.04.1 Copyright (c) 2000-2021\n'
+            'built with gcc 11 (Ubuntu 11.2.0-19ubuntu1)\n'))
+        self.assertEqual({'libx264', 'h264', 'aac', 'dca', 'dts'}, C.parse_encoders(
+            'Encoders:\n'
+            ' V..... = Video\n'
+            ' ------\n'
+            ' V....D libx264              libx264 H.264 / AVC (codec h264)\n'
+            ' A....D aac                  AAC (Advanced Audio Coding)\n'
+            ' A..X.. dca                  DCA (DTS Coherent Acoustics) (codec dts)\n'))
+        self.assertEqual({'matroska', 'mp4', 'hls'}, C.parse_muxers(
+            'File formats:\n'
+            ' D. = Demuxing supported\n'
+            ' E. = Muxing supported\n'
+            ' --\n'
+            '  E matroska        Matroska\n'
+            ' D  mov,mp4,m4a     QuickTime / MOV\n'
+            '  E mp4             MP4 (MPEG-4 Part 14)\n'
+            ' DE hls             Apple HTTP Live Streaming\n'))
+        self.assertEqual({'scale', 'tile'}, C.parse_filters(
+            'Filters:\n'
+            '  T.. = Timeline support\n'
+            ' ..C scale             V->V       Scale the input video size.\n'
+            ' ... tile              V->V       Tile several successive frames together.\n'))
+
+        c = Converter(ffmpeg_path=sys.executable, ffprobe_path=sys.executable)
+        c.ffmpeg._capabilities = (C('4.4', ['libtheora', 'aac'], ['ogg']),)
+        self.assertEqual(
+            ['-an', '-vcodec', 'libtheora', '-pix_fmt', 'yuv420p', '-sn', '-f', 'ogg'],
+            c.parse_options({'format': 'ogg', 'video': {'codec': 'theora'}}))
+        self.assertRaisesSpecific(ConverterError, c.parse_options,
+                                  {'format': 'ogg', 'audio': {'codec': 'vorbis'}})
+        self.assertRaisesSpecific(ConverterError, c.parse_options,
+                                  {'format': 'mkv', 'audio': {'codec': 'aac'}})
+        c.ffmpeg._capabilities = (C('4.4', ['dca', 'dts'], ['matroska']),)
+        self.assertEqual(['-acodec', 'dts', '-vn', '-sn', '-f', 'matroska'],
+                         c.parse_options({'format': 'mkv', 'audio': {'codec': 'dts'}}))
+
+        # fake binary printing the same listing for every query
+        fake = pjoin(self.temp_dir, 'ffmpeg')
+        with open(fake, 'w') as f:
+            f.write('#!/bin/sh\n'
+                    'echo "ffmpeg version 9.9 Copyright"\n'
+                    'echo " ------"\n'
+                    'echo " --"\n'
+                    'echo " VE.... libx264  H.264"\n'
+                    'echo " E mp4  MP4"\n')
+        os.chmod(fake, 0o755)
+        cache_path = pjoin(self.temp_dir, 'cache', 'capabilities.json')
+        caps = capabilities.get_capabilities(fake, cache_path)
+        self.assertEqual('9.9', caps.version)
+        self.assertTrue(caps.has_encoder('libx264'))
+        self.assertTrue(caps.has_muxer('mp4'))
+        self.assertTrue(caps is capabilities.get_capabilities(fake, cache_path))
+        self.assertTrue(os.path.exists(cache_path))
+
+        # a new process finds them on disk without running the binary
+        capabilities._cache.clear()
+        os.chmod(fake, 0o644)
+        self.assertEqual(caps.to_dict(),
+                         capabilities.get_capabilities(fake, cache_path).to_dict())
+        self.assertEqual(None, capabilities.get_capabilities(sys.executable, None))
+        self.assertEqual(None, Converter(ffmpeg_path=sys.executable,
+                                         ffprobe_path=sys.executable).ffmpeg.capabilities_cache)
+
     def test_ffmpeg_thumbnail(self):
         f = ffmpeg.FFMpeg(ffmpeg_path="ffmpeg-3.2.10", ffprobe_path="ffprobe-3.2.10")
         thumb = self.shot_file_path
@@ -201,14 +674,207 @@ class TestFFMpeg(unittest.TestCase):
         # test multiple thumbnail
         self.ensure_notexist(thumb)
         self.ensure_notexist(thumb2)
+        stats = []
         f.thumbnails('test1.ogg', [
             (5, thumb),
             (10, thumb2, None, 5),  # set quality
             (5, self.shot3_file_path, '320x240'),  # set size
-        ])
+        ], stats_list=stats)
         self.assertTrue(os.path.exists(thumb))
         self.assertTrue(os.path.exists(thumb2))
         self.assertTrue(os.path.exists(self.shot3_file_path))
+        self.assertEqual(1, len(stats))
+
+        # input seeking, in parallel processes
+        for fname in (thumb, thumb2, self.shot3_file_path):
+            self.ensure_notexist(fname)
+        del stats[:]
+        f.thumbnails('test1.ogg', [
+            (5, thumb),
+            (10, thumb2, None, 5),
+            (20, self.shot3_file_path, '320x240'),
+        ], stats_list=stats, input_seeking=True, max_workers=2, keyframes_only=True)
+        self.assertTrue(os.path.exists(thumb))
+        self.assertTrue(os.path.exists(thumb2))
+        self.assertTrue(os.path.exists(self.shot3_file_path))
+        self.assertEqual(2, len(stats))
+        self.assertTrue(all(s.returncode == 0 for s in stats))
+        self.assertRaisesSpecific(ValueError, f.thumbnails, 'test1.ogg', [(5, thumb)],
+                                  stats=ffmpeg.JobStats(), input_seeking=True)
+
+        # in memory
+        shots = f.thumbnails_data('test1.ogg', [5, 10, 20], '320x240',
+                                  max_workers=2)
+        self.assertEqual(3, len(shots))
+        self.assertTrue(all(shot.startswith(b'\xff\xd8') and
+                            shot.endswith(b'\xff\xd9') for shot in shots))
+        buf = bytearray(1024 * 1024)
+        size = f.thumbnail_data('test1.ogg', 5, '320x240', buf=buf)
+        self.assertEqual(shots[0], bytes(buf[:size]))
+        self.assertRaisesSpecific(ffmpeg.FFMpegError, f.thumbnail_data,
+                                  'test1.ogg', 5, buf=bytearray(10))
+
+        self.assertEqual(
+            ['-skip_frame', 'nokey', '-ss', '5', '-i', 'in.ogg',
+             '-skip_frame', 'nokey', '-ss', '10', '-i', 'in.ogg', '-y',
+             '-map', '0:v:0', '-f', 'image2', '-vframes', '1', '-q:v', '4', 'a.jpg',
+             '-map', '1:v:0', '-s', '320x240', '-f', 'image2', '-vframes', '1',
+             '-q:v', '5', 'b.jpg'],
+            f._thumbnails_seek_cmds('in.ogg', [(5, 'a.jpg'), (10, 'b.jpg', '320x240', 5)],
+                                    True)[1:])
+
+    def test_iter_frames(self):
+        f = ffmpeg.FFMpeg(ffmpeg_path="ffmpeg-3.2.10", ffprobe_path="ffprobe-3.2.10")
+        self.assertRaisesSpecific(ffmpeg.FFMpegError, list,
+                                  f.iter_frames('test1.ogg', pix_fmt='yuv420p'))
+
+        frames = f.iter_frames('test1.ogg', start=5, duration=2, fps=5)
+        first = next(frames)
+        self.assertEqual((400, 720, 3), first.shape)
+        self.assertEqual('uint8', str(first.dtype))
+        copy = first.copy()
+        count = 1
+        for frame in frames:
+            self.assertTrue(frame is first)  # the buffer is reused
+            count += 1
+        self.assertEqual(10, count)
+        self.assertFalse((copy == first).all())
+
+        numpy = ffmpeg.numpy
+        ffmpeg.numpy = None
+        try:
+            frames = list(f.iter_frames('test1.ogg', 'gray16le', '32x20',
+                                        duration=1))
+        finally:
+            ffmpeg.numpy = numpy
+        self.assertTrue(isinstance(frames[0], memoryview))
+        self.assertEqual((20, 32), frames[0].shape)
+        self.assertEqual('H', frames[0].format)
+
+    def test_iter_audio(self):
+        f = ffmpeg.FFMpeg(ffmpeg_path="ffmpeg-3.2.10", ffprobe_path="ffprobe-3.2.10")
+        self.assertRaisesSpecific(ffmpeg.FFMpegError, list,
+                                  f.iter_audio('test1.ogg', dtype='float64'))
+
+        total = 0
+        for block in f.iter_audio('test1.ogg', 8000, 2, 'float32', start=10,
+                                  duration=2, block_size=4096):
+            self.assertEqual(2, block.shape[1])
+            self.assertTrue(abs(block).max() <= 1.0)
+            total += block.shape[0]
+        self.assertTrue(abs(total - 16000) < 100)
+
+        c = Converter(ffmpeg_path="ffmpeg-3.2.10", ffprobe_path="ffprobe-3.2.10")
+        mins, maxs, rms = c.waveform('test1.ogg', points=100, samplerate=8000)
+        self.assertEqual(100, len(mins))
+        self.assertEqual(100, len(maxs))
+        self.assertEqual(100, len(rms))
+        self.assertTrue((mins <= maxs).all())
+        self.assertTrue((rms >= 0).all() and (rms <= 1).all())
+        self.assertTrue(rms.max() > 0)
+
+    def test_jpeg_reader(self):
+        def jpeg(payload):
+            # SOI, an APP segment holding a bogus EOI, SOS, scan data
+            # with a stuffed 0xFF and a restart marker, EOI
+            return (b'\xff\xd8\xff\xe1\x00\x04\xff\xd9'
+                    b'\xff\xda\x00\x03\x01' + payload +
+                    b'\xff\x00\x02\xff\xd0\x03\xff\xd9')
+
+        images = [jpeg(b'\x01'), jpeg(b'\x02' * 100), jpeg(b'')]
+        stream = b''.join(images)
+        self.assertEqual(images, ffmpeg.JpegReader().feed(stream))
+
+        r = ffmpeg.JpegReader()
+        found = []
+        for i in range(len(stream)):
+            found.extend(r.feed(stream[i:i + 1]))
+        self.assertEqual(images, found)
+        self.assertEqual(0, r.pending())
+
+        found = []
+        r = ffmpeg.JpegReader(found.append)
+        self.assertEqual([], r.feed(stream[:len(images[0]) + 5]))
+        self.assertEqual(images[:1], found)
+        r.feed(stream[len(images[0]) + 5:])
+        self.assertEqual(images, found)
+
+        r = ffmpeg.JpegReader()
+        self.assertEqual(images[:1], r.feed(stream[:len(images[0]) + 5]))
+        self.assertEqual(5, r.pending())
+        self.assertRaisesSpecific(ffmpeg.FFMpegError,
+                                  ffmpeg.JpegReader().feed, b'GIF89a')
+
+    def test_packet_index(self):
+        output = (b'pts_time=0.080000|size=4000|pos=48|flags=K_\n'
+                  b'pts_time=0.160000|size=900|pos=4048|flags=__\n'
+                  b'pts_time=N/A|size=10|pos=N/A|flags=K_\n'
+                  b'pts_time=2.080000|size=3000|pos=4958|flags=K_\n'
+                  b'pts_time=2.120000|size=800|pos=7958|flags=__')
+        index = ffmpeg.PacketIndex()
+        for i in range(0, len(output), 7):
+            index.feed(output[i:i + 7])
+        index.close()
+
+        self.assertEqual(5, len(index))
+        self.assertEqual([48, 4048, -1, 4958, 7958], index.pos.tolist())
+        self.assertEqual([4000, 900, 10, 3000, 800], index.size.tolist())
+        self.assertEqual([True, False, True, True, False],
+                         [index.is_keyframe(i) for i in range(len(index))])
+        self.assertTrue(index.is_keyframe(-2))
+        self.assertRaises(IndexError, index.is_keyframe, 5)
+        self.assertEqual([0.08, 2.08], index.keyframes().tolist())
+        self.assertEqual(0.08, index.keyframe_before(2.0))
+        self.assertEqual(2.08, index.keyframe_before(2.08))
+        self.assertEqual(None, index.keyframe_before(0.0))
+        self.assertEqual(2.08, index.keyframe_after(0.1))
+        self.assertEqual(None, index.keyframe_after(3.0))
+
+    def test_async_ffmpeg(self):
+        f = aio.AsyncFFMpeg(ffmpeg_path="ffmpeg-3.2.10", ffprobe_path="ffprobe-3.2.10")
+        convert_options = [
+            '-acodec', 'libvorbis', '-ab', '16k', '-ac', '1', '-ar', '11025',
+            '-vcodec', 'libtheora', '-r', '15', '-s', '360x200', '-b', '128k']
+
+        async def convert():
+            return [tc async for tc in f.convert(
+                'test1.ogg', self.video_file_path, convert_options)]
+
+        async def cancel():
+            task = asyncio.ensure_future(convert())
+            await asyncio.sleep(0.2)
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                return True
+
+        info = asyncio.run(f.probe('test1.ogg'))
+        self.assertEqual('ogg', info.format.format)
+        self.assertEqual(None, asyncio.run(f.probe('nonexistent')))
+
+        self.assertTrue(asyncio.run(cancel()))
+        timecodes = asyncio.run(convert())
+        self.assertTrue(timecodes)
+        self.assertEqual(sorted(timecodes), timecodes)
+        self._assert_converted_video_file()
+
+        self.ensure_notexist(self.shot_file_path)
+        asyncio.run(f.thumbnail('test1.ogg', 10, self.shot_file_path))
+        self.assertTrue(os.path.exists(self.shot_file_path))
+
+        shots = [pjoin(self.temp_dir, 'async%d.jpg' % i) for i in range(3)]
+        asyncio.run(f.thumbnails('test1.ogg', [(t, shot) for t, shot in zip((5, 10, 20), shots)],
+                                 input_seeking=True, max_workers=2))
+        self.assertTrue(all(os.path.exists(shot) for shot in shots))
+
+        probe_cache = cache.ProbeCache(path=pjoin(self.temp_dir, 'probe.sqlite'))
+        f = aio.AsyncFFMpeg(ffmpeg_path="ffmpeg-3.2.10", ffprobe_path="ffprobe-3.2.10",
+                            probe_cache=probe_cache)
+        info = asyncio.run(f.probe('test1.ogg'))
+        self.assertEqual(repr(info), repr(asyncio.run(f.probe('test1.ogg'))))
+        self.assertEqual((1, 1), (probe_cache.hits, probe_cache.misses))
+        probe_cache.close()
 
     def test_formats(self):
         self.assertRaisesSpecific(ValueError,
@@ -233,6 +899,40 @@ class TestFFMpeg(unittest.TestCase):
                          formats.Mp3Format().parse_options({'format': 'mp3'}))
         self.assertEqual(['-f', 'msmpeg4'],
                          formats.WmvFormat().parse_options({'format': 'wmv'}))
+        self.assertEqual(['-f', 'hls'],
+                         formats.HlsFormat().parse_options({'format': 'hls'}))
+        self.assertEqual(['-f', 'hls'],
+                         formats.HlsFormat().parse_options({
+                             'format': 'hls', 'segment_type': 'mpegts'}))
+        self.assertEqual(
+            ['-f', 'hls', '-hls_time', '4', '-hls_segment_type', 'fmp4',
+             '-hls_segment_filename', '/tmp/s%03d.m4s',
+             '-hls_playlist_type', 'vod'],
+            formats.HlsFormat().parse_options({
+                'format': 'hls', 'segment_duration': 4, 'segment_type': 'fmp4',
+                'segment_filename': '/tmp/s%03d.m4s', 'playlist_type': 'vod'}))
+        self.assertEqual(['-f', 'dash', '-use_template', '1'],
+                         formats.DashFormat().parse_options({'format': 'dash'}))
+        self.assertEqual(
+            ['-f', 'dash', '-use_template', '1', '-seg_duration', '2.5',
+             '-use_timeline', '0', '-adaptation_sets', 'id=0,streams=v',
+             '-hls_playlist', '1'],
+            formats.DashFormat().parse_options({
+                'format': 'dash', 'segment_duration': 2.5, 'use_timeline': False,
+                'adaptation_sets': 'id=0,streams=v', 'hls_playlist': True}))
+        self.assertEqual(
+            ['-f', 'dash', '-use_template', '1', '-use_timeline', '0'],
+            formats.DashFormat().parse_options({
+                'format': 'dash', 'use_timeline': '0', 'hls_playlist': 'false'}))
+        self.assertEqual(
+            ['-f', 'dash', '-use_template', '1', '-use_timeline', '1',
+             '-hls_playlist', '1'],
+            formats.DashFormat().parse_options({
+                'format': 'dash', 'use_timeline': 'True', 'hls_playlist': 1}))
+        self.assertEqual(['-f', 'dash', '-use_template', '1'],
+                         formats.DashFormat().parse_options({
+                             'format': 'dash', 'use_timeline': 'maybe',
+                             'hls_playlist': None}))
 
     def test_codecs(self):
         c = codecs.BaseCodec()
@@ -352,6 +1052,73 @@ class TestFFMpeg(unittest.TestCase):
         self.assertEqual(
             ['-vcodec', 'msmpeg4', '-pix_fmt', 'yuv420p'], codecs.WmvCodec().parse_options({'codec': 'wmv'}))
 
+    def test_smart_copy(self):
+        info = ffmpeg.MediaInfo()
+        info.parse_ffprobe(self.FFPROBE_FLAT_OUTPUT)
+        v = info.video
+        a = info.audio
+        a.bitrate = 96000
+
+        h264 = codecs.H264Codec()
+        self.assertTrue(h264.can_copy(v, {'codec': 'h264', 'width': 1280, 'height': 720,
+                                          'bitrate': 2500, 'preset': 'fast'}))
+        self.assertFalse(h264.can_copy(v, {'codec': 'h264', 'width': 640}))
+        self.assertFalse(h264.can_copy(v, {'codec': 'h264', 'bitrate': 1000}))
+        self.assertFalse(h264.can_copy(v, {'codec': 'h264', 'pix_fmt': 'yuv444p'}))
+        self.assertFalse(h264.can_copy(v, {'codec': 'h264', 'keyframe_interval': 50}))
+        self.assertFalse(h264.can_copy(v, {'codec': 'h264', 'width': 1280, 'rotate': '90'}))
+        self.assertFalse(codecs.Vp8Codec().can_copy(v, {'codec': 'vp8'}))
+        self.assertFalse(codecs.VideoCopyCodec().can_copy(v, {'codec': 'copy'}))
+
+        aac = codecs.AacCodec()
+        self.assertTrue(aac.can_copy(a, {'codec': 'aac', 'channels': 2, 'samplerate': 44100,
+                                         'bitrate': 128}))
+        self.assertFalse(aac.can_copy(a, {'codec': 'aac', 'channels': 1}))
+        self.assertFalse(aac.can_copy(a, {'codec': 'aac', 'bitrate': 64}))
+        self.assertFalse(aac.can_copy(a, {'codec': 'aac', 'filter': 'volume=2'}))
+
+        c = Converter(ffmpeg_path=sys.executable, ffprobe_path=sys.executable)
+        options = {'format': 'mp4',
+                   'video': {'codec': 'h264', 'width': 1280, 'height': 720},
+                   'audio': {'codec': 'aac', 'channels': 1}}
+        options_repr = repr(options)
+        copied = c._smart_copy(options, info)
+        self.assertEqual({'codec': 'copy'}, copied['video'])
+        self.assertEqual(options['audio'], copied['audio'])
+        self.assertEqual(options_repr, repr(options))
+
+    def test_conversion_profile(self):
+        c = Converter(ffmpeg_path=sys.executable, ffprobe_path=sys.executable)
+        self.assertRaisesSpecific(ConverterError, c.compile_profile, {'format': 'foo'})
+        self.assertRaisesSpecific(ConverterError, c.compile_profile, 'mkv')
+
+        options = {'format': 'mkv', 'audio': {'codec': 'aac'},
+                   'video': {'codec': 'h264', 'width': 640, 'mode': 'pad'}}
+        profile = c.compile_profile(options)
+        options['video']['width'] = 320
+        self.assertEqual(640, profile.options['video']['width'])
+        profile.options['format'] = 'mp4'
+        self.assertEqual('mkv', profile.options['format'])
+        self.assertRaises(AttributeError, setattr, profile, 'hits', 0)
+
+        info = ffmpeg.MediaInfo()
+        info.parse_ffprobe(self.FFPROBE_FLAT_OUTPUT)
+        expected, _ = c._source_options(profile.options, info)
+        optlist = profile.bind(info)
+        self.assertEqual(c.parse_options(expected), optlist)
+        self.assertEqual((0, 1), (profile.hits, profile.misses))
+
+        # the result is memoised, and callers get their own copy
+        optlist.append('-foo')
+        self.assertEqual(c.parse_options(expected), profile.bind(info))
+        self.assertEqual((1, 1), (profile.hits, profile.misses))
+        self.assertEqual(c.parse_options(expected, 1), profile.bind(info, 1))
+        self.assertEqual((1, 2), (profile.hits, profile.misses))
+
+        info.video.video_width = 1920
+        self.assertNotEqual(optlist[:-1], profile.bind(info))
+        self.assertEqual((1, 3), (profile.hits, profile.misses))
+
     def test_converter(self):
         c = Converter(ffmpeg_path="ffmpeg-3.2.10", ffprobe_path="ffprobe-3.2.10")
 
@@ -421,15 +1188,46 @@ class TestFFMpeg(unittest.TestCase):
             'video': {'codec': 'theora', 'bitrate': 128, 'width': 360, 'height': 200, 'fps': 15}
         }
         options_repr = repr(options)
+
+        optlist = c.parse_options(options, twopass=1)
+        self.assertEqual(['-f', 'null', '-pass', '1'], optlist[-4:])
+        self.assertTrue('-an' in optlist)
+
+        # first-pass statistics of different input ranges are kept apart
+        key = c._passlog_key(__file__, optlist, ['-ss', '10', '-t', '30'])
+        self.assertEqual(key, c._passlog_key(
+            __file__, optlist, ['-ss', '10', '-t', '30']))
+        self.assertNotEqual(key, c._passlog_key(
+            __file__, optlist, ['-ss', '20', '-t', '30']))
+        self.assertNotEqual(key, c._passlog_key(__file__, optlist))
+
         conv = c.convert(
             'test1.ogg', self.video_file_path, options, twopass=True)
 
-        verify_progress(conv)
+        self.assertTrue(verify_progress(conv))
 
         # Convert should not change options dict
         self.assertEqual(options_repr, repr(options))
 
         self._assert_converted_video_file()
+        self.assertFalse(os.path.exists('ffmpeg2pass-0.log'))
+
+        # first-pass statistics are reused regardless of the bitrate
+        passlog_dir = pjoin(self.temp_dir, 'passlog')
+        key = c._passlog_key('test1.ogg', optlist)
+        options['video'] = dict(options['video'], bitrate=256)
+        self.assertEqual(key, c._passlog_key('test1.ogg', c.parse_options(options, twopass=1)))
+        self.assertEqual(None, c._passlog_key('nonexistent', optlist))
+
+        conv = c.convert('test1.ogg', self.video_file_path, options,
+                         twopass=True, passlog_dir=passlog_dir)
+        self.assertTrue(verify_progress(conv))
+        self.assertTrue(len(os.listdir(passlog_dir)) > 1)
+
+        conv = c.convert('test1.ogg', self.video_file_path, options,
+                         twopass=True, passlog_dir=passlog_dir)
+        self.assertTrue(verify_progress(conv))
+        self._assert_converted_video_file()
 
     def test_converter_vp8_codec(self):
         c = Converter(ffmpeg_path="ffmpeg-3.2.10", ffprobe_path="ffprobe-3.2.10")
@@ -446,6 +1244,260 @@ class TestFFMpeg(unittest.TestCase):
 
         self.assertTrue(verify_progress(conv))
 
+    def test_conversion_queue(self):
+        options = {
+            'format': 'ogg',
+            'audio': {'codec': 'vorbis', 'samplerate': 11025, 'channels': 1, 'bitrate': 16},
+            'video': {'codec': 'theora', 'bitrate': 128, 'width': 360, 'height': 200, 'fps': 15}
+        }
+
+        q = scheduler.ConversionQueue(
+            Converter(ffmpeg_path=sys.executable, ffprobe_path=sys.executable),
+            max_workers=1, cores=4)
+        profile = q.converter.compile_profile(options)
+        threaded, threads = q._threaded_profile(profile)
+        self.assertEqual(4, threads)
+        self.assertEqual(4, threaded.options['threads'])
+        self.assertTrue(q._threaded_profile(profile)[0] is threaded)
+        profile = q.converter.compile_profile(dict(options, threads=1))
+        self.assertEqual((profile, 1), q._threaded_profile(profile))
+        q.shutdown()
+
+        c = Converter(ffmpeg_path="ffmpeg-3.2.10", ffprobe_path="ffprobe-3.2.10")
+        queue = scheduler.ConversionQueue(c, max_workers=2, cores=4)
+        self.assertEqual(2, queue.threads_per_job)
+        job = queue.convert('test1.ogg', self.video_file_path, options)
+        profiled = queue.convert('test1.ogg', pjoin(self.temp_dir, 'p.ogg'),
+                                 c.compile_profile(options))
+        cancelled = queue.convert('test1.ogg', pjoin(self.temp_dir, 'x.ogg'), options)
+        cancelled.cancel()
+        failed = queue.convert('nonexistent', pjoin(self.temp_dir, 'y.ogg'), options)
+        thumbs = queue.thumbnails('test1.ogg', [(5, self.shot_file_path)], priority=10)
+        queue.shutdown()
+
+        self.assertEqual('done', job.status)
+        self.assertEqual(1.0, job.progress)
+        self.assertEqual(2, job.threads)
+        self.assertAlmostEqual(33.0, job.duration, places=0)
+        self.assertEqual('done', profiled.status)
+        self.assertEqual(2, profiled.threads)
+        self.assertEqual('cancelled', cancelled.status)
+        self.assertEqual('failed', failed.status)
+        self.assertTrue(isinstance(failed.error, ConverterError))
+        self.assertEqual('done', thumbs.status)
+        self._assert_converted_video_file()
+
+        stats = queue.stats()
+        self.assertEqual(3, stats['done'])
+        self.assertAlmostEqual(66.0, stats['media_seconds'], places=0)
+        self.assertTrue(stats['throughput'] > 0)
+
+    def test_converter_parallel_chunks(self):
+        c = Converter(ffmpeg_path="ffmpeg-3.2.10", ffprobe_path="ffprobe-3.2.10")
+
+        keyframes = c.ffmpeg.keyframes('test1.ogg')
+        self.assertTrue(len(keyframes) > 1)
+        self.assertEqual(0.0, keyframes[0])
+        self.assertEqual(sorted(keyframes), keyframes)
+        index = c.ffmpeg.packet_index('test1.ogg')
+        self.assertEqual(keyframes, index.keyframes().tolist())
+        self.assertTrue(index is c.ffmpeg.packet_index('test1.ogg'))
+
+        conv = c.convert('test1.ogg', self.video_file_path, {
+            'format': 'ogg',
+            'audio': {'codec': 'vorbis', 'samplerate': 11025, 'channels': 1, 'bitrate': 16},
+            'video': {'codec': 'theora', 'bitrate': 128, 'width': 360, 'height': 200, 'fps': 15}
+        }, parallel_chunks=3)
+        self.assertTrue(verify_progress(conv))
+        self._assert_converted_video_file()
+
+        conv = c.convert('test1.ogg', self.video_file_path, {
+            'format': 'ogg', 'video': {'codec': 'theora'}}, twopass=True, parallel_chunks=3)
+        self.assertRaisesSpecific(ConverterError, list, conv)
+
+    def test_converter_multi(self):
+        optlist, filters = Converter._split_video_filters(
+            ['-vcodec', 'libx264', '-s', '640x360', '-vf', 'crop=1:2:3:4',
+             '-map', '0', '-f', 'mp4'])
+        self.assertEqual(['-vcodec', 'libx264', '-f', 'mp4'], optlist)
+        self.assertEqual('crop=1:2:3:4,scale=640:360', filters)
+        self.assertEqual((['-an'], None), Converter._split_video_filters(['-an']))
+
+        c = Converter(ffmpeg_path="ffmpeg-3.2.10", ffprobe_path="ffprobe-3.2.10")
+        small_file_path = pjoin(self.temp_dir, 'small.ogg')
+        conv = c.convert_multi('test1.ogg', [
+            (self.video_file_path, {
+                'format': 'ogg',
+                'audio': {'codec': 'vorbis', 'samplerate': 11025, 'channels': 1, 'bitrate': 16},
+                'video': {'codec': 'theora', 'bitrate': 128, 'width': 360, 'height': 200, 'fps': 15}
+            }),
+            (small_file_path, {
+                'format': 'ogg',
+                'video': {'codec': 'theora', 'bitrate': 64, 'width': 180, 'height': 100}
+            }),
+        ])
+        self.assertTrue(verify_progress(conv))
+        self._assert_converted_video_file()
+
+        info = c.probe(small_file_path)
+        self.assertEqual(None, info.audio)
+        self.assertEqual(180, info.video.video_width)
+        self.assertEqual(100, info.video.video_height)
+
+        self.assertRaisesSpecific(ConverterError, list, c.convert_multi('test1.ogg', []))
+
+    def test_converter_segment(self):
+        c = Converter(ffmpeg_path="ffmpeg-3.2.10", ffprobe_path="ffprobe-3.2.10")
+        cwd = os.getcwd()
+        results = {}
+
+        def run(name):
+            conv = c.segment('test.mp3', pjoin(self.temp_dir, name),
+                             'index.m3u8', 'segments', {})
+            results[name] = verify_progress(conv)
+
+        # concurrent jobs don't write into each other's directories
+        threads = [threading.Thread(target=run, args=(name,))
+                   for name in ('a', 'b')]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual({'a': True, 'b': True}, results)
+        self.assertEqual(cwd, os.getcwd())
+        for name in ('a', 'b'):
+            with open(pjoin(self.temp_dir, name, 'index.m3u8')) as f:
+                playlist = f.read()
+            self.assertTrue('segments/media00000.ts' in playlist)
+            self.assertTrue(os.path.exists(
+                pjoin(self.temp_dir, name, 'segments', 'media00000.ts')))
+
+    def test_package_hls(self):
+        playlist = pjoin(self.temp_dir, 'index.m3u8')
+        with open(playlist, 'w') as f:
+            f.write('#EXTM3U\n#EXT-X-TARGETDURATION:6\n'
+                    '#EXTINF:6.000000,\nsegment00000.ts\n'
+                    '#EXTINF:4.000000,\nsegment00001.ts\n'
+                    '#EXT-X-ENDLIST\n')
+        for name, size in (('segment00000.ts', 6000), ('segment00001.ts', 5000)):
+            with open(pjoin(self.temp_dir, name), 'wb') as f:
+                f.write(b'\0' * size)
+        self.assertEqual((10000, 8800), Converter._hls_bandwidth(playlist))
+
+        stream = ffmpeg.MediaStreamInfo()
+        for key, val in (('codec_name', 'h264'), ('profile', 'High'), ('level', '31')):
+            stream.parse_ffprobe(key, val)
+        self.assertEqual('avc1.64001F', Converter._codec_string(stream))
+        stream.profile = 'Constrained Baseline'
+        stream.level = 30
+        self.assertEqual('avc1.42E01E', Converter._codec_string(stream))
+        stream.codec, stream.profile, stream.level = 'aac', 'HE-AAC', -99
+        self.assertEqual('mp4a.40.5', Converter._codec_string(stream))
+        stream.codec = 'theora'
+        self.assertEqual(None, Converter._codec_string(stream))
+
+        C = capabilities.Capabilities
+        self.assertEqual((3, 2, 10), C('3.2.10').version_info)
+        self.assertEqual((4, 4, 2), C('4.4.2-0ubuntu0.22.04.1').version_info)
+        self.assertEqual((6, 0, 0), C('n6.0').version_info)
+        self.assertEqual(None, C('N-109421-g3e4f5a6').version_info)
+        c = Converter(ffmpeg_path=sys.executable, ffprobe_path=sys.executable)
+        c.ffmpeg._capabilities = (C('3.2.10', ['libx264', 'aac'], ['hls']),)
+        conv = c.package_hls('test1.ogg', pjoin(self.temp_dir, 'hls'), [
+            {'video': {'codec': 'h264'}}], segment_format='fmp4')
+        self.assertRaisesSpecific(ConverterError, list, conv)
+        self.assertRaisesSpecific(ConverterError, c.parse_options, {
+            'format': 'hls', 'segment_type': 'fmp4', 'video': {'codec': 'h264'}})
+        self.assertTrue(c.parse_options({
+            'format': 'hls', 'segment_type': 'mpegts', 'video': {'codec': 'h264'}}))
+
+        c = Converter(ffmpeg_path="ffmpeg-3.2.10", ffprobe_path="ffprobe-3.2.10")
+        outdir = pjoin(self.temp_dir, 'hls')
+        conv = c.package_hls('test1.ogg', outdir, [
+            {'name': 'hi', 'audio': {'codec': 'aac', 'bitrate': 96},
+             'video': {'codec': 'h264', 'width': 320, 'height': 180, 'bitrate': 600}},
+            {'audio': {'codec': 'aac', 'bitrate': 64},
+             'video': {'codec': 'h264', 'width': 160, 'height': 90, 'bitrate': 200}},
+        ], segment_duration=4)
+        self.assertTrue(verify_progress(conv))
+        with open(pjoin(outdir, 'master.m3u8')) as f:
+            master = f.read().splitlines()
+        self.assertEqual('#EXTM3U', master[0])
+        self.assertEqual(['hi/index.m3u8', 'stream1/index.m3u8'], master[4::2])
+        self.assertTrue('RESOLUTION=320x180' in master[3])
+        self.assertTrue('CODECS="avc1.' in master[3])
+        self.assertTrue('RESOLUTION=160x90' in master[5])
+
+    def test_package_dash(self):
+        self.assertEqual(
+            ['-c:v:1', 'libx264', '-b:v:1', '800k', '-profile:v:1', 'main'],
+            Converter._stream_options(['-vcodec', 'libx264', '-vb', '800k',
+                                       '-profile:v', 'main'], 'v', 1))
+        self.assertEqual(
+            ['-c:a:0', 'aac', '-b:a:0', '96k', '-ac:a:0', '2'],
+            Converter._stream_options(['-acodec', 'aac', '-ab', '96k',
+                                       '-ac', '2'], 'a', 0))
+        self.assertEqual(
+            ['-c:v:0', 'libvpx', '-threads:v:0', '4'],
+            Converter._stream_options(['-vcodec', 'libvpx', '-threads', '4'], 'v', 0))
+        self.assertRaisesSpecific(ConverterError, Converter._stream_options,
+                                  ['-an', '-ab', '96k'], 'a', 0)
+        self.assertRaisesSpecific(ConverterError, Converter._stream_options,
+                                  ['-acodec', 'aac', '-ab'], 'a', 0)
+
+        c = Converter(ffmpeg_path=sys.executable, ffprobe_path=sys.executable)
+        c.ffmpeg._capabilities = (capabilities.Capabilities(
+            '3.2.10', ['libx264', 'aac'], ['dash']),)
+        self.assertRaisesSpecific(ConverterError, list, c.package_dash(
+            'test1.ogg', self.temp_dir, [{'video': {'codec': 'h264'}}]))
+        self.assertRaisesSpecific(ConverterError, c.parse_options, {
+            'format': 'dash', 'video': {'codec': 'h264'}})
+
+        c = Converter(ffmpeg_path="ffmpeg-3.2.10", ffprobe_path="ffprobe-3.2.10")
+        caps = c.ffmpeg.capabilities
+        if caps is not None and caps.version_info and \
+                caps.version_info < formats.DashFormat.ffmpeg_min_version:
+            self.skipTest('DASH packaging needs ffmpeg 4.0 or newer')
+        outdir = pjoin(self.temp_dir, 'dash')
+        audio = {'codec': 'aac', 'bitrate': 64}
+        conv = c.package_dash('test1.ogg', outdir, [
+            {'audio': audio, 'video': {'codec': 'h264', 'width': 320,
+                                       'height': 180, 'bitrate': 600}},
+            {'audio': audio, 'video': {'codec': 'h264', 'width': 160,
+                                       'height': 90, 'bitrate': 200}},
+        ], segment_duration=4)
+        self.assertTrue(verify_progress(conv))
+        with open(pjoin(outdir, 'manifest.mpd')) as f:
+            mpd = f.read()
+        self.assertTrue('SegmentTemplate' in mpd)
+        self.assertEqual(3, mpd.count('<Representation '))
+
+    def test_sprite_sheet(self):
+        self.assertEqual('00:00:00.000', Converter._vtt_timestamp(0))
+        self.assertEqual('01:02:03.450', Converter._vtt_timestamp(3723.45))
+
+        c = Converter(ffmpeg_path="ffmpeg-3.2.10", ffprobe_path="ffprobe-3.2.10")
+        pattern = pjoin(self.temp_dir, 'sprite%03d.jpg')
+        vtt = pjoin(self.temp_dir, 'sprite.vtt')
+        self.assertRaisesSpecific(ConverterError, list, c.sprite_sheet(
+            'test1.ogg', 5, pjoin(self.temp_dir, 'sprite.jpg'), vtt))
+
+        # 32.997s at one per 2s: 17 thumbnails, in 3 sheets of 3x2
+        conv = c.sprite_sheet('test1.ogg', 2, pattern, vtt, tile=(3, 2),
+                              processes=2)
+        self.assertTrue(verify_progress(conv))
+        self.assertEqual([True, True, True, False],
+                         [os.path.exists(pattern % i) for i in range(1, 5)])
+
+        with open(vtt) as f:
+            cues = f.read().split('\n\n')
+        self.assertEqual('WEBVTT', cues[0])
+        self.assertEqual(17, len(cues) - 1)
+        self.assertEqual('00:00:00.000 --> 00:00:02.000\n'
+                         'sprite001.jpg#xywh=0,0,160,88', cues[1])
+        self.assertEqual('00:00:32.000 --> 00:00:32.997\n'
+                         'sprite003.jpg#xywh=160,88,160,88\n', cues[-1])
+
     def test_probe_audio_poster(self):
         c = Converter(ffmpeg_path="ffmpeg-3.2.10", ffprobe_path="ffprobe-3.2.10")
 